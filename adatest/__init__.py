@@ -13,4 +13,6 @@ default_generators = {
     "abstract": TestTree(r"test_trees/abstract_capabilities.csv")
 }
 text_embedding_model = None
-image_embedding_model = None
\ No newline at end of file
+image_embedding_model = None
+embedding_cache_mb = 1024 # the size limit of the in-memory embedding cache in megabytes (None means no limit)
+embedding_dtype = "float32" # the dtype embeddings are cached in ("float16" halves the memory and disk they use)
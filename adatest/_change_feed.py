@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+# the columns the topic models are trained on
+TOPIC_MODEL_COLUMNS = ["topic", "input", "output", "label", "labeler"]
+
+
+class ChangedRows():
+    """ A change feed subscriber that collects the ids of the rows changed since it was last popped.
+
+    Consumers like auto saving, scoring, label imputation and deduplication each keep one of these so they
+    only need to look at the rows touched since their last run.
+    """
+
+    def __init__(self, columns=None, ids=None):
+        """ Create a new changed row collector.
+
+        Parameters
+        ----------
+        columns : list[str] or None
+            Only collect changes that touch these columns (None means changes to any column).
+
+        ids : set or None
+            The initial set of changed ids (None means every row should be treated as changed).
+        """
+        self.columns = columns
+        self.ids = ids
+
+    def __call__(self, ids, columns):
+        if self.ids is None:
+            return
+        if columns is not None and self.columns is not None and not any(c in self.columns for c in columns):
+            return
+        if ids is None:
+            self.ids = None
+        else:
+            self.ids.update(ids)
+
+    def pop(self):
+        """ Return the ids changed since the last call (or None if every row should be treated as changed) and start over.
+        """
+        ids = self.ids
+        self.ids = set()
+        return ids
+
+
+class TopicChanges():
+    """ A change feed subscriber that remembers when the training data of each topic last changed.
+
+    A row is training data for the topic models when it has a real label (it is not a topic marker and was
+    not imputed). Tracking just those rows means that churn in the (imputed) suggestions does not force us to
+    retrain the topic models.
+    """
+
+    def __init__(self, test_tree):
+        self.test_tree = test_tree
+        self._topic_versions = {} # topic -> the tree version when its training data last changed
+        self._reset()
+
+    def _reset(self):
+        tests = self.test_tree._tests
+        trainable = _is_trainable(tests)
+        self._row_topic = dict(zip(tests.index[trainable], tests["topic"][trainable])) # trainable id -> topic
+        self._all_changed_version = self.test_tree.version
+
+    def __call__(self, ids, columns):
+        if columns is not None and not any(c in TOPIC_MODEL_COLUMNS for c in columns):
+            return
+        if ids is None:
+            self._reset()
+            return
+        version = self.test_tree.version
+        for id in ids:
+            topic = self._row_topic.pop(id, None)
+            if topic is not None:
+                self._topic_versions[topic] = version
+        tests = self.test_tree._tests
+        rows = tests.iloc[row_positions(tests.index, ids)]
+        trainable = _is_trainable(rows)
+        for id, topic in zip(rows.index[trainable], rows["topic"][trainable]):
+            self._row_topic[id] = topic
+            self._topic_versions[topic] = version
+
+    def changed_since(self, topic, version):
+        """ Check if the training data a topic model for the given topic could use changed after the given tree version.
+
+        Topic models fall back to the data in parent topics when their own topic has too little data, so we
+        conservatively treat any change inside the topic's top level topic as relevant.
+        """
+        if self._all_changed_version > version:
+            return True
+        scope = "/".join(topic.split("/")[:2])
+        return any(v > version and t.startswith(scope) for t, v in self._topic_versions.items())
+
+
+def row_positions(index, ids):
+    """ The sorted positions of the rows with the given ids (ids that are not in the index are skipped).
+
+    Every change feed subscriber looks up the rows of the same change, so we remember the last lookup and the
+    positions of a change are only computed once. Looking ids up with get_indexer_for costs a pass over the index
+    to build its hash table, but pandas keeps that table on the index object, so later lookups only pay for the
+    ids. Appends and drops give the frame a new index though, so the first lookup on a new index scans it with a
+    vectorized isin instead (which only hashes the ids we are looking for), and we only build the table once the
+    same index is looked up again (e.g. while rows are being edited) or the ids are a large part of the index.
+    """
+    global _last_lookup
+    last_index, last_ids, last_positions = _last_lookup
+    if last_index is index and last_ids is ids:
+        return last_positions
+    id_list = list(ids)
+    if len(id_list) == 0:
+        positions = np.zeros(0, dtype=np.intp)
+    elif last_index is index or len(id_list) * 4 >= len(index):
+        positions = index.get_indexer_for(id_list)
+        positions = np.unique(positions[positions >= 0])
+    else:
+        positions = np.flatnonzero(index.isin(id_list))
+    positions.flags.writeable = False # the positions are shared by everyone who looks up the same change
+    _last_lookup = (index, ids, positions)
+    return positions
+
+_last_lookup = (None, None, None) # the (index, ids, positions) of the last row_positions call
+
+
+def _is_trainable(tests):
+    return ((tests["labeler"] != "imputed") & (tests["label"] != "topic_marker")).values & tests["topic"].notna().values
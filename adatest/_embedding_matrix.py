@@ -0,0 +1,245 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+import pandas as pd
+import adatest
+
+log = logging.getLogger(__name__)
+
+
+class EmbeddingMatrix():
+    """ A contiguous matrix holding the input and output embeddings of the tests in a test tree.
+
+    Each test owns a row (slot) of the matrix that holds its input embedding followed by its output embedding, so
+    consumers get the embeddings of many tests with a single gather instead of looking up every string in the
+    embedding cache and stacking the results. Slots are filled lazily through `adatest.embed` (so the global
+    embedding cache is still shared) and this is a change feed subscriber, so a test whose input or output changes
+    gives up its slot and is re-embedded the next time it is asked for.
+
+    The matrix is kept in memory until `save` is called. When a path is given, `save` writes the matrix to a ".npy"
+    file (and the id and a text hash of every slot to a ".json" file next to it) and from then on the matrix is
+    memory mapped from that file, so embeddings survive restarts and are only recomputed for tests that changed in
+    between. Slots given up since the last save are not reused until the next save, so the saved slot table never
+    points at a row that was overwritten. If the files can't be written we just keep the matrix in memory.
+
+    The embeddings of different models can't share a matrix, so the matrix starts over whenever the text embedding
+    model changes. The matrix is stored in `adatest.embedding_dtype` (so float16 halves its size), but rows are always handed
+    out as float32.
+    """
+
+    def __init__(self, test_tree, path=None):
+        """ Create an (empty) embedding matrix for a test tree.
+
+        Parameters
+        ----------
+        test_tree : adatest.TestTree
+            The test tree whose tests we embed.
+
+        path : str or None
+            The ".npy" file to load the matrix from and save it to (None always keeps the matrix in memory).
+        """
+        self.test_tree = test_tree
+        self.path = path
+        self._reset(adatest.embedders._text_embedding_model().name)
+        self._lock = threading.RLock() # the browser prefetcher fills slots from a background thread
+        if path is not None and os.path.isfile(path) and os.path.isfile(_slots_path(path)):
+            self._load()
+
+    @property
+    def dim(self):
+        """ The size of a single (input or output) embedding.
+        """
+        return 0 if self._matrix is None else self._matrix.shape[1] // 2
+
+    def __call__(self, ids, columns):
+        """ Release the slots of the tests whose text changed (this is a change feed subscriber).
+        """
+        if columns is not None and "input" not in columns and "output" not in columns:
+            return
+        with self._lock:
+            if ids is None:
+                self._release_stale()
+                return
+            for id in ids:
+                slot = self._slots.pop(id, None)
+                if slot is not None:
+                    self._release(slot)
+
+    def get(self, ids, column=None):
+        """ The embeddings of the given tests (one row per id, in order).
+
+        Parameters
+        ----------
+        ids : list-like
+            The ids of the tests to embed.
+
+        column : "input" or "output" or None
+            Which embedding to return for each test (None means the input and output embeddings side by side).
+        """
+        ids = list(ids)
+        with self._lock:
+            model_name = adatest.embedders._text_embedding_model().name
+            if model_name != self.model_name:
+                self._reset(model_name) # vectors from different models can't share a matrix
+            slots = np.array([self._slots.get(id, -1) for id in ids], dtype=np.int64)
+            missing = np.flatnonzero(slots < 0)
+            if len(missing) > 0:
+                self._embed(list(dict.fromkeys(ids[i] for i in missing)))
+                slots[missing] = [self._slots[ids[i]] for i in missing]
+            if self._matrix is None:
+                return np.zeros((0, 0), dtype=np.float32)
+            if column == "input":
+                out = self._matrix[slots, :self.dim]
+            elif column == "output":
+                out = self._matrix[slots, self.dim:]
+            else:
+                out = self._matrix[slots]
+            return out.astype(np.float32, copy=False)
+
+    def save(self):
+        """ Write the matrix and the slot table to disk (this is a no-op for matrices without a path).
+        """
+        if self.path is None or self._matrix is None:
+            return
+        with self._lock:
+            try:
+                if self._mapped:
+                    self._matrix.flush()
+                else:
+                    # the first save (or the first one after the matrix grew) writes the whole matrix and maps it
+                    tmp_path = self.path + ".tmp"
+                    matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self._matrix.dtype, shape=self._matrix.shape)
+                    matrix[:] = self._matrix
+                    matrix.flush()
+                    os.replace(tmp_path, self.path)
+                    self._matrix = matrix
+                    self._mapped = True
+                tmp_path = _slots_path(self.path) + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "ids": self._slot_ids, "hashes": self._slot_hashes}, f)
+                os.replace(tmp_path, _slots_path(self.path))
+            except OSError:
+                log.warning(f"Could not save the embedding matrix to {self.path}, so it will only be kept in memory", exc_info=True)
+                if self._mapped:
+                    self._matrix = np.array(self._matrix)
+                    self._mapped = False
+                self.path = None
+            self._free.extend(self._pending_free)
+            self._pending_free = []
+
+    def _embed(self, ids):
+        tests = self.test_tree._tests
+        positions = tests.index.get_indexer_for(ids)
+        if (positions < 0).any():
+            raise KeyError(f"Can't embed tests that are not in the test tree: {[id for id, p in zip(ids, positions) if p < 0]}")
+        inputs = list(tests["input"].iloc[positions])
+        outputs = list(tests["output"].iloc[positions])
+        embeddings = adatest.embed(inputs + outputs)
+        embeddings = np.hstack([np.vstack(embeddings[:len(ids)]), np.vstack(embeddings[len(ids):])]).astype(self.dtype)
+        hashes = _text_hashes(inputs, outputs)
+
+        if self._matrix is None:
+            self._matrix = self._allocate(max(1024, len(ids)), embeddings.shape[1])
+        slots = []
+        for id, h in zip(ids, hashes):
+            slot = self._free.pop() if len(self._free) > 0 else len(self._slot_ids)
+            if slot == len(self._slot_ids):
+                self._slot_ids.append(None)
+                self._slot_hashes.append(None)
+            self._slot_ids[slot] = id
+            self._slot_hashes[slot] = int(h)
+            self._slots[id] = slot
+            slots.append(slot)
+        if len(self._slot_ids) > self._matrix.shape[0]:
+            self._grow(len(self._slot_ids))
+        self._matrix[slots] = embeddings
+
+    def _allocate(self, capacity, width, old=None):
+        """ Allocate an in-memory matrix with room for the given number of slots (copying over the rows of an old matrix).
+        """
+        matrix = np.zeros((capacity, width), dtype=self.dtype)
+        if old is not None:
+            matrix[:len(old)] = old
+        self._mapped = False # the file (if any) is left alone until the next save
+        return matrix
+
+    def _grow(self, min_capacity):
+        capacity = self._matrix.shape[0]
+        while capacity < min_capacity:
+            capacity *= 2
+        self._matrix = self._allocate(capacity, self._matrix.shape[1], old=self._matrix)
+
+    def _release(self, slot):
+        self._slot_ids[slot] = None
+        self._slot_hashes[slot] = None
+        if self._mapped:
+            self._pending_free.append(slot)
+        else:
+            self._free.append(slot)
+
+    def _release_stale(self):
+        """ Release every slot whose test was removed or whose text no longer matches the text it was computed from.
+        """
+        tests = self.test_tree._tests
+        ids = list(self._slots)
+        positions = tests.index.get_indexer_for(ids)
+        present = positions >= 0
+        current_hashes = np.zeros(len(ids), dtype=np.uint64)
+        current_hashes[present] = _text_hashes(tests["input"].values[positions[present]], tests["output"].values[positions[present]])
+        for id, is_present, h in zip(ids, present, current_hashes):
+            slot = self._slots[id]
+            if not is_present or self._slot_hashes[slot] != int(h):
+                del self._slots[id]
+                self._release(slot)
+
+    def _reset(self, model_name):
+        """ Forget every slot (and start a new matrix for the embeddings of the given model).
+        """
+        self.model_name = model_name
+        self.dtype = np.dtype(adatest.embedding_dtype)
+        self._matrix = None # (capacity, 2 * dim), allocated when we see the first embedding
+        self._mapped = False # whether the matrix is memory mapped from the file at our path
+        self._slot_ids = [] # slot -> id (None for free slots)
+        self._slot_hashes = [] # slot -> hash of the (input, output) pair the slot was computed from
+        self._slots = {} # id -> slot
+        self._free = [] # slots we can reuse
+        self._pending_free = [] # slots given up since the last save
+
+    def _load(self):
+        with open(_slots_path(self.path), encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["model"] != self.model_name:
+            return # the embeddings came from a different model, so we start over
+        try:
+            self._matrix = np.load(self.path, mmap_mode="r+")
+            self._mapped = True
+        except OSError:
+            self._matrix = np.load(self.path) # we can't write the file, so we work on a copy in memory
+        self.dtype = self._matrix.dtype # we keep the dtype the matrix was saved in
+        self._slot_ids = saved["ids"]
+        self._slot_hashes = saved["hashes"]
+        self._slots = {id: slot for slot, id in enumerate(self._slot_ids) if id is not None}
+        self._free = [slot for slot, id in enumerate(self._slot_ids) if id is None]
+        self._release_stale() # the test tree may have been edited without us
+
+
+def embeddings_path(location):
+    """ The ".npy" file we keep the embedding matrix of a test tree stored at the given location in.
+    """
+    if not isinstance(location, str):
+        return None
+    if os.path.isdir(location) or location.endswith("/") or location.endswith(os.sep):
+        return os.path.join(location, "embeddings.npy")
+    return location + ".embeddings.npy"
+
+
+def _slots_path(path):
+    return path[:-len(".npy")] + ".json"
+
+
+def _text_hashes(inputs, outputs):
+    inputs = pd.util.hash_array(np.asarray(inputs, dtype=object))
+    outputs = pd.util.hash_array(np.asarray(outputs, dtype=object))
+    return (inputs * np.uint64(1000003)) ^ outputs
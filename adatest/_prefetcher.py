@@ -0,0 +1,102 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher():
+    """ Warms the embeddings and topic models of the topics around the one a user is looking at in a background thread.
+
+    After a topic change the browser is usually idle while the user reads, so we use that time to embed the tests
+    of the current topic, its children and its siblings, and to (re)train their topic labeling and membership
+    models. The first suggestion request after navigating is then served from warm caches. The browser cancels
+    the prefetcher before handling any other event. Cancelling does not wait for the thread: the tests (and the
+    training data of the topic models) are embedded a small chunk at a time and the thread checks for cancellation
+    between chunks, so it stops soon after, and a topic model that finishes training after we cancelled is dropped
+    since the test tree may have changed under it.
+    """
+
+    max_topics = 20 # the most topics we warm after a single topic change
+    chunk_size = 16 # the most tests we embed between checks for cancellation
+
+    def __init__(self, test_tree):
+        """ Create a prefetcher for a test tree (it does nothing until started).
+        """
+        self.test_tree = test_tree
+        self.warmed = [] # the (step, topic) pairs warmed by the last run
+        self._thread = None
+        self._cancelled = None
+
+    def start(self, topic):
+        """ Start warming the caches around the given topic (cancelling any earlier run).
+        """
+        self.cancel()
+        self.warmed = []
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self.neighborhood(topic), self._cancelled, self.warmed), daemon=True)
+        self._thread.start()
+
+    def cancel(self):
+        """ Stop warming caches (this does not wait for the thread, which exits after the chunk in progress).
+        """
+        if self._cancelled is not None:
+            self._cancelled.set()
+
+    def wait(self):
+        """ Wait for the current run to finish (or to stop, if it was cancelled).
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def neighborhood(self, topic):
+        """ The topics we warm for the given topic: the topic itself, then its children, then its siblings.
+        """
+        out = [topic]
+        out.extend(self._children(topic))
+        if topic != "":
+            out.extend(t for t in self._children(topic.rsplit("/", 1)[0]) if t != topic)
+        return out[:self.max_topics]
+
+    def _children(self, topic):
+        depth = topic.count("/") + 1
+        return [
+            t for t in self.test_tree.topic_index.subtopics(topic, include_self=False)
+            if t.count("/") == depth and not t.endswith("/__suggestions__")
+        ]
+
+    def _run(self, topics, cancelled, warmed):
+        steps = [
+            ("embeddings", lambda topic: self._embed_topic(topic, cancelled)),
+            ("labeling", lambda topic: self._train_topic_model("labeling", topic, cancelled)),
+            ("membership", lambda topic: self._train_topic_model("membership", topic, cancelled))
+        ]
+        for topic in topics:
+            for name, step in steps:
+                if cancelled.is_set():
+                    return
+                try:
+                    step(topic)
+                    if cancelled.is_set(): # the step may have stopped early
+                        return
+                    warmed.append((name, topic))
+                except Exception:
+                    log.debug(f"Failed to prefetch the {name} of topic {topic}", exc_info=True)
+
+    def _embed_topic(self, topic, cancelled):
+        self._embed(self.test_tree.topic_index.ids(topic), cancelled)
+
+    def _train_topic_model(self, kind, topic, cancelled):
+        if not self.test_tree._topic_model_needs_training(kind, topic):
+            return
+        model = self.test_tree.labeling_model if kind == "labeling" else self.test_tree.membership_model
+        if hasattr(model, "training_ids"): # embed the training data first, so training itself only reads cached embeddings
+            self._embed(model.training_ids(topic, self.test_tree), cancelled)
+        if not cancelled.is_set():
+            self.test_tree._train_topic_model(kind, topic, cancelled)
+
+    def _embed(self, ids, cancelled):
+        for start in range(0, len(ids), self.chunk_size):
+            if cancelled.is_set():
+                return
+            self.test_tree._cache_embeddings(ids[start:start + self.chunk_size])
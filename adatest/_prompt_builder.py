@@ -1,6 +1,5 @@
 import numpy as np
 import logging
-import re
 import urllib.parse
 import adatest
 from .embedders import cos_sim
@@ -114,16 +113,7 @@ class PromptBuilder():
         # hide rows that don't match the filter
         hidden_scaling = np.ones(len(ids))
         if filter != "":
-            filter_compiled = re.compile(filter)
-            for i,k in enumerate(ids):
-                test = test_tree.loc[k]
-                if filter_compiled.search(test.test_type) is not None:
-                    continue
-                if hasattr(test, "input") and filter_compiled.search(test.input) is not None:
-                    continue
-                if hasattr(test, "output") and filter_compiled.search(test.output) is not None:
-                    continue
-                hidden_scaling[i] = 0.0
+            hidden_scaling[~test_tree.query(regex=filter).reindex(ids, fill_value=False).values] = 0.0
 
         # filter down to a single test type (chosen to match the top scoring test)
         if suggest_topics:
@@ -162,10 +152,7 @@ class PromptBuilder():
                         [urllib.parse.unquote(test_tree.loc[id, "topic"].split("/")[-1]) for id in ids]
                     ))
                 else:
-                    embeddings_arr = np.hstack([
-                        np.vstack(adatest.embed([test_tree.loc[id, "input"] for id in ids])),
-                        np.vstack(adatest.embed([test_tree.loc[id, "output"] for id in ids]))
-                    ])
+                    embeddings_arr = test_tree.embeddings(ids)
                 similarities = cos_sim(embeddings_arr, embeddings_arr)
             hard_avoidance = np.zeros(len(ids))
             diversity = np.ones(len(ids))
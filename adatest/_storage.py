@@ -0,0 +1,530 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+import contextlib
+import urllib.parse
+import numpy as np
+import pandas as pd
+from ._change_feed import row_positions
+
+log = logging.getLogger(__name__)
+
+# file extensions we store as columnar (Apache Arrow based) files instead of CSV
+COLUMNAR_EXTENSIONS = [".parquet", ".feather", ".arrow"]
+
+# the low-cardinality metadata columns we keep as categoricals in memory (and dictionary encode in columnar files)
+CATEGORICAL_COLUMNS = ["topic", "label", "labeler"]
+
+
+def saveable_tests(tests):
+    """ The rows of a tests frame that should be persisted (everything except pending suggestions).
+    """
+    return tests.loc[~tests["topic"].str.contains("/__suggestions__", regex=False, na=False)]
+
+
+def is_columnar_path(path):
+    """ Check if a path should be stored as a columnar (Parquet or Arrow IPC/Feather) file.
+    """
+    return isinstance(path, str) and os.path.splitext(path)[1].lower() in COLUMNAR_EXTENSIONS
+
+
+def write_tests(tests, path):
+    """ Write a tests frame to a file (picking the format from the extension) so that readers never see a partially written file.
+    """
+    tmp_path = path + ".tmp"
+    if is_columnar_path(path):
+        write_columnar(tests, tmp_path, format="parquet" if path.lower().endswith(".parquet") else "feather")
+    else:
+        tests.to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_columnar(tests, path, format="parquet"):
+    """ Write a tests frame as a Parquet or Arrow IPC (Feather) file.
+
+    Score columns are stored as floats whenever all their values are numeric, and the topic, label and labeler
+    columns are dictionary encoded.
+    """
+    import pyarrow as pa
+
+    typed = tests.copy()
+    for c in typed.columns:
+        if c in CATEGORICAL_COLUMNS:
+            typed[c] = typed[c].astype("category")
+        elif c.endswith(" score"):
+            missing = typed[c].isna() | (typed[c] == "")
+            values = pd.to_numeric(typed[c].where(~missing, np.nan), errors="coerce")
+            typed[c] = values if values.isna().sum() == missing.sum() else _as_nullable_str(typed[c])
+        elif typed[c].dtype == object:
+            typed[c] = _as_nullable_str(typed[c])
+
+    table = pa.Table.from_pandas(typed, preserve_index=True)
+    if format == "parquet":
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, path)
+    elif format == "feather":
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, path)
+    else:
+        raise ValueError(f"Unknown columnar format: {format}")
+
+
+def read_columnar(path, memory_map=False):
+    """ Read a tests frame from a Parquet or Arrow IPC (Feather) file.
+    """
+    if path.lower().endswith(".parquet"):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path, memory_map=memory_map)
+    else:
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(path, memory_map=memory_map)
+    tests = table.to_pandas()
+    tests.index = tests.index.map(str)
+
+    # the canonical text columns never hold missing values in a test tree
+    for c in ["topic", "input", "output", "label", "labeler", "description"]:
+        if c not in tests.columns:
+            continue
+        if isinstance(tests[c].dtype, pd.CategoricalDtype):
+            # dictionary encoded columns come back as categoricals, which is how TestTree stores them anyway
+            if tests[c].isna().any():
+                if "" not in tests[c].cat.categories:
+                    tests[c] = tests[c].cat.add_categories([""])
+                tests[c] = tests[c].fillna("")
+        else:
+            tests[c] = tests[c].astype(object).where(tests[c].notna(), "").astype(str)
+    return tests
+
+
+def _as_nullable_str(values):
+    """ Convert the non-missing values of a column to strings (so Arrow sees a single type).
+    """
+    return values.astype(object).where(values.isna(), values.astype(str))
+
+
+class TestTreeJournal():
+    """ An append-only write-ahead log of row edits that lives next to a test tree file.
+
+    Instead of rewriting the whole file after every edit we append just the changed rows (and deletions)
+    to a sidecar "<file>.journal" file. Every `compact_every` entries the journal is compacted back into the
+    main file on a background thread. Loading a test tree replays any journal entries that were not yet
+    compacted, so a crash at any point loses at most the edits that were never saved.
+    """
+
+    def __init__(self, location, saved_ids=(), compact_every=1000):
+        """ Create a journal for the test tree stored at the given location.
+
+        Parameters
+        ----------
+        location : str
+            The path of the test tree file.
+
+        saved_ids : iterable
+            The ids of the rows already persisted in the file and journal.
+
+        compact_every : int
+            How many journal entries to accumulate before compacting them into the main file.
+        """
+        self.location = location
+        self.path = location + ".journal"
+        self.compact_every = compact_every
+        self.num_entries = 0
+        self._saved_ids = set(saved_ids)
+        self._lock = threading.Lock()
+        self._compaction_thread = None
+        if os.path.isfile(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.num_entries = sum(1 for _ in f)
+
+    def append(self, tests, ids):
+        """ Append the current state of the given rows (or their deletion) to the journal.
+        """
+        entries = []
+        rows = tests.iloc[row_positions(tests.index, ids)]
+        rows = rows.loc[~rows.index.duplicated()]
+        is_suggestion = rows["topic"].str.contains("/__suggestions__", regex=False, na=False)
+        for id, row in rows.loc[~is_suggestion.values].iterrows():
+            entries.append({"id": id, "row": row.to_dict()})
+            self._saved_ids.add(id)
+        for id in list(rows.index[is_suggestion.values]) + [id for id in ids if id not in rows.index]:
+            if id in self._saved_ids:
+                entries.append({"id": id, "deleted": True})
+                self._saved_ids.discard(id)
+
+        if len(entries) > 0:
+            with self._lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(e, default=_json_default) + "\n" for e in entries))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.num_entries += len(entries)
+
+    def compact(self, tests, background=True):
+        """ Rewrite the main file from the given tests frame and retire the current journal entries.
+
+        The frame is copied up front, so the caller can keep editing it while the file is written.
+        """
+        self.wait()
+        snapshot = saveable_tests(tests).copy()
+        compacting_path = self.path + ".compacting"
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.replace(self.path, compacting_path)
+            self.num_entries = 0
+            self._saved_ids = set(snapshot.index)
+
+        def write():
+            write_tests(snapshot, self.location)
+            if os.path.isfile(compacting_path):
+                os.remove(compacting_path)
+
+        if background:
+            self._compaction_thread = threading.Thread(target=write)
+            self._compaction_thread.start()
+        else:
+            write()
+
+    def wait(self):
+        """ Block until any background compaction has finished.
+        """
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+            self._compaction_thread = None
+
+
+def replay_journal(tests, location):
+    """ Apply any journal entries saved next to the given location to the freshly loaded tests frame.
+
+    Entries from an interrupted compaction are replayed before the live journal (replaying an entry that
+    already made it into the main file is harmless since each entry holds the full row).
+    """
+    final_rows = {}
+    for path in [location + ".journal.compacting", location + ".journal"]:
+        if not os.path.isfile(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning(f"Skipping a corrupt test tree journal entry in {path}")
+                    continue # a partially written last line from a crash
+                final_rows[entry["id"]] = entry.get("row", None)
+
+    if len(final_rows) == 0:
+        return tests
+    tests = tests.loc[~tests.index.isin(list(final_rows))]
+    upserts = {id: row for id, row in final_rows.items() if row is not None}
+    if len(upserts) > 0:
+        tests = pd.concat([tests, pd.DataFrame.from_dict(upserts, orient="index")])
+    return tests
+
+
+def remove_journal(location):
+    """ Remove the journal files next to a test tree file (once the file was rewritten in full without them).
+    """
+    for path in [location + ".journal.compacting", location + ".journal"]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+# file extensions we store as SQLite databases
+SQLITE_EXTENSIONS = [".sqlite", ".sqlite3", ".db"]
+
+
+def is_sqlite_path(path):
+    """ Check if a path should be stored as a SQLite database.
+    """
+    return isinstance(path, str) and os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+
+class SQLiteTestTreeStore():
+    """ Stores the rows of a test tree in a local SQLite database.
+
+    Every save is a single small transaction that upserts just the changed rows (and marks deleted rows with a
+    tombstone), so several processes can edit the same test tree at once. Each write stamps the rows it touches with
+    a new version number, which lets every process cheaply pull in the edits made by the others (see `changes_since`).
+    The topic, label, labeler and version columns are indexed.
+
+    Rows are read lazily: a test tree starts with just the topic markers and the tests of the root topic, reads the
+    tests of a topic with a range scan over the topic index the first time the topic is used (see `read_topic`),
+    and answers queries by first reading the rows that could match with an indexed query (see `read_matching`).
+    """
+
+    # the columns stored directly in the database (any other columns, like scores, are stored as JSON in "extra")
+    columns = ["topic", "input", "output", "label", "labeler", "description"]
+    compact_every = float("inf") # rows are updated in place, so there is never a journal to compact
+    num_entries = 0
+
+    def __init__(self, location):
+        self.location = location
+        self.version = 0 # the newest version we have read from the database
+        self._loaded_topics = [] # the topics whose whole subtree we have read
+        self._read_ids = set() # the ids of all the rows we have read
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tests (id TEXT PRIMARY KEY, " + ", ".join(c + " TEXT" for c in self.columns) +
+                ", extra TEXT, version INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            for c in ["topic", "label", "labeler", "version"]:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS tests_{c} ON tests({c})")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.location, timeout=30, isolation_level=None)
+        return contextlib.closing(conn)
+
+    def read(self):
+        """ Read the rows a test tree needs up front: every topic marker and the tests in the root topic.
+        """
+        with self._connect() as conn:
+            self.version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM tests").fetchone()[0]
+        return self._select("deleted = 0 AND (label = 'topic_marker' OR topic = '')", ())
+
+    def is_loaded(self, topic):
+        """ Check if we have read all the tests of a topic.
+        """
+        return any(t == "" or topic == t or topic.startswith(t + "/") for t in self._loaded_topics)
+
+    def read_topic(self, topic):
+        """ Read the tests of a topic and all its subtopics ("" reads every row).
+        """
+        self._loaded_topics.append(topic)
+        if topic == "":
+            return self._select("deleted = 0", ())
+        where, params = _topic_condition(topic, subtopics=True)
+        return self._select("deleted = 0 AND " + where, params)
+
+    def read_matching(self, topic=None, subtopics=True, labels=None, text=None):
+        """ Read the rows that could match a `TestTree.query` with the given conditions (None means no condition).
+        """
+        conditions = ["deleted = 0"]
+        params = ()
+        if topic is not None:
+            where, topic_params = _topic_condition(topic, subtopics)
+            conditions.append(where)
+            params += topic_params
+        if labels is not None:
+            conditions.append("label IN (" + ", ".join(["?"] * len(labels)) + ")")
+            params += tuple(labels)
+        if text is not None:
+            conditions.append("(instr(input, ?) > 0 OR instr(output, ?) > 0)")
+            params += (text, text)
+        return self._select(" AND ".join(conditions), params)
+
+    def mark_read(self, ids):
+        """ Record that the given rows (e.g. pulled in with `changes_since`) are now in the tests frame.
+        """
+        self._read_ids.update(ids)
+
+    def _select(self, where, params):
+        with self._connect() as conn:
+            records = conn.execute("SELECT id, " + ", ".join(self.columns) + ", extra FROM tests WHERE " + where + " ORDER BY id", params).fetchall()
+        self._read_ids.update(r[0] for r in records)
+        return self._frame(records)
+
+    def _frame(self, records):
+        tests = pd.DataFrame([r[1:len(self.columns)+1] for r in records], index=[r[0] for r in records], columns=self.columns, dtype=object)
+        extras = pd.DataFrame.from_records([json.loads(r[len(self.columns)+1]) for r in records], index=tests.index)
+        return pd.concat([tests, extras], axis=1)
+
+    def changes_since(self, version):
+        """ Return the rows written after the given version.
+
+        Returns
+        -------
+        (DataFrame, list, int)
+            The rows that were added or edited, the ids of the rows that were deleted, and the newest version seen.
+        """
+        with self._connect() as conn:
+            records = conn.execute(
+                "SELECT id, " + ", ".join(self.columns) + ", extra, version, deleted FROM tests WHERE version > ? ORDER BY id",
+                (version,)
+            ).fetchall()
+        new_version = max([version] + [r[-2] for r in records])
+        deleted_ids = [r[0] for r in records if r[-1]]
+        return self._frame([r for r in records if not r[-1]]), deleted_ids, new_version
+
+    def append(self, tests, ids):
+        """ Save the current state of the given rows (or their deletion) in a single transaction.
+        """
+        rows = tests.iloc[row_positions(tests.index, ids)]
+        rows = rows.loc[~rows.index.duplicated()]
+        is_suggestion = rows["topic"].str.contains("/__suggestions__", regex=False, na=False).values
+        deleted_ids = list(rows.index[is_suggestion]) + [id for id in ids if id not in rows.index]
+        self._write(rows.loc[~is_suggestion], deleted_ids)
+
+    def compact(self, tests, background=False):
+        """ Make the database match the given tests frame (rows we never read are left alone).
+        """
+        rows = saveable_tests(tests)
+        rows = rows.loc[~rows.index.duplicated()]
+        self._write(rows, [id for id in self._read_ids if id not in rows.index])
+
+    def wait(self):
+        pass
+
+    def _write(self, rows, deleted_ids):
+        if len(rows) == 0 and len(deleted_ids) == 0:
+            return
+        extra_columns = [c for c in rows.columns if c not in self.columns]
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last_version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM tests").fetchone()[0]
+                version = last_version + 1
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tests VALUES (" + ", ".join(["?"] * (len(self.columns) + 4)) + ")",
+                    [
+                        (id,) + tuple(row[:len(self.columns)]) + (json.dumps(dict(zip(extra_columns, row[len(self.columns):])), default=_json_default), version, 0)
+                        for id, row in zip(rows.index, rows[self.columns + extra_columns].itertuples(index=False, name=None))
+                    ]
+                )
+                conn.executemany("UPDATE tests SET deleted = 1, version = ? WHERE id = ?", [(version, id) for id in deleted_ids])
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+
+        self._read_ids.update(rows.index)
+        self._read_ids.difference_update(deleted_ids)
+
+        # if nobody else wrote in between then we are still up to date with the database
+        if last_version == self.version:
+            self.version = version
+
+
+def _topic_condition(topic, subtopics):
+    """ A SQL condition matching a topic (and its subtopics) that can use the topic index.
+    """
+    if not subtopics:
+        return "topic = ?", (topic,)
+    return "(topic = ? OR (topic >= ? AND topic < ?))", (topic, topic + "/", topic + "0") # "0" is the character right after "/"
+
+
+def is_sharded_path(path):
+    """ Check if a path should be stored as a directory of per top level topic shards.
+    """
+    return isinstance(path, str) and (os.path.isdir(path) or path.endswith("/") or path.endswith(os.sep))
+
+
+def shard_key(topic):
+    """ The shard a topic is stored in (the name of its top level topic, or "" for the root topic).
+    """
+    parts = topic.split("/") if isinstance(topic, str) else []
+    return parts[1] if len(parts) > 1 else ""
+
+
+def shard_keys(tests):
+    """ The shard each row of a tests frame is stored in.
+
+    The topic markers of the top level topics live in the root shard, so listing the top level topics never
+    requires reading their shards. This is computed once per distinct topic, so it stays cheap on large frames.
+    """
+    codes, topics = pd.factorize(tests["topic"], use_na_sentinel=False)
+    keys = np.array([shard_key(t) for t in topics], dtype=object)[codes]
+    is_top_level = np.array([isinstance(t, str) and t.count("/") == 1 for t in topics], dtype=bool)[codes]
+    keys[is_top_level & (tests["label"] == "topic_marker").values] = ""
+    return keys
+
+
+class ShardedTestTreeStore():
+    """ Stores a test tree as a directory with one CSV file per top level topic.
+
+    The rows of the root topic (and the topic markers of the top level topics) live in "root.csv" and the rows of
+    each top level topic live in "topics/<quoted topic name>.csv". Only the root shard is read up front, the other
+    shards are read the first time their topic is used (see `TestTree.load_topic`), and saving only rewrites the
+    shards that hold changed rows. Rows added to a shard that was never read are merged into its file on save.
+    """
+
+    # the columns every shard has (any others, like scores, are only in the shards that have them)
+    columns = ["topic", "input", "output", "label", "labeler", "description"]
+    compact_every = float("inf") # every save rewrites whole shards, so there is never a journal to compact
+    num_entries = 0
+
+    def __init__(self, location):
+        self.location = location
+        self.loaded = set() # the keys of the shards we have read
+        self._row_shard = {} # id -> the shard each row we read or wrote is stored in
+
+    def path(self, key):
+        """ The file a shard is stored in.
+        """
+        if key == "":
+            return os.path.join(self.location, "root.csv")
+        return os.path.join(self.location, "topics", urllib.parse.quote(key, safe="") + ".csv")
+
+    def shards(self):
+        """ The keys of all the shards stored on disk.
+        """
+        topics_dir = os.path.join(self.location, "topics")
+        names = sorted(os.listdir(topics_dir)) if os.path.isdir(topics_dir) else []
+        return [""] + [urllib.parse.unquote(name[:-4]) for name in names if name.endswith(".csv")]
+
+    def read(self, key=""):
+        """ Read the rows of a shard (an empty frame if the shard does not exist yet) and remember that it is loaded.
+        """
+        tests = self._read_file(key)
+        self.loaded.add(key)
+        for id in tests.index:
+            self._row_shard[id] = key
+        return tests
+
+    def append(self, tests, ids):
+        """ Rewrite the shards that held or now hold the given rows.
+        """
+        keys = set(self._row_shard[id] for id in ids if id in self._row_shard)
+        positions = row_positions(tests.index, ids)
+        keys.update(shard_keys(tests.iloc[positions]))
+        self._write(tests, keys, deleted_ids=[id for id in ids if id not in tests.index[positions]])
+
+    def compact(self, tests, background=False):
+        """ Rewrite every shard we have read (and any shard that the given tests frame has rows in).
+        """
+        self._write(tests, self.loaded | set(shard_keys(tests)), deleted_ids=[])
+
+    def wait(self):
+        pass
+
+    def _read_file(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return pd.DataFrame([], columns=self.columns, dtype=str)
+        tests = pd.read_csv(path, index_col=0, dtype=str, keep_default_na=False)
+        tests.index = tests.index.map(str)
+        return tests
+
+    def _write(self, tests, keys, deleted_ids):
+        if len(keys) == 0:
+            return
+        rows = saveable_tests(tests)
+        row_keys = shard_keys(rows)
+        deleted_ids = set(deleted_ids)
+        os.makedirs(os.path.join(self.location, "topics"), exist_ok=True)
+        for key in keys:
+            shard = rows.loc[row_keys == key]
+
+            # a shard we never read still holds rows we don't have in memory, so we merge into it
+            if key not in self.loaded:
+                on_disk = self._read_file(key)
+                on_disk = on_disk.loc[~on_disk.index.isin(deleted_ids) & ~on_disk.index.isin(tests.index)]
+                shard = pd.concat([on_disk, shard])
+
+            path = self.path(key)
+            if len(shard) == 0 and key != "":
+                if os.path.isfile(path):
+                    os.remove(path)
+            else:
+                write_tests(shard, path)
+            for id in shard.index:
+                self._row_shard[id] = key
+        for id in deleted_ids:
+            self._row_shard.pop(id, None)
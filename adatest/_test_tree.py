@@ -4,12 +4,21 @@ import os
 import io
 import time
 import re
+import warnings
 import numpy as np
 import pandas as pd
 from ._prompt_builder import PromptBuilder
 from ._test_tree_browser import TestTreeBrowser, is_subtopic
 from ._model import Model
 from ._topic_model import TopicLabelingModel, TopicMembershipModel
+from ._topic_index import TopicIndex
+from ._topic_stats import TopicStats
+from ._text_index import TextIndex
+from ._embedding_matrix import EmbeddingMatrix, embeddings_path
+from ._storage import TestTreeJournal, replay_journal, remove_journal, saveable_tests, is_columnar_path, read_columnar, write_tests, write_columnar
+from ._storage import SQLiteTestTreeStore, is_sqlite_path, CATEGORICAL_COLUMNS
+from ._storage import ShardedTestTreeStore, is_sharded_path, shard_key
+from ._change_feed import ChangedRows, TopicChanges, row_positions
 import adatest
 from pathlib import Path
 
@@ -34,14 +43,19 @@ class TestTree():
     webserver. A TestTree object also conforms to most of the standard pandas DataFrame API.
     """
 
-    def __init__(self, tests=None, labeling_model=TopicLabelingModel, membership_model=TopicMembershipModel, index=None, compute_embeddings=False, ensure_topic_markers=True, cache_file=None, **kwargs):
+    def __init__(self, tests=None, labeling_model=TopicLabelingModel, membership_model=TopicMembershipModel, index=None, compute_embeddings=False, ensure_topic_markers=True, cache_file=None, journal=False, memory_map=False, **kwargs):
         """ Create a new test tree.
 
         Parameters
         ----------
         tests : str or DataFrame or list or tuple or None
             The tests to load as a test tree. If a string is provided, it is assumed to be a path to a CSV file containing
-            the tests. If tests is a tuple of two elements, it is assumed to be a dataset of (data, labels) which will be used to build a test tree.
+            the tests (or a Parquet/Arrow IPC file when the path ends in ".parquet", ".feather" or ".arrow", or a SQLite
+            database when the path ends in ".sqlite", ".sqlite3" or ".db"). SQLite test trees only read the tests of a topic
+            (with an indexed query) the first time it is used, save each batch of edits as a single small transaction,
+            and can pull in the edits saved by other processes with `refresh`. If the
+            path is a directory (or ends in "/") the test tree is stored with one CSV file per top level topic, and each
+            of those files is only read when its topic is first used (see `load_topic`). If tests is a tuple of two elements, it is assumed to be a dataset of (data, labels) which will be used to build a test tree.
             Otherwise tests is passed to the pandas DataFrame constructor to load the tests as a DataFrame.
 
         index : list or list-like or None
@@ -50,6 +64,15 @@ class TestTree():
         compute_embeddings: boolean
             If True, use the global adatest.embed to build embeddings of tests in the TestTree.
 
+        journal : bool
+            If True (and tests is a CSV file path), `save` appends just the changed rows to a "<file>.journal" sidecar
+            file instead of rewriting the whole CSV file, and periodically compacts the journal back into the CSV
+            file in the background. Any journal found next to a CSV file is always replayed when it is loaded.
+
+        memory_map : bool
+            If True, memory map Parquet/Arrow IPC files while reading them, which makes loading faster (the rows are
+            still copied into an in-memory frame, and this has no effect on CSV files).
+
         kwargs : dict
             Additional keyword arguments are passed to the pandas DataFrame constructor.
         """
@@ -59,12 +82,25 @@ class TestTree():
 
         self.labeling_model = labeling_model
         self.membership_model = membership_model
+        self._init_state()
 
         # create a new test tree in memory
         if tests is None:
             self._tests = pd.DataFrame([], columns=column_names, dtype=str)
             self._tests_location = None
 
+        # load the test tree from (or create it in) a SQLite database
+        elif isinstance(tests, str) and is_sqlite_path(tests):
+            self._tests_location = tests
+            self._store = SQLiteTestTreeStore(tests)
+            self._tests = self._store.read()
+
+        # load the root of the test tree from (or create it in) a directory of per top level topic shards
+        elif isinstance(tests, str) and is_sharded_path(tests):
+            self._tests_location = tests
+            self._store = ShardedTestTreeStore(tests)
+            self._tests = self._store.read()
+
         # create a new test tree on disk (lazily saved)
         elif isinstance(tests, str) and not os.path.isfile(tests):
             self._tests = pd.DataFrame([], columns=column_names)
@@ -73,9 +109,14 @@ class TestTree():
         # load the test tree from a file or IO stream
         elif isinstance(tests, str) or isinstance(tests, io.TextIOBase):
             self._tests_location = tests
-            if os.path.isfile(tests) or isinstance(tests, io.TextIOBase):
+            if is_columnar_path(tests) and os.path.isfile(tests):
+                self._tests = read_columnar(tests, memory_map=memory_map)
+                self._tests = replay_journal(self._tests, tests)
+            elif os.path.isfile(tests) or isinstance(tests, io.TextIOBase):
                 self._tests = pd.read_csv(tests, index_col=0, dtype=str, keep_default_na=False)
                 self._tests.index = self._tests.index.map(str)
+                if isinstance(tests, str):
+                    self._tests = replay_journal(self._tests, tests)
             else:
                 raise Exception(f"The provided tests file is not supported: {tests}")
 
@@ -116,6 +157,8 @@ class TestTree():
             self._tests.index = index
             self._tests_location = None
 
+        self._embeddings_path = embeddings_path(self._tests_location)
+
         # # ensure auto saving is possible when requested
         # if auto_save and self._tests_location is None:
         #     raise Exception("auto_save=True is only supported when loading from a file or IO stream")
@@ -137,53 +180,222 @@ class TestTree():
         if ensure_topic_markers:
             self.ensure_topic_markers()
 
-        # drop any duplicate index values
-        self._tests = self._tests.groupby(level=0).first()
+        # drop any duplicate index values (keeping the first) and sort by id
+        if not self._tests.index.is_unique:
+            self._tests = self._tests.groupby(level=0).first()
+        else:
+            self._tests = self._tests.sort_index()
 
         # fix spaces in topics names that are not URI encoded
-        self._tests['topic'] = self._tests['topic'].apply(lambda x: x.replace(" ", "%20"))
+        self._tests['topic'] = self._tests['topic'].str.replace(" ", "%20", regex=False)
 
         # drop any duplicate rows
         self._tests.drop_duplicates(["topic", "input", "output", "labeler"], inplace=True)
 
         # put the columns in a consistent order
-        self._tests = self._tests[column_names + [c for c in self._tests.columns if c not in column_names]]
+        extra_columns = [c for c in self._tests.columns if c not in column_names]
+        self._tests = self._tests[column_names + extra_columns]
+
+        # extra columns (like scores) can hold mixed types, so we don't let them be inferred as pure string columns
+        for c in extra_columns:
+            if isinstance(self._tests[c].dtype, pd.StringDtype):
+                self._tests[c] = self._tests[c].astype(object)
 
         if compute_embeddings:
             self._cache_embeddings()
 
         # replace any invalid topics with the empty string
-        for i, row in self._tests.iterrows():
-            if not isinstance(row.topic, str) or not row.topic.startswith("/"):
-                self._tests.loc[i, "topic"] = ""
+        valid_topics = self._tests['topic'].str.startswith("/", na=False)
+        if not valid_topics.all():
+            self._tests.loc[~valid_topics, "topic"] = ""
 
-        self._topic_labeling_models = {}
-        self._topic_membership_models = {}
+        # store the low-cardinality metadata columns as categoricals
+        self._categorize()
+
+        if journal and self._store is None:
+            if not isinstance(self._tests_location, str):
+                raise Exception("journal=True is only supported when loading from a file path!")
+            self._store = TestTreeJournal(self._tests_location, saved_ids=saveable_tests(self._tests).index)
 
         # # keep track of our original state
         # if self.auto_save:
         #     self._last_saved_tests = self._tests.copy()
 
+    def _init_state(self):
+        """ Initialize the cached models and indexes that are derived from the tests frame.
+        """
+        self._topic_labeling_models = {}
+        self._topic_membership_models = {}
+        self._topic_model_versions = {} # (model kind, topic) -> the tree version the topic model was trained on
+        self._topic_index = None # built lazily the first time we navigate the topics
+        self._topic_stats = None # built lazily the first time we summarize the topics
+        self._text_index = None # built the first time we search the text of a large test tree
+        self._embedding_matrix = None # created the first time we are asked for embeddings
+        self._embeddings_path = None # where we persist the embedding matrix (only set for test trees loaded from a path)
+        self._query_cache = {} # query arguments -> result mask (for the tree version below)
+        self._query_cache_version = 0
+        self._store = None # the journal or database we save edits to incrementally (if any)
+        self._dedup_owners = None # (topic, input, output) hash -> id, maintained for incremental deduplication
+        self._dedup_keys = None # id -> (topic, input, output) hash
+
+        # the change feed that lets everything derived from the tests frame update incrementally
+        self._version = 0
+        self._change_subscribers = []
+        self._topic_changes = None # created when the first topic model is trained
+        self.subscribe(self._update_topic_index)
+        self._unsaved_changes = self.subscribe(ChangedRows(ids=set()))
+        self._dedup_changes = self.subscribe(ChangedRows(columns=["topic", "input", "output"]))
+        self._impute_changes = self.subscribe(ChangedRows(columns=["label"]))
+
+    @classmethod
+    def _from_slice(cls, tests, parent):
+        """ Wrap a slice of another test tree's frame without re-running the constructor.
+
+        The parent tree is already normalized (topic markers, encoded topics, column order, etc.) so any subset of
+        its rows is too, and we can skip straight to sharing the sliced frame with the new test tree.
+        """
+        if not tests.index.is_unique:
+            tests = tests.loc[~tests.index.duplicated()]
+        test_tree = cls.__new__(cls)
+        test_tree.labeling_model = parent.labeling_model
+        test_tree.membership_model = parent.membership_model
+        test_tree._tests = tests
+        test_tree._tests_location = parent._tests_location
+        test_tree._init_state()
+        return test_tree
+
+    @property
+    def topic_index(self):
+        """ The sorted-path index over our topic column (built on first use and then kept in sync with edits).
+        """
+        if self._topic_index is None:
+            self._topic_index = TopicIndex(self._tests)
+        return self._topic_index
+
+    @property
+    def version(self):
+        """ A counter that goes up every time the test tree changes.
+        """
+        return self._version
+
+    def subscribe(self, callback):
+        """ Register a callback that is called after every change to the test tree.
+
+        Parameters
+        ----------
+        callback : callable
+            Called as callback(ids, columns) where `ids` are the ids of the rows that were added, edited, or removed
+            (None means any row may have changed) and `columns` are the columns that changed (None means any column).
+
+        Returns
+        -------
+        callable
+            The callback (so it can be passed to `unsubscribe` later).
+        """
+        self._change_subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        """ Stop calling a callback registered with `subscribe`.
+        """
+        self._change_subscribers.remove(callback)
+
+    @property
+    def topic_stats(self):
+        """ The per-topic aggregate label counts and scores (built on first use and then kept in sync with edits).
+        """
+        score_columns = [c for c in self._tests.columns if c.endswith("score")]
+        if self._topic_stats is None or self._topic_stats.score_columns != score_columns:
+            self._topic_stats = TopicStats(self, score_columns)
+        return self._topic_stats
+
+    def _rows_changed(self, ids, columns=None):
+        """ Publish a change to the given rows (None means any row may have changed) and columns (None means any column).
+        """
+        self._version += 1
+        for callback in self._change_subscribers:
+            callback(ids, columns)
+
+    def _update_topic_index(self, ids, columns):
+        # the topic stats look up the old topics of the changed rows, so they have to go before the index update
+        if self._topic_stats is not None and not self._topic_stats.update(ids, columns):
+            self._topic_stats = None
+        if self._topic_index is None or (columns is not None and "topic" not in columns and "label" not in columns):
+            return
+        if ids is None:
+            self._topic_index = None
+        else:
+            self._topic_index.update(self._tests, ids)
+
+    def _categorize(self, columns=CATEGORICAL_COLUMNS):
+        """ Make sure the topic, label and labeler columns are stored as categoricals.
+
+        Each row then only holds a small integer code, and masks like tests["label"] == "topic_marker" compare
+        codes instead of strings. Pandas falls back to object columns when we enlarge the frame or concatenate
+        frames with different categories, so this is called after those operations to restore the categoricals.
+        """
+        for c in columns:
+            if c in self._tests.columns and not isinstance(self._tests[c].dtype, pd.CategoricalDtype):
+                self._tests[c] = self._tests[c].astype("category")
+
+    def _add_categories(self, column, values):
+        """ Make sure a categorical column can hold the given values (so we can assign them in place).
+        """
+        if column not in CATEGORICAL_COLUMNS or column not in self._tests.columns:
+            return
+        categories = self._tests[column].dtype.categories if isinstance(self._tests[column].dtype, pd.CategoricalDtype) else None
+        if categories is None:
+            return
+        new_categories = [v for v in dict.fromkeys(values) if isinstance(v, str) and v not in categories]
+        if len(new_categories) > 0:
+            self._tests[column] = self._tests[column].cat.add_categories(new_categories)
+
+    def _concat(self, new_tests):
+        """ Append the rows of a frame to our tests in a single concatenation (keeping the categorical columns categorical).
+        """
+        categorical = [c for c in CATEGORICAL_COLUMNS if c in self._tests.columns and isinstance(self._tests[c].dtype, pd.CategoricalDtype)]
+        for c in categorical:
+            if c in new_tests.columns:
+                self._add_categories(c, pd.unique(new_tests[c]))
+                new_tests = new_tests.assign(**{c: new_tests[c].astype(self._tests[c].dtype)})
+        self._tests = pd.concat([self._tests, new_tests])
+        self._categorize(categorical)
+
+    def _columns_changed(self, columns=None):
+        """ Publish a change that added, removed, or rewrote whole columns.
+        """
+        self._rows_changed(None, columns)
+
     @property
     def name(self):
-        return re.split(r"\/", self._tests_location)[-1] if self._tests_location is not None else "Tests"
+        return re.split(r"\/", self._tests_location.rstrip("/"))[-1] if self._tests_location is not None else "Tests"
 
     def ensure_topic_markers(self):
-        marked_topics = {t: True for t in set(self._tests.loc[self._tests["label"] == "topic_marker"]["topic"])}
-        for topic in set(self._tests["topic"]):
+        """ Add a topic_marker row for every topic (or parent topic) that is missing one.
+        """
+        marked_topics = set(self._tests["topic"][self._tests["label"] == "topic_marker"])
+        missing_topics = {}
+        for topic in self._tests["topic"].unique():
+            if not isinstance(topic, str):
+                continue
             parts = topic.split("/")
             for i in range(1, len(parts)+1):
                 parent_topic = "/".join(parts[:i])
                 if parent_topic not in marked_topics:
-                    self._tests.loc[uuid.uuid4().hex] = {
-                        "label": "topic_marker",
-                        "topic": parent_topic,
-                        "labeler": "imputed",
-                        "input": "",
-                        "output": "",
-                        "description": ""
-                    }
-                    marked_topics[parent_topic] = True
+                    missing_topics[parent_topic] = True
+
+        # add all the missing markers in a single concatenation
+        if len(missing_topics) > 0:
+            markers = pd.DataFrame({
+                "topic": list(missing_topics),
+                "input": "",
+                "output": "",
+                "label": "topic_marker",
+                "labeler": "imputed",
+                "description": ""
+            }, index=[uuid.uuid4().hex for _ in range(len(missing_topics))])
+            self._concat(markers)
+            self._rows_changed(list(markers.index))
 
     def __getitem__(self, key):
         """ TestSets act just like a DataFrame when sliced. """
@@ -195,6 +407,8 @@ class TestTree():
     def __setitem__(self, key, value):
         """ TestSets act just like a DataFrame when sliced, including assignment. """
         self._tests[key] = value
+        self._categorize()
+        self._columns_changed(list(key) if pd.api.types.is_list_like(key) else [key])
 
     # all these methods directly expose the underlying DataFrame API
     @property
@@ -221,12 +435,25 @@ class TestTree():
     @property
     def groupby(self):
         return self._tests.groupby
-    @property
-    def drop(self):
-        return self._tests.drop
-    @property
-    def insert(self):
-        return self._tests.insert
+    def drop(self, labels=None, axis=0, index=None, columns=None, inplace=False, **kwargs):
+        """ Drop rows or columns just like DataFrame.drop (while keeping our indexes in sync).
+        """
+        out = self._tests.drop(labels=labels, axis=axis, index=index, columns=columns, inplace=inplace, **kwargs)
+        if inplace:
+            if index is None and axis in [0, "index"]:
+                index = labels
+            if index is not None:
+                self._rows_changed(list(index) if pd.api.types.is_list_like(index) else [index])
+            if columns is not None or axis in [1, "columns"]:
+                if columns is None:
+                    columns = labels
+                self._columns_changed(list(columns) if pd.api.types.is_list_like(columns) else [columns])
+        return out
+    def insert(self, *args, **kwargs):
+        """ Insert a column just like DataFrame.insert.
+        """
+        self._tests.insert(*args, **kwargs)
+        self._columns_changed([kwargs["column"] if "column" in kwargs else args[1]])
     @property
     def copy(self):
         return self._tests.copy
@@ -237,30 +464,166 @@ class TestTree():
     # NOTE: Can't delegate to df.append as it is deprecated in favor of pd.concat, which we can't use due to type checks 
     def append(self, test_tree, axis=0):
         if isinstance(test_tree, pd.DataFrame):
-            self._tests = pd.concat([self._tests, test_tree], axis=axis)
+            new_tests = test_tree
         elif isinstance(test_tree, TestTree):
-            self._tests = pd.concat([self._tests, test_tree._tests], axis=axis)
+            new_tests = test_tree._tests
         elif isinstance(test_tree, dict):
             # check if the values are strings or lists of strings
             if any([isinstance(v, str) for v in test_tree.values()]):
-                self._tests = pd.concat([self._tests, pd.DataFrame({k: [test_tree[k]] for k in test_tree}, index=[uuid.uuid4().hex])], axis=axis)
+                new_tests = pd.DataFrame({k: [test_tree[k]] for k in test_tree}, index=[uuid.uuid4().hex])
             else:
-                self._tests = pd.concat([self._tests, pd.DataFrame(test_tree)], axis=axis)
+                new_tests = pd.DataFrame(test_tree)
+        else:
+            return None
+        if axis in [0, "index"]:
+            self._concat(new_tests)
+            self._rows_changed(list(new_tests.index))
+        else:
+            self._tests = pd.concat([self._tests, new_tests], axis=axis)
+            self._columns_changed(list(new_tests.columns) if hasattr(new_tests, "columns") else None)
 
         #self.deduplicate()
         #self.compute_embeddings()
         return None # TODO: Rethink append logic -- return copy vs. in place update?
 
+    def extend(self, rows, index=None):
+        """ Add many new rows to the test tree with a single concatenation.
+
+        This is much faster than adding rows one cell at a time with `loc`, since every enlargement of the
+        underlying DataFrame copies the whole frame.
+
+        Parameters
+        ----------
+        rows : list[dict] or dict[str, list] or DataFrame
+            The new rows, either as a list of row dicts or as a dict of column arrays. Missing topic, input, output,
+            label, labeler or description values are filled in with the usual defaults.
+
+        index : list[str] or None
+            The ids of the new rows (new random ids are used when not given).
+
+        Returns
+        -------
+        list[str]
+            The ids of the new rows.
+        """
+        new_tests = pd.DataFrame(rows)
+        if len(new_tests) == 0:
+            return []
+        if index is None:
+            index = new_tests.index if isinstance(rows, pd.DataFrame) else [uuid.uuid4().hex for _ in range(len(new_tests))]
+        new_tests.index = index
+        for c, default in [("topic", ""), ("input", ""), ("output", ""), ("label", ""), ("labeler", "imputed"), ("description", "")]:
+            if c not in new_tests.columns:
+                new_tests[c] = default
+        self._concat(new_tests)
+        self._rows_changed(list(new_tests.index))
+        return list(new_tests.index)
+
     def __len__(self):
         return self._tests.__len__()
-    def __setitem__(self, key, value):
-        return self._tests.__setitem__(key, value)
     def to_csv(self, file=None):
-        no_suggestions = self._tests.loc[["/__suggestions__" not in topic for topic in self._tests["topic"]]]
+        if file is not None:
+            self.load_topic("") # an export has to include the shards we have not read yet
+        no_suggestions = saveable_tests(self._tests)
         if file is None:
-            no_suggestions.to_csv(self._tests_location)
+            if is_columnar_path(self._tests_location) or is_sqlite_path(self._tests_location):
+                raise Exception("This test tree is not stored as a CSV file, so use save() to write it back to its location!")
+            if self._store is not None:
+                self._store.compact(self._tests, background=False)
+            else:
+                no_suggestions.to_csv(self._tests_location)
+                self._retire_journal(self._tests_location)
+            self._unsaved_changes.pop()
         else:
             no_suggestions.to_csv(file)
+            self._retire_journal(file)
+
+    def _retire_journal(self, path):
+        """ Remove any journal left next to a file we just rewrote in full (so it is never replayed over newer rows).
+        """
+        if isinstance(path, str) and not (isinstance(self._store, TestTreeJournal) and self._store.location == path):
+            remove_journal(path)
+
+    def to_parquet(self, file=None):
+        """ Save the test tree as a Parquet file (with typed score columns and dictionary encoded metadata columns).
+        """
+        self.load_topic("")
+        file = self._tests_location if file is None else file
+        write_columnar(saveable_tests(self._tests), file, format="parquet")
+        self._retire_journal(file)
+
+    def to_feather(self, file=None):
+        """ Save the test tree as an Arrow IPC (Feather) file (with typed score columns and dictionary encoded metadata columns).
+        """
+        self.load_topic("")
+        file = self._tests_location if file is None else file
+        write_columnar(saveable_tests(self._tests), file, format="feather")
+        self._retire_journal(file)
+
+    @classmethod
+    def from_parquet(cls, file, memory_map=False, **kwargs):
+        """ Load a test tree from a Parquet file.
+        """
+        if not file.lower().endswith(".parquet"):
+            raise Exception(f"Parquet test tree files must end in .parquet: {file}")
+        return cls(file, memory_map=memory_map, **kwargs)
+
+    @classmethod
+    def from_feather(cls, file, memory_map=True, **kwargs):
+        """ Load a test tree from an Arrow IPC (Feather) file.
+        """
+        if not (file.lower().endswith(".feather") or file.lower().endswith(".arrow")):
+            raise Exception(f"Arrow IPC test tree files must end in .feather or .arrow: {file}")
+        return cls(file, memory_map=memory_map, **kwargs)
+
+    def refresh(self):
+        """ Pull in any rows that other processes have saved to our SQLite database since we last read from it.
+
+        Rows we have unsaved local edits for are left alone (they will overwrite the database version when saved).
+        This is a no-op for test trees that are not stored in a SQLite database.
+        """
+        unsaved_ids = self._unsaved_changes.ids
+        if not isinstance(self._store, SQLiteTestTreeStore) or unsaved_ids is None:
+            return
+        changed, deleted_ids, self._store.version = self._store.changes_since(self._store.version)
+        changed = changed.loc[~changed.index.isin(list(unsaved_ids))]
+
+        # we only pull in rows we would have read by now (the rest are read when their topic is first used)
+        in_scope = changed.index.isin(self._tests.index) | (changed["label"] == "topic_marker").values
+        in_scope |= np.array([self._store.is_loaded(t) for t in changed["topic"]], dtype=bool)
+        changed = changed.loc[in_scope]
+        self._store.mark_read(changed.index)
+        ids = list(changed.index) + [id for id in deleted_ids if id not in unsaved_ids]
+        if len(ids) == 0:
+            return
+        self._tests = self._tests.loc[~self._tests.index.isin(ids)]
+        self._concat(changed)
+        self._rows_changed(ids)
+        self._unsaved_changes.ids.difference_update(ids) # these rows came from the database, so they are already saved
+
+    def save(self):
+        """ Save any unsaved changes back to the location the test tree was loaded from.
+
+        Without a journal this just rewrites the whole file. With a journal (or a SQLite database) we only save the
+        rows that changed since the last save (falling back to a full rewrite when whole columns changed, or when the
+        journal has grown long enough to be worth compacting). The embedding matrix (if any) is flushed as well.
+        """
+        if self._embedding_matrix is not None:
+            self._embedding_matrix.save()
+        if self._store is None:
+            if is_columnar_path(self._tests_location):
+                write_tests(saveable_tests(self._tests), self._tests_location)
+                self._retire_journal(self._tests_location)
+            else:
+                self.to_csv()
+            return
+        unsaved_ids = self._unsaved_changes.pop()
+        if unsaved_ids is None:
+            self._store.compact(self._tests)
+        else:
+            self._store.append(self._tests, unsaved_ids)
+            if self._store.num_entries >= self._store.compact_every:
+                self._store.compact(self._tests)
 
     def topic(self, topic):
         """ Return a subset of the test tree containing only tests that match the given topic.
@@ -270,24 +633,204 @@ class TestTree():
         topic : str
             The topic to filter the test tree by.
         """
-        ids = [id for id, test in self._tests.iterrows() if is_subtopic(topic, test.topic)]
-        return self.loc[ids]
+        self.load_topic(topic)
+        return self.loc[self.topic_ids(topic)]
+
+    def load_topic(self, topic):
+        """ Make sure the tests of a topic are in memory (this only matters for test trees stored as a directory or database).
+
+        Test trees stored as a directory of per top level topic shards only read a shard the first time one of its
+        topics is used, and test trees stored in a SQLite database only read the tests of a topic (and its subtopics)
+        the first time it is used. Loading the root topic "" reads every row. This is a no-op for all other test trees.
+
+        Returns
+        -------
+        list
+            The ids of the rows that were read.
+        """
+        if isinstance(self._store, SQLiteTestTreeStore):
+            if self._store.is_loaded(topic):
+                return []
+            return self._add_stored_rows([self._store.read_topic(topic)])
+        if not isinstance(self._store, ShardedTestTreeStore):
+            return []
+        keys = self._store.shards() if topic == "" else [shard_key(topic)]
+        return self._add_stored_rows([self._store.read(key) for key in keys if key not in self._store.loaded])
+
+    def _add_stored_rows(self, new_tests):
+        """ Add rows read from our storage location to the tests frame (they are already saved).
+        """
+        new_tests = [t.loc[~t.index.isin(self._tests.index)] for t in new_tests] # rows already in memory are newer
+        if self._unsaved_changes.ids:
+            new_tests = [t.loc[~t.index.isin(list(self._unsaved_changes.ids))] for t in new_tests] # and so are our unsaved deletions
+        new_tests = [t for t in new_tests if len(t) > 0]
+        if len(new_tests) == 0:
+            return []
+        new_tests = pd.concat(new_tests)
+        for c in new_tests.columns:
+            if c not in self._tests.columns or not isinstance(self._tests[c].dtype, pd.CategoricalDtype):
+                new_tests[c] = new_tests[c].astype(object)
+        self._concat(new_tests)
+        ids = list(new_tests.index)
+        self._rows_changed(ids)
+        if self._unsaved_changes.ids is not None:
+            self._unsaved_changes.ids.difference_update(ids) # these rows came from disk, so they are already saved
+        return ids
+
+    def to_shards(self, location):
+        """ Save the test tree as a directory with one CSV file per top level topic (see the `tests` argument of the constructor).
+        """
+        self.load_topic("")
+        store = ShardedTestTreeStore(location)
+        store.loaded = set(store.shards()) # overwrite (or remove) any shards already in the directory
+        store.compact(self._tests)
+
+    def topic_ids(self, topic, subtopics=True):
+        """ Return the ids of the tests in the given topic (in test tree order).
+
+        Parameters
+        ----------
+        topic : str
+            The topic to look up.
+
+        subtopics : bool
+            Whether to also include the tests in all the subtopics of the given topic.
+        """
+        self.load_topic(topic)
+        return self._loaded_topic_ids(topic, subtopics)
+
+    def _loaded_topic_ids(self, topic, subtopics=True):
+        """ Like `topic_ids`, but only looks at the rows already in memory (without reading any shards).
+        """
+        if subtopics:
+            ids = self.topic_index.subtree_ids(topic)
+        else:
+            ids = self.topic_index.ids(topic)
+        return self._tests.index[row_positions(self._tests.index, ids)]
 
     def topic_has_direct_tests(self, target_topic: str)-> bool:
         """Check if a topic has direct tests."""
-        hdt_df = self._tests.apply(
-            lambda row: row['topic']==target_topic and row['label'] != 'topic_marker',
-            axis=1
-        )
-        return hdt_df.any()
+        return self.topic_index.has_direct_tests(target_topic)
 
     def topic_has_subtopics(self, target_topic: str) -> bool:
         """Check if a topic has subtopics."""
-        has_subtopics_df = self._tests.apply(
-            lambda row: row['topic']!=target_topic and is_subtopic(target_topic, row["topic"]),
-            axis=1
-        )
-        return has_subtopics_df.any()
+        return self.topic_index.has_subtopics(target_topic)
+
+    # test trees with at least this many rows build a trigram index the first time their text is searched
+    text_index_min_rows = 20000
+
+    def search(self, text):
+        """ Return the ids of the tests whose input or output contains the given text, using a trigram index.
+
+        This returns None when the index doesn't help (the test tree has fewer than `text_index_min_rows` rows, the
+        text is shorter than three bytes, or the text is so common that most rows are candidates), in which case
+        scanning the columns directly is just as fast.
+        """
+        if len(self._tests) < self.text_index_min_rows:
+            return None
+        if self._text_index is None or not self._text_index.valid:
+            if self._text_index is not None:
+                self.unsubscribe(self._text_index)
+            self._text_index = self.subscribe(TextIndex(self))
+        return self._text_index.search(text)
+
+    def query(self, text=None, regex=None, topic=None, subtopics=True, labels=None, score_column=None, min_score=None, max_score=None,
+              suggestions=True):
+        """ Find the tests that match a set of conditions.
+
+        All the conditions are evaluated as vectorized masks over whole columns, and the result is cached until
+        the test tree changes (so repeated queries while browsing are free).
+
+        Parameters
+        ----------
+        text : str or None
+            Only match tests whose input or output contains this text.
+
+        regex : str or None
+            Only match tests whose input or output (or test_type if present) matches this regular expression.
+
+        topic : str or None
+            Only match tests in this topic.
+
+        subtopics : bool
+            Whether a topic condition also matches the tests in its subtopics.
+
+        labels : list[str] or None
+            Only match tests with one of these labels.
+
+        score_column : str or None
+            The score column that `min_score` and `max_score` apply to (the max is used for multi-part scores).
+
+        min_score : float or None
+            Only match tests with at least this score.
+
+        max_score : float or None
+            Only match tests with at most this score.
+
+        suggestions : bool
+            Whether to match pending suggestions.
+
+        Returns
+        -------
+        pandas.Series
+            A boolean mask over the tests (indexed by test id).
+        """
+        if isinstance(self._store, SQLiteTestTreeStore) and not self._store.is_loaded("" if topic is None else topic) and \
+                (topic is not None or labels is not None or (text is not None and text != "")):
+            # read just the rows that could match with an indexed query, and then run the query on the tests frame
+            self._add_stored_rows([self._store.read_matching(topic, subtopics, labels, text if text != "" else None)])
+        else:
+            self.load_topic("" if topic is None else topic)
+        return self._loaded_query(text, regex, topic, subtopics, labels, score_column, min_score, max_score, suggestions)
+
+    def _loaded_query(self, text=None, regex=None, topic=None, subtopics=True, labels=None, score_column=None, min_score=None,
+                      max_score=None, suggestions=True):
+        """ Like `query`, but only over the tests that are already in memory (this never reads from the store).
+        """
+        key = (text, regex, topic, subtopics, tuple(labels) if labels is not None else None, score_column, min_score, max_score, suggestions)
+        if self._query_cache_version != self._version:
+            self._query_cache = {}
+            self._query_cache_version = self._version
+        mask = self._query_cache.get(key, None)
+        if mask is not None:
+            return mask
+
+        tests = self._tests
+        mask = np.ones(len(tests), dtype=bool)
+        if text is not None and text != "":
+            ids = self.search(text)
+            if ids is None:
+                mask &= (tests["input"].str.contains(text, regex=False, na=False) | tests["output"].str.contains(text, regex=False, na=False)).values
+            else:
+                matches = np.zeros(len(tests), dtype=bool)
+                matches[row_positions(tests.index, ids)] = True
+                mask &= matches
+        if regex is not None and regex != "":
+            pattern = re.compile(regex)
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", "This pattern is interpreted as a regular expression", UserWarning) # we only need matches, not groups
+                matches = tests["input"].str.contains(pattern, na=False) | tests["output"].str.contains(pattern, na=False)
+                if "test_type" in tests.columns:
+                    matches |= tests["test_type"].str.contains(pattern, na=False)
+            mask &= matches.values
+        if topic is not None:
+            mask &= tests.index.isin(self._loaded_topic_ids(topic, subtopics=subtopics))
+        if labels is not None:
+            mask &= tests["label"].isin(labels).values
+        if min_score is not None or max_score is not None:
+            scores = _max_scores(tests[score_column])
+            if min_score is not None:
+                mask &= scores >= min_score
+            if max_score is not None:
+                mask &= scores <= max_score
+        if not suggestions:
+            mask &= ~tests["topic"].str.contains("/__suggestions__", regex=False, na=False).values
+
+        mask = pd.Series(mask, index=tests.index)
+        if len(self._query_cache) >= 32:
+            self._query_cache.pop(next(iter(self._query_cache)))
+        self._query_cache[key] = mask
+        return mask
 
     def adapt(self, scorer=None, generator=adatest.generators.OpenAI(), auto_save=False, user="anonymous", recompute_scores=False, drop_inactive_score_columns=False,
               max_suggestions=100, suggestion_thread_budget=0.5, prompt_builder=PromptBuilder(), active_generator="default", starting_path="",
@@ -308,7 +851,8 @@ class TestTree():
             A source to generate new tests from. Currently supported generator types are language models, existing test trees, or datasets.
 
         auto_save : bool
-            Whether to automatically save the test tree after each edit.
+            Whether to automatically save the test tree after each edit (see the `journal` option of TestTree to
+            save just the edited rows).
 
         user : str
             The user name to author new tests with.
@@ -365,32 +909,100 @@ class TestTree():
     def _repr_html_(self):
         return self._tests._repr_html_()
 
-    def deduplicate(self):
+    def deduplicate(self, incremental=False):
         """ Remove duplicate tests from the test tree.
         
-        Note that we give precendence to the first test in a set of duplicates.
+        Note that we give precendence to the first test in a set of duplicates. Tests are compared by hashing their
+        (topic, input, output) values, and suggestions are also removed when they duplicate a test in their parent topic.
+
+        Parameters
+        ----------
+        incremental : bool
+            Only check the rows added or edited since the last incremental call against the hashes of the rows we
+            already checked (which we keep up to date). This makes deduplicating a small batch of new suggestions
+            independent of the size of the test tree.
+        """
+        # duplicates always share a topic (and so a shard), so incremental passes only need the shards we have read
+        # (the rows of shards we read later are checked as changed rows by the next incremental pass)
+        if not incremental and len(self.load_topic("")) > 0:
+            self._dedup_changes.pop() # the full pass below also checks the rows we just read
+        changed_ids = self._dedup_changes.pop()
+        if incremental and self._dedup_owners is not None and changed_ids is not None:
+            drop_ids = self._deduplicate_changed_rows(changed_ids)
+        else:
+            drop_ids = self._deduplicate_all_rows(build_index=incremental or self._dedup_owners is not None)
+        if len(drop_ids) > 0:
+            self.drop(drop_ids, axis=0, inplace=True)
+            self._dedup_changes.pop() # the rows we just dropped were never added to the hash index
+
+    def _deduplicate_all_rows(self, build_index):
+        """ Find the ids of all the duplicate rows with a single vectorized pass over the tests.
+        """
+        tests = self._tests
+        keys = _test_hashes(tests["topic"], tests["input"], tests["output"])
+        duplicate = pd.Series(keys).duplicated().to_numpy(copy=True)
+
+        # see if any suggestions are duplicates of things already in their topic
+        is_suggestion = tests["topic"].str.endswith("/__suggestions__", na=False).values
+        if is_suggestion.any():
+            suggestions = tests.loc[is_suggestion]
+            parent_keys = _test_hashes(suggestions["topic"].str.slice(stop=-len("/__suggestions__")), suggestions["input"], suggestions["output"])
+            duplicate[is_suggestion] |= np.isin(parent_keys, keys)
+
+        if build_index:
+            self._dedup_owners = dict(zip(keys[~duplicate], tests.index[~duplicate]))
+            self._dedup_keys = dict(zip(tests.index[~duplicate], keys[~duplicate]))
+        return list(tests.index[duplicate])
+
+    def _deduplicate_changed_rows(self, changed_ids):
+        """ Find the ids of the duplicate rows by only checking the given changed rows against the rows we already checked.
         """
+        # forget the old hashes of the changed rows
+        for id in changed_ids:
+            key = self._dedup_keys.pop(id, None)
+            if key is not None and self._dedup_owners.get(key) == id:
+                del self._dedup_owners[key]
+
+        rows = self._tests.loc[self._tests.index.isin(list(changed_ids))]
+        topics = rows["topic"].astype(object).fillna("")
+        is_suggestion = topics.str.endswith("/__suggestions__").values
+        keys = _test_hashes(topics, rows["input"], rows["output"])
+        parent_keys = _test_hashes(topics.str.slice(stop=-len("/__suggestions__")), rows["input"], rows["output"])
+        suggestion_keys = _test_hashes(topics + "/__suggestions__", rows["input"], rows["output"])
 
-        already_seen = {}
         drop_ids = []
-
-        # catch duplicate tests in the same topic
-        for id, test in self._tests.iterrows():
-            k = test.topic + "|_ADA_JOIN_|" + test.input + "|_ADA_JOIN_|" + test.output
-            if k in already_seen:
+        for id, key, suggestion, parent_key, suggestion_key in zip(rows.index, keys, is_suggestion, parent_keys, suggestion_keys):
+            if key in self._dedup_owners or (suggestion and parent_key in self._dedup_owners):
                 drop_ids.append(id)
-            else:
-                already_seen[k] = True
-
-        # see if any suggestions are duplicates of things already in the their topic
-        # (note we do this as a second loop so we know we have already marked all the
-        # members of the topic in already_seen)
-        for id, test in self._tests.iterrows():
-            if test.topic.endswith("/__suggestions__"):
-                k = test.topic[:-len("/__suggestions__")] + "|_ADA_JOIN_|" + test.input + "|_ADA_JOIN_|" + test.output
-                if k in already_seen:
-                    drop_ids.append(id)
-        self._tests.drop(drop_ids, axis=0, inplace=True)
+                continue
+            self._dedup_owners[key] = id
+            self._dedup_keys[id] = key
+
+            # a new test also replaces any matching suggestion in its topic
+            if not suggestion and suggestion_key in self._dedup_owners:
+                suggestion_id = self._dedup_owners.pop(suggestion_key)
+                del self._dedup_keys[suggestion_id]
+                drop_ids.append(suggestion_id)
+        return drop_ids
+
+    def embeddings(self, ids=None, column=None):
+        """ The embeddings of the given tests as a float32 matrix (one row per id, in order).
+
+        The embeddings are kept in a matrix owned by the test tree (which `save` writes next to the test tree file
+        when it was loaded from a path) that is kept in sync with edits, so this is a single gather for tests that
+        were already embedded.
+
+        Parameters
+        ----------
+        ids : list-like or None
+            The ids of the tests to embed (None means every test, in test tree order).
+
+        column : "input" or "output" or None
+            Which embedding to return for each test (None means the input and output embeddings side by side).
+        """
+        if self._embedding_matrix is None:
+            self._embedding_matrix = self.subscribe(EmbeddingMatrix(self, self._embeddings_path))
+        return self._embedding_matrix.get(self._tests.index if ids is None else ids, column)
 
     def _cache_embeddings(self, ids=None):
         """ Pre-compute the embeddings for the given test cases.
@@ -400,39 +1012,43 @@ class TestTree():
 
         if ids is None:
             ids = self._tests.index
+        tests = self._tests.loc[ids]
+        is_marker = (tests["label"] == "topic_marker").values
 
-        # see what new embeddings we need to compute
-        all_strings = []
-        for id in ids:
-            test = self._tests.loc[id]
-            if test.label == "topic_marker":
-                parts = test.topic.rsplit("/", 1)
-                str = parts[1] if len(parts) == 2 else ""
-                all_strings.append(str)
-            else:
-                for str in [test.input, test.output]:
-                    all_strings.append(str)
+        # tests are embedded into our embedding matrix
+        self.embeddings(tests.index[~is_marker])
 
-        # suggestions topics don't have topic markers so we check for them separately
-        # all_strings.append("__suggestions__")
-        
-        # we don't use the output of the embedding, just do this to get the embeddings cached
-        adatest.embed(all_strings)
+        # topic markers are embedded by the name of their topic (we don't use the output of the embedding, just do
+        # this to get the embeddings cached)
+        topic_names = []
+        for topic in tests["topic"][is_marker]:
+            parts = topic.rsplit("/", 1)
+            topic_names.append(parts[1] if len(parts) == 2 else "")
+        if len(topic_names) > 0:
+            adatest.embed(topic_names)
 
     def impute_labels(self):
         """ Impute missing labels in the test tree. """
         # TODO: this is just a random mock, it needs to implement real local topic models
 
-        ids_to_impute = self._tests.index[self._tests["label"] == ""]
+        # only look at the rows whose labels changed since we last ran
+        changed_ids = self._impute_changes.pop()
+        if changed_ids is None:
+            ids_to_impute = self._tests.index[self._tests["label"] == ""]
+        else:
+            changed = self._tests.iloc[row_positions(self._tests.index, changed_ids)]
+            ids_to_impute = changed.index[changed["label"] == ""]
+        if len(ids_to_impute) == 0:
+            return
         self._cache_embeddings(ids_to_impute)
         for id in ids_to_impute:
             test = self._tests.loc[id]
             if test.label == "":
                 if self.topic_membership_model(test.topic)(test.input) == "off_topic":
-                    self._tests.loc[id, "label"] = "off_topic"
+                    self.loc[id, "label"] = "off_topic"
                 else:
-                    self._tests.loc[id, "label"] = "pass" if self.topic_labeling_model(test.topic)(test.input, test.output) < 0.5 else "fail"
-                self._tests.loc[id, "labeler"] = "imputed"
+                    self.loc[id, "label"] = "pass" if self.topic_labeling_model(test.topic)(test.input, test.output) < 0.5 else "fail"
+                self.loc[id, "labeler"] = "imputed"
 
     # def predict_labels(self, topical_io_pairs):
     #     """ Return the label probabilities for a set of input-output pairs. [NOT USED RIGHT NOW]
@@ -475,24 +1091,99 @@ class TestTree():
     def topic_labeling_model(self, topic):
         topic = topic.replace("/__suggestions__", "") # predict suggestions using their parent topic label model
         if topic not in self._topic_labeling_models:
-            self._topic_labeling_models[topic] = self.labeling_model(topic, self)
+            self._train_topic_model("labeling", topic)
         return self._topic_labeling_models[topic]
 
     def topic_membership_model(self, topic):
         topic = topic.replace("/__suggestions__", "") # predict suggestions using their parent topic membership model
         if topic not in self._topic_membership_models:
-            self._topic_membership_models[topic] = self.membership_model(topic, self)
+            self._train_topic_model("membership", topic)
         return self._topic_membership_models[topic]
 
     def retrain_topic_labeling_model(self, topic):
-        self._topic_labeling_models[topic] = self.labeling_model(topic, self)
+        """ Retrain the labeling model for a topic (unless none of its training data changed since it was last trained).
+        """
+        if self._topic_model_needs_training("labeling", topic):
+            self._train_topic_model("labeling", topic)
 
     def retrain_topic_membership_model(self, topic):
-        self._topic_membership_models[topic] = self.membership_model(topic, self)
+        """ Retrain the membership model for a topic (unless none of its training data changed since it was last trained).
+        """
+        if self._topic_model_needs_training("membership", topic):
+            self._train_topic_model("membership", topic)
+
+    def _topic_model_needs_training(self, kind, topic):
+        models = self._topic_labeling_models if kind == "labeling" else self._topic_membership_models
+        return topic not in models or self._topic_model_is_stale(kind, topic)
+
+    def _train_topic_model(self, kind, topic, cancelled=None):
+        """ Train a topic model, and use it unless the given cancellation event was set while we trained it.
+
+        The browser prefetcher trains models in a background thread, so we also never replace a model that was
+        trained on a newer version of the test tree in the meantime.
+        """
+        if self._topic_changes is None:
+            self._topic_changes = self.subscribe(TopicChanges(self))
+        version = self._version
+        if kind == "labeling":
+            model = self.labeling_model(topic, self)
+        else:
+            model = self.membership_model(topic, self)
+        if cancelled is not None and cancelled.is_set():
+            return
+        if self._topic_model_versions.get((kind, topic), -1) > version:
+            return
+        self._topic_model_versions[(kind, topic)] = version
+        if kind == "labeling":
+            self._topic_labeling_models[topic] = model
+        else:
+            self._topic_membership_models[topic] = model
+
+    def _topic_model_is_stale(self, kind, topic):
+        version = self._topic_model_versions.get((kind, topic), None)
+        return version is None or self._topic_changes.changed_since(topic, version)
 
-    def drop_topic(self, topic):
-        """ Remove a topic from the test tree. """
-        self._tests = self._tests.loc[self._tests["topic"] != topic]
+    def drop_topic(self, topic, subtopics=False):
+        """ Remove a topic (and optionally all of its subtopics) from the test tree.
+
+        The rows are found with the topic index and removed with a single positional mask, so the cost does not
+        depend on looking up ids in the (possibly just rebuilt) index of the whole tree.
+        """
+        self.load_topic(topic)
+        ids = self.topic_index.subtree_ids(topic) if subtopics else self.topic_index.ids(topic)
+        positions = row_positions(self._tests.index, ids)
+        if len(positions) == 0:
+            return
+        ids = self._tests.index[positions]
+        keep = np.ones(len(self._tests), dtype=bool)
+        keep[positions] = False
+        self._tests = self._tests[keep]
+        self._rows_changed(list(ids))
+
+    def move_topic(self, topic, new_topic):
+        """ Move a topic and all of its subtopics under a new name (this is also how topics are renamed).
+
+        The topic prefix of every row in the subtree is rewritten in a single vectorized assignment.
+
+        Parameters
+        ----------
+        topic : str
+            The topic to move.
+
+        new_topic : str
+            The new name of the topic (its subtopics keep their names relative to it).
+
+        Returns
+        -------
+        pandas.Index
+            The ids of the rows that were moved.
+        """
+        ids = self.topic_ids(topic)
+        self.load_topic(new_topic) # so the moved rows don't shadow rows of the destination we have not read yet
+        if len(ids) > 0 and new_topic != topic:
+            old_topics = self._tests.loc[ids, "topic"].astype(object)
+            self.loc[ids, "topic"] = (new_topic + old_topics.str[len(topic):]).values
+        return ids
 
 class TestTreeLocIndexer():
     def __init__(self, test_tree):
@@ -507,14 +1198,23 @@ class TestTreeLocIndexer():
         
         subset = self.test_tree._tests.loc[key]
         if hasattr(subset, 'columns') and len(set(["topic", "input", "output", "label"]) - set(subset.columns)) == 0:
-            test_tree_slice = TestTree(subset, index=subset.index, ensure_topic_markers=False)
-            test_tree_slice._tests_location = self.test_tree._tests_location
-            return test_tree_slice
+            return self.test_tree._from_slice(subset, self.test_tree)
         else:
             return subset
     
     def __setitem__(self, key, value):
-        self.test_tree._tests.loc[key] = value
+        _add_assigned_categories(self.test_tree, key[1] if isinstance(key, tuple) else None, value)
+        try:
+            self.test_tree._tests.loc[key] = value
+        except TypeError:
+            # typed columns (like float scores loaded from a Parquet file) become object columns once they need to hold other values
+            columns = key[1] if isinstance(key, tuple) else self.test_tree._tests.columns
+            for c in ([columns] if isinstance(columns, str) else columns):
+                if c in self.test_tree._tests.columns and self.test_tree._tests[c].dtype != object:
+                    self.test_tree._tests[c] = self.test_tree._tests[c].astype(object)
+            self.test_tree._tests.loc[key] = value
+        self.test_tree._categorize() # adding new rows turns categorical columns back into object columns
+        self.test_tree._rows_changed(_loc_row_ids(self.test_tree._tests, key), _key_columns(key))
     
 class TestTreeILocIndexer():
     def __init__(self, test_tree):
@@ -529,14 +1229,91 @@ class TestTreeILocIndexer():
         
         subset = self.test_tree._tests.iloc[key]
         if hasattr(subset, 'columns') and len(set(["topic", "input", "output", "label"]) - set(subset.columns)) == 0:
-            test_tree_slice = TestTree(subset, ensure_topic_markers=False)
-            test_tree_slice._tests_location = self.test_tree._tests_location
-            return test_tree_slice
+            return self.test_tree._from_slice(subset, self.test_tree)
         else:
             return subset
     
     def __setitem__(self, key, value):
+        columns = self.test_tree._tests.columns[key[1]] if isinstance(key, tuple) else None
+        _add_assigned_categories(self.test_tree, columns, value)
         self.test_tree._tests.iloc[key] = value
+        self.test_tree._categorize()
+        row_key = key[0] if isinstance(key, tuple) else key
+        self.test_tree._rows_changed(
+            list(self.test_tree._tests.index[[row_key] if np.isscalar(row_key) else row_key]),
+            None if columns is None else ([columns] if isinstance(columns, str) else list(columns))
+        )
+
+def _max_scores(scores):
+    """ The numeric value of each score (the max part for "|" separated multi-part scores, and NaN for missing scores).
+    """
+    values = pd.to_numeric(scores.astype(object), errors="coerce").values.astype(float)
+    for i, v in enumerate(scores.values):
+        if isinstance(v, str) and "|" in v:
+            values[i] = np.nanmax(pd.to_numeric(pd.Series(v.split("|")), errors="coerce").values.astype(float))
+    return values
+
+def _test_hashes(topics, inputs, outputs):
+    """ Vectorized 64 bit hashes of (topic, input, output) triples.
+    """
+    out = np.zeros(len(topics), dtype=np.uint64)
+    for values in [topics, inputs, outputs]:
+        out = (out * np.uint64(1000003)) ^ pd.util.hash_array(np.asarray(values, dtype=object))
+    return out
+
+def _add_assigned_categories(test_tree, columns, value):
+    """ Add any new values about to be assigned to the categorical columns of a test tree to their categories.
+
+    `columns` is the column part of the indexing key (None when whole rows are assigned). Assignments we can't
+    cheaply inspect are left alone and fall back to re-categorizing the columns after the assignment.
+    """
+    if columns is None:
+        if isinstance(value, dict):
+            columns, values = list(value.keys()), list(value.values())
+        elif isinstance(value, pd.Series):
+            columns, values = list(value.index), list(value.values)
+        else:
+            return
+    elif isinstance(columns, str):
+        columns, values = [columns], [value]
+    else:
+        columns = list(columns)
+        if isinstance(value, str) or not pd.api.types.is_list_like(value):
+            values = [value] * len(columns)
+        elif len(columns) == 1:
+            values = [value]
+        else:
+            return
+    for c, v in zip(columns, values):
+        if c in CATEGORICAL_COLUMNS:
+            test_tree._add_categories(c, [v] if isinstance(v, str) or not pd.api.types.is_list_like(v) else list(v))
+
+def _key_columns(key):
+    """ The columns selected by a DataFrame.loc key, or None if it selects whole rows (or we can't cheaply tell).
+    """
+    if not isinstance(key, tuple) or len(key) != 2:
+        return None
+    columns = key[1]
+    if isinstance(columns, str):
+        return [columns]
+    elif pd.api.types.is_list_like(columns) and all(isinstance(c, str) for c in columns):
+        return list(columns)
+    return None
+
+def _loc_row_ids(tests, key):
+    """ The row ids selected by a DataFrame.loc key, or None if we can't cheaply tell.
+    """
+    row_key = key[0] if isinstance(key, tuple) else key
+    if isinstance(row_key, pd.Series) and row_key.dtype == bool:
+        return list(row_key.index[row_key.values])
+    elif pd.api.types.is_list_like(row_key):
+        mask = np.asarray(row_key)
+        if mask.dtype == bool:
+            return list(tests.index[mask])
+        return list(row_key)
+    elif isinstance(row_key, slice) or callable(row_key):
+        return None
+    return [row_key]
 
 def _test_tree_from_dataset(X, y, model=None, time_budget=60, min_samples=100):
     column_names = ['topic', 'type' , 'value1', 'value2', 'value3', 'author', 'description', \
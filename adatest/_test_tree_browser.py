@@ -16,6 +16,8 @@ import logging
 import statistics
 from threading import Timer
 from ._scorer import expand_template, clean_template, Scorer
+from ._change_feed import ChangedRows, row_positions
+from ._prefetcher import Prefetcher
 import adatest # Need to import like this to prevent circular dependencies
 import urllib.parse
 from .utils import is_subtopic
@@ -87,6 +89,8 @@ class TestTreeBrowser():
     """ Used for browsing and expanding a test tree.
     """
 
+    prefetch = False # warm the embeddings and topic models around the current topic in the background after a topic change (off by default since embedding the tests of the neighboring topics can cost embedding API calls)
+
     def __init__(self, test_tree, scorer, generators, user, auto_save, recompute_scores, drop_inactive_score_columns,
                  max_suggestions, suggestion_thread_budget, prompt_builder, active_generator, starting_path,
                  score_filter, topic_model_scale):
@@ -106,7 +110,6 @@ class TestTreeBrowser():
         self.suggestion_thread_budget = suggestion_thread_budget
         self.prompt_builder = prompt_builder
         self.active_generator = active_generator
-        self.current_topic = starting_path
         self.score_filter = score_filter
         self.topic_model_scale = topic_model_scale
         self.filter_text = ""
@@ -166,12 +169,17 @@ class TestTreeBrowser():
             if c not in self.test_tree.columns:
                 self.test_tree[c] = [np.nan if label == "topic_marker" else "__TOEVAL__" for label in self.test_tree["label"]]
 
+        # track which rows may need to be (re)scored, so we don't rescan the whole test tree after every edit
+        self._score_changes = self.test_tree.subscribe(ChangedRows(columns=self.score_columns + ["output", "label"]))
+
         # a unique identifier for this test set instance, used for UI connections
         self._id = uuid.uuid4().hex
 
         # these are all temporary state
         self._hidden_topics = {}
         self.comm = None
+        self._prefetcher = Prefetcher(self.test_tree)
+        self._set_topic(starting_path)
 
         # define our current mode, and set of supported modes
         self.mode = "tests" if self.test_tree.shape[0] > 0 else "topics"
@@ -290,8 +298,12 @@ class TestTreeBrowser():
             return
         event_id = msg["event_id"]
 
+        # the prefetcher only runs while we are idle (cancelling just asks it to stop, so this never blocks the event)
+        self._prefetcher.cancel()
+
         # redraw the entire interface
         if event_id == "redraw":
+            self.test_tree.refresh() # pull in edits other users saved to a shared test tree
             self._refresh_interface()
 
         # generate a new set of suggested tests/topics
@@ -326,7 +338,9 @@ class TestTreeBrowser():
             
         # change the current topic
         elif event_id == "change_topic":
-            self.current_topic = msg["topic"]
+            self.test_tree.refresh()
+            if self._set_topic(msg["topic"]):
+                self._compute_embeddings_and_scores(self.test_tree)
             # self.suggestions = pd.DataFrame([], columns=self.test_tree.columns)
 
             # see if we have only topics are direct children, if so, we suggest topics, otherwise we suggest tests
@@ -338,6 +352,10 @@ class TestTreeBrowser():
                 self.mode = "tests"
 
             self._refresh_interface()
+
+            # warm the caches the next suggestion request (here or in a neighboring topic) will need
+            if self.prefetch:
+                self._prefetcher.start(self.current_topic)
             
         # clear the current set of suggestions
         elif event_id == "clear_suggestions":
@@ -425,15 +443,14 @@ class TestTreeBrowser():
             log.debug("move_test")
             test_ids = msg["test_ids"]
             # test_id can either be a unique test ID or a topic name
+            row_ids = [test_id for test_id in test_ids if test_id in self.test_tree.index]
+            if len(row_ids) > 0:
+                self.test_tree.loc[row_ids, "topic"] = msg["topic"]
+                self.test_tree.loc[row_ids, "author"] = self.user
             for test_id in test_ids:
-                if test_id in self.test_tree.index:
-                    self.test_tree.loc[test_id, "topic"] = msg["topic"]
-                    self.test_tree.loc[test_id, "author"] = self.user
                 if '/' in test_id:
-                    for id, test in self.test_tree.iterrows():
-                        if is_subtopic(test_id, test.topic):
-                            self.test_tree.loc[id, "topic"] = msg["topic"] + test.topic[len(test_id):]
-            # Recompute any missing embeddings to handle any changes
+                    self.test_tree.move_topic(test_id, msg["topic"])
+            # Recompute any missing embeddings to handle any changes (only changed rows are rescored, and a move changes no scores)
             self._compute_embeddings_and_scores(self.test_tree)
             self._auto_save()
             self._refresh_interface()
@@ -441,15 +458,12 @@ class TestTreeBrowser():
         elif event_id == "delete_test":
             log.debug("delete_test")
             test_ids = msg["test_ids"]
-            # test_id can either be a unique test ID or a topic name
+            # test_id can either be a unique test ID or a topic name (in which case we delete its whole subtree)
+            drop_ids = [test_id for test_id in test_ids if test_id in self.test_tree.index]
             for test_id in test_ids:
-                if test_id in self.test_tree.index:
-                    self.test_tree.drop(test_id, inplace=True)
                 if '/' in test_id:
-                    # Delete tests from subtopics
-                    for id, test in self.test_tree.iterrows():
-                        if is_subtopic(test_id, test.topic):
-                            self.test_tree.drop(id, inplace=True)
+                    drop_ids.extend(self.test_tree.topic_ids(test_id))
+            self.test_tree.drop(list(dict.fromkeys(drop_ids)), inplace=True)
             self._compute_embeddings_and_scores(self.test_tree)
             self._auto_save()
             self._refresh_interface()
@@ -501,12 +515,14 @@ class TestTreeBrowser():
 
         # get the children of the current topic
         data = {}
+        child_topic_stats = {}
 
         def create_children(data, tests, topic):
             children = []
             
             # add tests and topics to the data lookup structure
-            subtopic_ids = tests.index[tests["topic"].str.match(r"^%s(/|$)" % re.escape(topic))]
+            subtopic_ids = tests._loaded_topic_ids(topic) # the root view only lists the shards we have read
+            visible = tests._loaded_query(text=self.filter_text, topic=topic) if self.filter_text else None # like the listing, only over what we have read
             for k in subtopic_ids:
                 test = tests.loc[k]
                     
@@ -527,7 +543,7 @@ class TestTreeBrowser():
                             children.append(test.topic)
                 
                 # add a test
-                elif matches_filter(test, self.filter_text):
+                elif visible is None or visible[k]:
                     data[k] = {
                         "input": test.input,
                         "output": test.output,
@@ -543,17 +559,25 @@ class TestTreeBrowser():
                     if test.topic == topic:
                         children.append(k)
             
-            # fill in the scores for the child topics
-            for k in subtopic_ids:
-                test = tests.loc[k]
-                if "/__suggestions__" not in test.topic and is_subtopic(topic, test.topic) and test.topic != topic:
-                    child_topic = test.topic[len(topic):].split("/", 2)[1]
-                    scores = data[topic+"/"+child_topic]["scores"]
+            # fill in the scores for the child topics from the maintained per-topic totals (the UI only uses the
+            # number of passing and failing scores and their mean, so folders get just that summary)
+            topic_stats = tests.topic_stats
+            for child_topic in children:
+                if data[child_topic].get("label", "") == "topic_marker" and "/__suggestions__" not in child_topic:
+                    stats = child_topic_stats[child_topic] = topic_stats.subtree(child_topic)
                     for c in self.score_columns:
-                        scores[c].extend([[k, v] for v in ui_score_parts(test[c], test.label)])
+                        s = stats[c]
+                        data[child_topic]["scores"][c] = {
+                            "n_pass": s["n_pass"],
+                            "n_fail": s["n_fail"],
+                            "mean": None if np.isnan(s["mean"]) else float(s["mean"])
+                        }
 
             # sort by score and always put new topics first
             def sort_key(id):
+                if id in child_topic_stats and len(self.score_columns) > 0:
+                    mean = child_topic_stats[id][self.score_columns[0]]["mean"]
+                    return 1e3 if np.isnan(mean) else -mean
                 try:
                     total = 0
                     count = 0
@@ -589,7 +613,12 @@ class TestTreeBrowser():
             if len(children) < 10:
                 score_filter = -1e12
             else:
-                children_scores = sorted([np.max([score_max(x[1]) for x in data[key]['scores'][self.score_columns[0]]]) for key in children])
+                def max_score(id):
+                    if id in child_topic_stats:
+                        max_score = child_topic_stats[id][self.score_columns[0]]["max"]
+                        return -1e3 if np.isnan(max_score) else max_score
+                    return np.max([score_max(x[1]) for x in data[id]['scores'][self.score_columns[0]]])
+                children_scores = sorted([max_score(key) for key in children])
                 suggestions_children_scores = sorted([np.max([score_max(x[1]) for x in data[key]['scores'][self.score_columns[0]]]) for key in suggestions_children])
                 score_filter = children_scores[-5] - (children_scores[-1] - children_scores[-5]) * 0.2
                 if len(suggestions_children_scores) > 0:
@@ -629,17 +658,33 @@ class TestTreeBrowser():
 
         self.comm.send(data)
 
+    def _set_topic(self, topic):
+        """ Make the given topic the current topic.
+
+        Test trees stored as a directory or database read the tests of a topic the first time we visit it, so this
+        reads them and marks the ones without scores for scoring. Returns True if any tests were read (the caller
+        should then compute their scores).
+        """
+        self.current_topic = topic
+        loaded_ids = self.test_tree.load_topic(topic)
+        if len(loaded_ids) == 0:
+            return False
+        loaded = self.test_tree.loc[loaded_ids]
+        for c in self.score_columns:
+            missing = loaded.index[loaded[c].isna() & (loaded["label"] != "topic_marker")]
+            if len(missing) > 0:
+                self.test_tree.loc[missing, c] = "__TOEVAL__"
+        return True
+
     def _clear_suggestions(self):
         """ Clear the suggestions for the current topic.
         """
-        ids = list(self.test_tree.index)
-        for k in ids:
-            if self.test_tree.loc[k, "topic"].startswith(self.current_topic + "/__suggestions__"):
-                self.test_tree.drop(k, inplace=True)
+        self.test_tree.drop_topic(self.current_topic + "/__suggestions__", subtopics=True)
 
     def generate_suggestions(self, topic=None, filter=""):
-        if topic is not None:
-            self.current_topic = topic
+        self._prefetcher.cancel()
+        if topic is not None and self._set_topic(topic):
+            self._compute_embeddings_and_scores(self.test_tree)
         self._clear_suggestions()
         self.test_tree.retrain_topic_labeling_model(self.current_topic)
         self.test_tree.retrain_topic_membership_model(self.current_topic)
@@ -691,7 +736,7 @@ class TestTreeBrowser():
         if curr_topic_mask.sum() == 0:
             desc = ""
         else:
-            desc = self.test_tree.loc[(self.test_tree["topic"] == self.current_topic) & (self.test_tree["label"] == "topic_marker")]["description"][0]
+            desc = self.test_tree.loc[(self.test_tree["topic"] == self.current_topic) & (self.test_tree["label"] == "topic_marker")]["description"].iloc[0]
 
         # generate the suggestions
         generators = [self._active_generator_obj] + list(self.generators.values())
@@ -717,6 +762,7 @@ class TestTreeBrowser():
         else:
             # suggestions = []
             test_map_tmp = copy.copy(test_map)
+            new_rows = []
             for input in proposals:
                 if self.mode == "topics" and ("/" in input or "\n" in input):
                     input = input.replace("/", " or ").replace("\n", " ") # topics can't have newlines or slashes in their names
@@ -725,15 +771,17 @@ class TestTreeBrowser():
                 else:
                     str_val = self.current_topic + " __JOIN__ " + input
                 if str_val not in test_map_tmp:
-                    id = uuid.uuid4().hex
-                    self.test_tree.loc[id, "topic"] = self.current_topic + "/__suggestions__" + ("/"+input if self.mode == "topics" else "")
-                    self.test_tree.loc[id, "input"] = "" if self.mode == "topics" else input
-                    self.test_tree.loc[id, "output"] = "[no output]"
-                    self.test_tree.loc[id, "label"] = "topic_marker" if self.mode == "topics" else ""
-                    self.test_tree.loc[id, "labeler"] = "imputed"
-                    self.test_tree.loc[id, "description"] = ""
+                    row = {
+                        "topic": self.current_topic + "/__suggestions__" + ("/"+input if self.mode == "topics" else ""),
+                        "input": "" if self.mode == "topics" else input,
+                        "output": "[no output]",
+                        "label": "topic_marker" if self.mode == "topics" else "",
+                        "labeler": "imputed",
+                        "description": ""
+                    }
                     for c in self.score_columns:
-                        self.test_tree.loc[id, c] = "__TOEVAL__"
+                        row[c] = "__TOEVAL__"
+                    new_rows.append(row)
 
                     # s = {
                     #     "topic": self.current_topic + "/__suggestions__" + ("/"+input if self.mode == "topics" else ""),
@@ -750,8 +798,11 @@ class TestTreeBrowser():
                         test_map_tmp[str_val] = True
 
             # suggestions = pd.DataFrame(suggestions, index=[uuid.uuid4().hex for _ in range(len(suggestions))], columns=self.test_tree.columns)
+            # add all the new suggestions with a single concatenation
+            self.test_tree.extend(new_rows)
+
             # make sure any duplicates we may have introduced are removed
-            self.test_tree.deduplicate()
+            self.test_tree.deduplicate(incremental=True)
             
             # compute the scores for the new tests
             self._compute_embeddings_and_scores(self.test_tree)
@@ -821,14 +872,20 @@ class TestTreeBrowser():
         # nothing to do if we don't have a scorer
         if self.scorer is None:
             return
+
+        # only rows that changed since we last scored can need scoring
+        changed_ids = self._score_changes.pop() if tests is self.test_tree and not recompute else None
+        if changed_ids is not None:
+            changed_ids = tests.index[row_positions(tests.index, changed_ids)]
         
         for k in self.scorer:
+            candidates = tests if changed_ids is None else tests.loc[changed_ids]
             # determine which rows we need to evaluate
             # eval_ids = []
             # for i, (id, test) in enumerate(tests.iterrows()):
             #     if (recompute or test[k+" score"] == "__TOEVAL__" or test["output"] == "[no output]") and test.label != "topic_marker" and test.label != "off_topic":
             #         eval_ids.append(id)
-            eval_ids = tests.index[((tests[k+" score"] == "__TOEVAL__") | (tests["output"] == "[no output]")) & (tests["label"] != "topic_marker") & (tests["label"] != "off_topic")]
+            eval_ids = candidates.index[((candidates[k+" score"] == "__TOEVAL__") | (candidates["output"] == "[no output]")) & (candidates["label"] != "topic_marker") & (candidates["label"] != "off_topic")]
 
             if len(eval_ids) > 0:
 
@@ -837,26 +894,40 @@ class TestTreeBrowser():
 
                 # update the scores in the test tree
                 current_outputs = tests["output"]
+                mismatched_ids = []
+                updated_ids, updated_outputs, updated_scores = [], [], []
+                new_rows = []
                 for i,id in enumerate(eval_ids):
                     # tests.loc[id, k+" score"] = scores[i]
 
                     if not overwrite_outputs and current_outputs.loc[id] != "[no output]" and current_outputs.loc[id] != new_outputs[i]:
 
                         # mark the current row as nan score (meaning the output does not match)
-                        tests.loc[id, k+" score"] = np.nan
+                        mismatched_ids.append(id)
 
                         # add a new test where the model output does match if we are saving outputs
                         if save_outputs:
-                            id_new = uuid.uuid4().hex
-                            tests.loc[id_new, "topic"] = tests.loc[id, "topic"]
-                            tests.loc[id_new, "input"] = tests.loc[id, "input"]
-                            tests.loc[id_new, "output"] = new_outputs[i]
-                            tests.loc[id_new, "labeler"] = "imputed"
-                            tests.loc[id_new, "label"] = ""
-                            tests.loc[id_new, k+" score"] = scores[i]
+                            new_rows.append({
+                                "topic": tests.loc[id, "topic"],
+                                "input": tests.loc[id, "input"],
+                                "output": new_outputs[i],
+                                "labeler": "imputed",
+                                "label": "",
+                                k+" score": scores[i]
+                            })
                     else:
-                        tests.loc[id, "output"] = new_outputs[i]
-                        tests.loc[id, k+" score"] = scores[i]
+                        updated_ids.append(id)
+                        updated_outputs.append(new_outputs[i])
+                        updated_scores.append(scores[i])
+
+                # write all the changes back in bulk
+                if len(mismatched_ids) > 0:
+                    tests.loc[mismatched_ids, k+" score"] = np.nan
+                if len(updated_ids) > 0:
+                    tests.loc[updated_ids, "output"] = updated_outputs
+                    tests.loc[updated_ids, k+" score"] = updated_scores
+                if len(new_rows) > 0:
+                    tests.extend(new_rows)
 
         # make sure any duplicates we may have introduced are removed
         # tests.deduplicate()
@@ -1105,7 +1176,7 @@ class TestTreeBrowser():
         """ Save the current state of the model if we are auto saving.
         """
         if self.auto_save:
-            self.test_tree.to_csv()
+            self.test_tree.save()
 
 def score_max(s, nan_val=-1e3):
     if s == "" or s is None:
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+from ._change_feed import row_positions
+
+
+class TextIndex():
+    """ A trigram inverted index over the input and output text of the tests in a test tree.
+
+    Every substring of three or more bytes contains all of its trigrams, so intersecting the posting lists of
+    a search string's trigrams gives a small superset of the rows that contain it, which we then check exactly.
+    The posting lists are built once with vectorized numpy operations and stored as sorted arrays of row numbers.
+    Edits are tracked through the test tree's change feed: edited and removed rows are masked out of the posting
+    lists and edited rows are kept in a small side table that is searched directly (until it grows large enough
+    that it is worth rebuilding the index).
+    """
+
+    def __init__(self, test_tree):
+        """ Build a text index over the tests in a test tree.
+        """
+        self.test_tree = test_tree
+        tests = test_tree._tests
+        self._doc_ids = tests.index
+        inputs = tests["input"].tolist()
+        outputs = tests["output"].tolist()
+        texts = [_text_bytes(i) + b"\0" + _text_bytes(o) for i, o in zip(inputs, outputs)]
+        self._codes, self._starts, self._docs = _trigram_postings(texts)
+        self._stale = np.zeros(len(texts), dtype=bool) # rows that changed (or were removed) since we built the posting lists
+        self._edited = {} # id -> (input, output) for rows that changed since we built the posting lists
+        self.valid = True
+
+    def __call__(self, ids, columns):
+        """ Note a change to the test tree (this is a change feed subscriber).
+        """
+        if not self.valid or (columns is not None and "input" not in columns and "output" not in columns):
+            return
+        if ids is None:
+            self.valid = False
+            return
+        positions = self._doc_ids.get_indexer_for(list(ids))
+        self._stale[positions[positions >= 0]] = True
+
+        # remember the current text of the changed rows (and forget the rows that were removed)
+        tests = self.test_tree._tests
+        for id in ids:
+            self._edited.pop(id, None)
+        positions = row_positions(tests.index, ids)
+        for id, input, output in zip(tests.index[positions], tests["input"].iloc[positions], tests["output"].iloc[positions]):
+            self._edited[id] = (input, output)
+        if len(self._edited) > max(1000, len(self._doc_ids) // 10):
+            self.valid = False # cheaper to rebuild than to keep scanning the edits
+
+    def search(self, text):
+        """ The ids of the rows whose input or output contains the given text.
+
+        Returns None when the index would not be faster than scanning the columns (the text is shorter than three
+        bytes or its trigrams are so common that a large fraction of the rows are candidates), in which case the caller should scan.
+        """
+        text_bytes = text.encode("utf-8")
+        if len(text_bytes) < 3:
+            return None
+
+        # intersect the posting lists of all the trigrams, smallest first
+        postings = []
+        for code in np.unique(_trigram_codes(text_bytes)):
+            i = np.searchsorted(self._codes, code)
+            if i == len(self._codes) or self._codes[i] != code:
+                postings = [np.zeros(0, dtype=self._docs.dtype)]
+                break
+            postings.append(self._docs[self._starts[i]:self._starts[i+1]])
+        postings.sort(key=len)
+        candidates = postings[0]
+        for p in postings[1:]:
+            if len(candidates) == 0:
+                break
+            found = np.searchsorted(p, candidates) # binary search, since the candidates are usually far fewer than p
+            candidates = candidates[p[np.minimum(found, len(p) - 1)] == candidates]
+        if len(candidates) > len(self._doc_ids) // 4:
+            return None
+        candidates = candidates[~self._stale[candidates]]
+
+        # check the candidates exactly (the trigrams can match in a different order)
+        tests = self.test_tree._tests
+        candidate_ids = self._doc_ids[candidates]
+        if tests.index is self._doc_ids:
+            positions = candidates
+        else:
+            positions = tests.index.get_indexer_for(candidate_ids)
+        inputs = tests["input"].iloc[positions]
+        outputs = tests["output"].iloc[positions]
+        matches = inputs.str.contains(text, regex=False, na=False).values | outputs.str.contains(text, regex=False, na=False).values
+        out = candidate_ids[matches]
+
+        # the rows edited since the index was built are checked directly
+        edited = [id for id, (input, output) in self._edited.items() if (isinstance(input, str) and text in input) or (isinstance(output, str) and text in output)]
+        if len(edited) > 0:
+            out = out.append(pd.Index(edited))
+        return out
+
+
+def _text_bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else b""
+
+
+def _trigram_codes(text_bytes):
+    values = np.frombuffer(text_bytes, dtype=np.uint8).astype(np.int64)
+    return (values[:-2] << 16) | (values[1:-1] << 8) | values[2:]
+
+
+def _trigram_postings(texts):
+    """ Build the sorted trigram codes, the start offset of each code's posting list, and the posting lists (row numbers).
+    """
+    lengths = np.array([len(t) for t in texts], dtype=np.int64)
+    if lengths.sum() < 3:
+        return np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    codes = _trigram_codes(b"".join(texts))
+    docs = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+
+    # only keep the trigrams that lie inside a single row and do not span the input/output separator
+    keep = (docs[:-2] == docs[2:])
+    keep &= ((codes >> 8) & 0xFF) != 0
+    keep &= (codes & 0xFF) != 0
+    keep &= (codes >> 16) != 0
+    keys = codes[keep] * len(texts) + docs[:-2][keep]
+    keys.sort() # by code and then row
+    keys = keys[np.append(True, keys[1:] != keys[:-1])]
+    codes = keys // len(texts)
+    docs = (keys % len(texts)).astype(np.int32)
+    starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1]))
+    return codes[starts], np.append(starts, len(docs)), docs
@@ -0,0 +1,111 @@
+import bisect
+from ._change_feed import row_positions
+
+
+class TopicIndex():
+    """ A sorted-path index over the topic column of a test tree.
+
+    Topics look like UNIX paths, so every subtree of a topic is a contiguous range of the sorted list of
+    distinct topics (all of them start with the topic name followed by a "/"). This lets us answer subtree
+    queries in time proportional to the size of the subtree instead of scanning every row of the tree.
+    """
+
+    def __init__(self, tests=None):
+        """ Build a new topic index.
+
+        Parameters
+        ----------
+        tests : DataFrame or None
+            The tests frame to index. It must have "topic" and "label" columns.
+        """
+        self._topic_rows = {} # topic -> {id: is_topic_marker} (dicts are used as insertion ordered sets)
+        self._num_tests = {} # topic -> number of rows in the topic that are not topic markers
+        self._row_topic = {} # id -> topic
+        self._sorted_topics = []
+
+        if tests is not None:
+            for id, topic, label in zip(tests.index, tests["topic"], tests["label"]):
+                self._add(id, topic, label)
+
+    def __len__(self):
+        return len(self._row_topic)
+
+    def __contains__(self, id):
+        return id in self._row_topic
+
+    def update(self, tests, ids):
+        """ Re-index the given row ids to match their current state in the tests frame.
+
+        Rows that are no longer in the frame are removed from the index. This is called after rows
+        are appended, dropped, moved or relabeled.
+        """
+        for id in ids:
+            if id in self._row_topic:
+                self._remove(id)
+        positions = row_positions(tests.index, ids)
+        if len(positions) > 0:
+            for id, topic, label in zip(tests.index[positions], tests["topic"].iloc[positions], tests["label"].iloc[positions]):
+                if id not in self._row_topic: # guard against duplicate index values
+                    self._add(id, topic, label)
+
+    def topic_of(self, id):
+        """ The (normalized) topic a row id is indexed under.
+        """
+        return self._row_topic[id]
+
+    def ids(self, topic):
+        """ The ids of the rows that are directly in the given topic.
+        """
+        return list(self._topic_rows.get(topic, ()))
+
+    def subtopics(self, topic, include_self=True):
+        """ The sorted list of known topics in the subtree rooted at the given topic.
+        """
+        start = bisect.bisect_left(self._sorted_topics, topic + "/")
+        end = bisect.bisect_left(self._sorted_topics, topic + "0", lo=start) # "0" is the character right after "/"
+        out = self._sorted_topics[start:end]
+        if include_self and topic in self._topic_rows:
+            out.insert(0, topic)
+        return out
+
+    def subtree_ids(self, topic):
+        """ The ids of all the rows in the given topic or any of its subtopics.
+        """
+        out = []
+        for t in self.subtopics(topic):
+            out.extend(self._topic_rows[t])
+        return out
+
+    def has_direct_tests(self, topic):
+        """ Check if a topic contains any rows that are not topic markers.
+        """
+        return self._num_tests.get(topic, 0) > 0
+
+    def has_subtopics(self, topic):
+        """ Check if any rows live in a strict subtopic of the given topic.
+        """
+        return len(self.subtopics(topic, include_self=False)) > 0
+
+    def _add(self, id, topic, label):
+        if not isinstance(topic, str):
+            topic = ""
+        rows = self._topic_rows.get(topic, None)
+        if rows is None:
+            rows = self._topic_rows[topic] = {}
+            self._num_tests[topic] = 0
+            bisect.insort(self._sorted_topics, topic)
+        is_marker = label == "topic_marker"
+        rows[id] = is_marker
+        if not is_marker:
+            self._num_tests[topic] += 1
+        self._row_topic[id] = topic
+
+    def _remove(self, id):
+        topic = self._row_topic.pop(id)
+        rows = self._topic_rows[topic]
+        if not rows.pop(id):
+            self._num_tests[topic] -= 1
+        if len(rows) == 0:
+            del self._topic_rows[topic]
+            del self._num_tests[topic]
+            del self._sorted_topics[bisect.bisect_left(self._sorted_topics, topic)]
@@ -38,35 +38,36 @@ class OutputNearestNeighborLabelModel():
         embeddings[:,:embeddings.shape[1]//2] = 0
         return self.model.predict(embeddings)
 
+def _topic_training_mask(topic, test_tree, valid_mask):
+    """ Select the valid samples of a topic, expanding to its subtopics and then its parent topics if there are too few.
+    """
+
+    # try and select samples from the current topic
+    topic_mask = (test_tree["topic"] == topic) & valid_mask
+    
+    # if we didn't find enough samples then expand to include subtopics
+    if topic_mask.sum() <= 1:
+        topic_mask = test_tree["topic"].str.startswith(topic) & valid_mask
+    
+    # if we still didn't find enough samples then expand to include parent topics
+    parts = topic.split("/")
+    for i in range(len(parts), 0, -1):
+        prefix = "/".join(parts[:i+1])
+        if topic_mask.sum() <= 1:
+            topic_mask = test_tree["topic"].str.startswith(prefix) & valid_mask
+        else:
+            break
+    return topic_mask
+
 class TopicLabelingModel:
     def __init__(self, topic, test_tree):
         self.topic = topic
         self.test_tree = test_tree
-
-        # mask out entries that do not have a pass/fail label
-        valid_mask = ~((test_tree["labeler"] == "imputed") | (test_tree["label"] == "topic_marker") | (test_tree["label"] == "off_topic"))
-        
-        # try and select samples from the current topic
-        topic_mask = (test_tree["topic"] == topic) & valid_mask
-        
-        # if we didn't find enough samples then expand to include subtopics
-        if topic_mask.sum() <= 1:
-            topic_mask = test_tree["topic"].str.startswith(topic) & valid_mask
-        
-        # if we still didn't find enough samples then expand to include parent topics
-        parts = topic.split("/")
-        for i in range(len(parts), 0, -1):
-            prefix = "/".join(parts[:i+1])
-            if topic_mask.sum() <= 1:
-                topic_mask = test_tree["topic"].str.startswith(prefix) & valid_mask
-            else:
-                break
+        topic_mask = self._training_mask(topic, test_tree)
 
         # get our features and labels for fitting a model
-        strings = list(test_tree["input"][topic_mask]) + list(test_tree["output"][topic_mask])
         labels = list(test_tree["label"][topic_mask])
-        unrolled_embeds = adatest.embed(strings)
-        embeddings = np.hstack([unrolled_embeds[:len(labels)], unrolled_embeds[len(labels):]])
+        embeddings = test_tree.embeddings(test_tree.index[topic_mask.values])
 
         # empty test tree
         if len(labels) == 0:
@@ -112,6 +113,18 @@ class TopicLabelingModel:
             return self.model.predict_prob([embeddings])[0]
         return self.model.predict_prob(embeddings)
 
+    @classmethod
+    def training_ids(cls, topic, test_tree):
+        """ The ids of the tests a labeling model for the given topic is trained on.
+        """
+        return test_tree.index[cls._training_mask(topic, test_tree).values]
+
+    @staticmethod
+    def _training_mask(topic, test_tree):
+        # mask out entries that do not have a pass/fail label
+        valid_mask = ~((test_tree["labeler"] == "imputed") | (test_tree["label"] == "topic_marker") | (test_tree["label"] == "off_topic"))
+        return _topic_training_mask(topic, test_tree, valid_mask)
+
 class TopicMembershipModel:
     """ A model that predicts if a given test fits in a given topic.
 
@@ -120,30 +133,11 @@ class TopicMembershipModel:
     def __init__(self, topic, test_tree):
         self.topic = topic
         self.test_tree = test_tree
-
-        # mask out entries that do not have a topic membership label
-        valid_mask = ~((test_tree["labeler"] == "imputed") | (test_tree["label"] == "topic_marker"))
-        
-        # try and select samples from the current topic
-        topic_mask = (test_tree["topic"] == topic) & valid_mask
-        
-        # if we didn't find enough samples then expand to include subtopics
-        if topic_mask.sum() <= 1:
-            topic_mask = test_tree["topic"].str.startswith(topic) & valid_mask
-        
-        # if we still didn't find enough samples then expand to include parent topics
-        parts = topic.split("/")
-        for i in range(len(parts), 0, -1):
-            prefix = "/".join(parts[:i+1])
-            if topic_mask.sum() <= 1:
-                topic_mask = test_tree["topic"].str.startswith(prefix) & valid_mask
-            else:
-                break
+        topic_mask = self._training_mask(topic, test_tree)
 
         # get our features and labels for fitting a model
-        strings = list(test_tree["input"][topic_mask])
         labels = [l if l == "off_topic" else "on_topic" for l in test_tree["label"][topic_mask]]
-        embeddings = np.array(adatest.embed(strings))
+        embeddings = test_tree.embeddings(test_tree.index[topic_mask.values], column="input")
 
         # empty test tree (default to on-topic)
         if len(labels) == 0:
@@ -166,6 +160,18 @@ class TopicMembershipModel:
             return "on_topic" if self.model.predict_prob([embeddings])[0] > 0.5 else "off_topic"
         return ["on_topic" if v > 0.5 else "off_topic" for v in self.model.predict_prob(embeddings)]
 
+    @classmethod
+    def training_ids(cls, topic, test_tree):
+        """ The ids of the tests a membership model for the given topic is trained on.
+        """
+        return test_tree.index[cls._training_mask(topic, test_tree).values]
+
+    @staticmethod
+    def _training_mask(topic, test_tree):
+        # mask out entries that do not have a topic membership label
+        valid_mask = ~((test_tree["labeler"] == "imputed") | (test_tree["label"] == "topic_marker"))
+        return _topic_training_mask(topic, test_tree, valid_mask)
+
 class ChainTopicModel:
     def __init__(self, model=None):
         if model is None:
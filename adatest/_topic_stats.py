@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+from ._change_feed import row_positions
+
+# the per score column statistics we keep (values are the signed scores we show in the UI, so <= 0 is a pass and > 0 a failure)
+SCORE_STATS = ["n_pass", "sum_pass", "n_fail", "sum_fail"]
+LABEL_STATS = ["pass", "fail", "off_topic"]
+
+
+class TopicStats():
+    """ Aggregate statistics for every topic of a test tree that are kept up to date as the test tree changes.
+
+    For each topic we keep the label counts and, for each score column, the count and sum of the UI score values
+    at or below zero (passing) and above zero (failing). These are additive, so the totals of a whole subtree are
+    maintained by adding the change in a topic's own totals to each of its ancestors. This lets the browser
+    summarize and sort folders in time proportional to the number of folders instead of the number of tests in them.
+    Rows in suggestion topics are never counted in their parent topics.
+    """
+
+    def __init__(self, test_tree, score_columns):
+        """ Build the statistics for a test tree.
+
+        Parameters
+        ----------
+        test_tree : adatest.TestTree
+            The test tree to summarize.
+
+        score_columns : list[str]
+            The score columns to aggregate.
+        """
+        self.test_tree = test_tree
+        self.score_columns = list(score_columns)
+        self._direct = {} # topic -> totals for the rows directly in the topic
+        self._direct_max = {} # topic -> max UI score value for each score column over the rows directly in the topic
+        self._subtree = {} # topic -> totals for the whole subtree rooted at the topic
+        self._dirty_topics = set()
+
+        tests = test_tree._tests
+        totals, maxes = _row_stats(tests, self.score_columns)
+        topics = tests["topic"].astype(object).where(tests["topic"].notna(), "").values
+        codes, unique_topics = pd.factorize(topics)
+        direct = np.zeros((len(unique_topics), totals.shape[1]))
+        np.add.at(direct, codes, totals)
+        direct_max = np.full((len(unique_topics), maxes.shape[1]), -np.inf)
+        np.maximum.at(direct_max, codes, maxes)
+        for i, topic in enumerate(unique_topics):
+            self._set_direct(topic, direct[i], direct_max[i])
+
+    def update(self, ids, columns):
+        """ Note the rows that are about to be re-indexed in the topic index (so we can still see their old topics).
+
+        Returns False if the change could not be tracked incrementally (and the statistics should be rebuilt).
+        """
+        if columns is not None and not any(c in ["topic", "label"] or c in self.score_columns for c in columns):
+            return True
+        topic_index = self.test_tree._topic_index
+        if ids is None or topic_index is None:
+            return False
+        for id in ids:
+            if id in topic_index:
+                self._dirty_topics.add(topic_index.topic_of(id))
+        tests = self.test_tree._tests
+        for topic in tests["topic"].iloc[row_positions(tests.index, ids)]:
+            self._dirty_topics.add(topic if isinstance(topic, str) else "")
+        return True
+
+    def subtree(self, topic):
+        """ The statistics of all the (non-suggestion) tests in the subtree rooted at the given topic.
+
+        Returns
+        -------
+        dict
+            The label counts under "pass", "fail" and "off_topic", and for each score column a dict with the
+            "n_pass", "sum_pass", "n_fail", "sum_fail", "mean" and "max" of the UI score values.
+        """
+        self._flush()
+        totals = self._subtree.get(topic, None)
+        if totals is None:
+            totals = np.zeros(len(LABEL_STATS) + len(SCORE_STATS) * len(self.score_columns))
+        out = {k: int(totals[i]) for i, k in enumerate(LABEL_STATS)}
+        maxes = None
+        for j, c in enumerate(self.score_columns):
+            start = len(LABEL_STATS) + len(SCORE_STATS) * j
+            stats = dict(zip(SCORE_STATS, totals[start:start + len(SCORE_STATS)]))
+            stats["n_pass"] = int(stats["n_pass"])
+            stats["n_fail"] = int(stats["n_fail"])
+            count = stats["n_pass"] + stats["n_fail"]
+            stats["mean"] = (stats["sum_pass"] + stats["sum_fail"]) / count if count > 0 else np.nan
+            if maxes is None:
+                maxes = self._subtree_max(topic)
+            stats["max"] = maxes[j] if np.isfinite(maxes[j]) else np.nan
+            out[c] = stats
+        return out
+
+    def _subtree_max(self, topic):
+        """ Max is not additive, so we combine the maxes of all the topics in the subtree when asked for it.
+        """
+        out = np.full(len(self.score_columns), -np.inf)
+        for t in [topic] + self.test_tree.topic_index.subtopics(topic, include_self=False):
+            if "/__suggestions__" not in t and t in self._direct_max:
+                out = np.maximum(out, self._direct_max[t])
+        return out
+
+    def _flush(self):
+        """ Recompute the totals of the topics that changed since the last query.
+        """
+        if len(self._dirty_topics) == 0:
+            return
+        topic_index = self.test_tree.topic_index
+        tests = self.test_tree._tests
+        for topic in self._dirty_topics:
+            rows = tests.loc[topic_index.ids(topic)]
+            totals, maxes = _row_stats(rows, self.score_columns)
+            self._set_direct(topic, totals.sum(0), maxes.max(0, initial=-np.inf))
+        self._dirty_topics = set()
+
+    def _set_direct(self, topic, totals, maxes):
+        old = self._direct.get(topic, None)
+        delta = totals if old is None else totals - old
+        if not np.any(totals) and np.all(np.isinf(maxes)):
+            self._direct.pop(topic, None)
+            self._direct_max.pop(topic, None)
+        else:
+            self._direct[topic] = totals
+            self._direct_max[topic] = maxes
+
+        # suggestions are not counted in the totals of their parent topics
+        if "/__suggestions__" in topic or not np.any(delta):
+            return
+        parts = topic.split("/")
+        for i in range(1, len(parts) + 1):
+            ancestor = "/".join(parts[:i])
+            self._subtree[ancestor] = self._subtree.get(ancestor, 0) + delta
+
+
+def _row_stats(tests, score_columns):
+    """ The label indicators and score totals of each row, and the max UI score value of each row in each score column.
+
+    This is a vectorized version of running ui_score_parts on every score of every row.
+    """
+    labels = np.asarray(tests["label"], dtype=object)
+    is_pass = labels == "pass"
+    is_fail = labels == "fail"
+    totals = [is_pass, is_fail, labels == "off_topic"]
+    maxes = []
+
+    # the sign and offset we use to encode the label in the UI score (see ui_score_parts)
+    sign = np.where(is_pass | is_fail, 1.0, np.nan)
+    offset = np.where(is_pass, -1 - 1e-6, np.where(is_fail, 1e-6, 0.0))
+
+    for c in score_columns:
+        scores = np.asarray(tests[c], dtype=object)
+
+        # most rows have a single score, but some hold several "|" separated scores
+        has_parts = [isinstance(v, str) and "|" in v for v in scores]
+        if any(has_parts):
+            scores = pd.Series([v.split("|") if p else v for v, p in zip(scores, has_parts)], dtype=object).explode()
+        else:
+            scores = pd.Series(scores)
+        positions = scores.index.values
+        values = pd.to_numeric(scores.where(scores != "", np.nan), errors="coerce").values.astype(float)
+        values = np.clip(offset[positions] + values * sign[positions], -1, 1)
+
+        passed = values <= 0
+        failed = values > 0
+        n = len(tests)
+        totals.append(np.bincount(positions[passed], minlength=n))
+        totals.append(np.bincount(positions[passed], weights=values[passed], minlength=n))
+        totals.append(np.bincount(positions[failed], minlength=n))
+        totals.append(np.bincount(positions[failed], weights=values[failed], minlength=n))
+        row_max = np.full(n, -np.inf)
+        finite = np.isfinite(values)
+        np.maximum.at(row_max, positions[finite], values[finite])
+        maxes.append(row_max)
+
+    return np.column_stack(totals).astype(float), np.column_stack(maxes) if len(maxes) > 0 else np.zeros((len(tests), 0))
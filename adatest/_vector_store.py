@@ -0,0 +1,291 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+KEY_BYTES = 16 # the embedding caches use 16 byte digests as keys (see embedders._cache_key)
+
+
+class VectorStore():
+    """ An append-only on-disk embedding store with one memory-mapped matrix per embedding model.
+
+    Each model gets three files in the store directory: a ".vectors" file with the raw rows of the matrix, a ".keys"
+    file with the 16 byte key of each row, and a ".json" file recording the model name, dimension, dtype and the
+    generation of the other two files. Lookups are a dict probe per key and a single row gather from the
+    memory-mapped matrix, and since the files are only ever appended to, several server processes can map the same
+    pages and pick up each other's writes by reading the tail of the ".keys" file. Appends (and compaction) hold an
+    exclusive file lock, vectors are written before their keys, and a reader only trusts rows that have a key, so a
+    crashed writer never exposes a partial row.
+
+    Setting a key that is already stored appends a new row that shadows the old one; `compact` rewrites each
+    matrix without the shadowed rows (and can change the dtype, e.g. to float16 to halve the size of the store).
+    Compaction writes a new generation of the ".keys" and ".vectors" files and then switches to it by atomically
+    replacing the ".json" file, so readers always see a matching pair of files.
+    """
+
+    def __init__(self, path, dtype="float32"):
+        """ Open (or create) a vector store.
+
+        Parameters
+        ----------
+        path : str
+            The directory to keep the store in.
+
+        dtype : str
+            The dtype to store the vectors of new models in ("float32" or "float16"). Vectors are always returned
+            as float32, and models that are already stored keep the dtype they were stored with.
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+        self._models = {} # model name -> _ModelVectors
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            for vectors in self._all_models():
+                vectors.refresh()
+            return sum(len(vectors.rows) for vectors in self._models.values())
+
+    def get_many(self, keys, model):
+        """ Look up the vectors stored for the given keys.
+
+        Parameters
+        ----------
+        keys : iterable of str
+            The (hex digest) keys to look up.
+
+        model : str
+            The name of the embedding model the vectors came from.
+
+        Returns
+        -------
+        dict
+            The float32 vector of every key that was found.
+        """
+        vectors = self._model(model)
+        with self._lock:
+            vectors.refresh()
+            found_keys = []
+            found_rows = []
+            for key in keys:
+                row = vectors.rows.get(bytes.fromhex(key), None)
+                if row is not None:
+                    found_keys.append(key)
+                    found_rows.append(row)
+            if len(found_rows) == 0:
+                return {}
+            block = np.asarray(vectors.matrix[np.array(found_rows)], dtype=np.float32)
+        return dict(zip(found_keys, block))
+
+    def set_many(self, embeddings, model):
+        """ Append vectors to the store.
+
+        Parameters
+        ----------
+        embeddings : dict
+            The vector to store under each (hex digest) key.
+
+        model : str
+            The name of the embedding model the vectors came from.
+        """
+        if len(embeddings) == 0:
+            return
+        keys = b"".join(bytes.fromhex(key) for key in embeddings)
+        matrix = np.vstack([np.asarray(v) for v in embeddings.values()])
+        vectors = self._model(model)
+        with self._lock, _FileLock(self.path):
+            vectors.refresh()
+            vectors.append(keys, matrix)
+
+    def compact(self, dtype=None):
+        """ Rewrite every matrix without the rows shadowed by later writes.
+
+        Parameters
+        ----------
+        dtype : str or None
+            The dtype to rewrite the vectors in (None keeps the dtype each model is stored in).
+
+        Returns
+        -------
+        int
+            The number of rows that were dropped.
+        """
+        num_dropped = 0
+        with self._lock, _FileLock(self.path):
+            for vectors in self._all_models():
+                vectors.refresh()
+                num_dropped += vectors.compact(dtype)
+        return num_dropped
+
+    def _model(self, model):
+        vectors = self._models.get(model, None)
+        if vectors is None:
+            vectors = self._models[model] = _ModelVectors(self, model)
+        return vectors
+
+    def _all_models(self):
+        """ Every model in the store, including the ones other processes added.
+        """
+        for file in sorted(os.listdir(self.path)):
+            if file.endswith(".json"):
+                with open(os.path.join(self.path, file), encoding="utf-8") as f:
+                    self._model(json.load(f)["model"])
+        return list(self._models.values())
+
+
+class _ModelVectors():
+    """ The matrix and key index of a single model in a vector store.
+    """
+
+    def __init__(self, store, model):
+        self.store = store
+        self.model = model
+        self.base = os.path.join(store.path, hashlib.blake2b(model.encode("utf-8"), digest_size=8).hexdigest())
+        self.meta_path = self.base + ".json"
+        self._reset()
+
+    def _reset(self):
+        self.rows = {} # key bytes -> row
+        self.num_rows = 0
+        self.matrix = None
+        self.dim = None
+        self.dtype = None
+        self.generation = None
+        self.keys_path = None
+        self.vectors_path = None
+        self._meta_version = None
+
+    def _paths(self, generation):
+        """ The ".keys" and ".vectors" files of a generation.
+        """
+        base = self.base if generation is None else "%s.%d" % (self.base, generation)
+        return base + ".keys", base + ".vectors"
+
+    def refresh(self):
+        """ Pick up the rows appended (and compactions done) since we last looked.
+        """
+        try:
+            self._refresh()
+        except FileNotFoundError:
+            # a compaction removed the generation we were about to read, so we switch to the new one
+            self._reset()
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.meta_path)
+        except FileNotFoundError:
+            if self._meta_version is not None:
+                self._reset()
+            return
+        if (stat.st_ino, stat.st_mtime_ns) != self._meta_version:
+            self._reset()
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.generation = meta.get("generation", None)
+            self.keys_path, self.vectors_path = self._paths(self.generation)
+            self._meta_version = (stat.st_ino, stat.st_mtime_ns)
+
+        num_keys = os.path.getsize(self.keys_path) // KEY_BYTES
+        if num_keys > self.num_rows:
+            with open(self.keys_path, "rb") as f:
+                f.seek(self.num_rows * KEY_BYTES)
+                data = f.read((num_keys - self.num_rows) * KEY_BYTES)
+            matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(num_keys, self.dim))
+            for i in range(0, len(data), KEY_BYTES):
+                self.rows[data[i:i + KEY_BYTES]] = self.num_rows + i // KEY_BYTES
+            self.num_rows = num_keys
+            self.matrix = matrix
+
+    def append(self, keys, matrix):
+        """ Append rows (the caller holds the file lock and has just refreshed).
+        """
+        if self.dim is None:
+            self.generation = 0
+            self.keys_path, self.vectors_path = self._paths(self.generation)
+            open(self.keys_path, "wb").close()
+            open(self.vectors_path, "wb").close()
+            _write_json(self.meta_path, {"model": self.model, "dim": matrix.shape[1], "dtype": self.store.dtype.name, "generation": self.generation})
+            self.refresh()
+        if matrix.shape[1] != self.dim:
+            raise Exception("Can't store %d dimensional vectors for %s, which has %d dimensional vectors!" % (matrix.shape[1], self.model, self.dim))
+
+        # we write at the end of the rows that have keys, which drops anything a crashed writer left behind
+        _write_at(self.vectors_path, self.num_rows * self.dim * self.dtype.itemsize, matrix.astype(self.dtype).tobytes())
+        _write_at(self.keys_path, self.num_rows * KEY_BYTES, keys)
+        self.refresh()
+
+    def compact(self, dtype):
+        """ Rewrite the matrix with only the newest row of every key (the caller holds the file lock and has just refreshed).
+        """
+        if self.num_rows == 0:
+            return 0
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        keys = list(self.rows)
+        rows = np.array([self.rows[key] for key in keys], dtype=np.int64)
+        num_dropped = self.num_rows - len(rows)
+        if num_dropped == 0 and dtype == self.dtype:
+            return 0
+
+        # write the new generation next to the old one, and then switch readers over to it with the ".json" file
+        generation = (self.generation or 0) + 1
+        keys_path, vectors_path = self._paths(generation)
+        with open(vectors_path, "wb") as f:
+            for start in range(0, len(rows), 65536):
+                f.write(np.asarray(self.matrix[rows[start:start + 65536]], dtype=dtype).tobytes())
+        with open(keys_path, "wb") as f:
+            f.write(b"".join(keys))
+        _write_json(self.meta_path, {"model": self.model, "dim": self.dim, "dtype": dtype.name, "generation": generation})
+
+        # readers that still have the old generation mapped keep it until they refresh
+        for path in [self.keys_path, self.vectors_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass # e.g. on Windows, where files can't be removed while another process has them mapped
+        self.refresh()
+        return num_dropped
+
+
+class _FileLock():
+    """ An exclusive lock on a vector store shared by all the processes using it (where fcntl is available).
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, "lock")
+        self._file = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self # no locking across processes on platforms without fcntl
+        self._file = open(self.path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._file is not None:
+            import fcntl
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def _write_at(path, offset, data):
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+
+
+def _write_json(path, data):
+    """ Replace a JSON file atomically (readers see either the old or the new contents).
+    """
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
@@ -1,54 +1,350 @@
+import os
+import hashlib
+import warnings
+import threading
+import collections
+import contextlib
 import numpy as np
 import adatest
 from sklearn.preprocessing import normalize
 import appdirs
 import diskcache
-_embedding_memory_cache = {}
+from ._vector_store import VectorStore
+
+
+class LRUEmbeddingCache():
+    """ An in-memory embedding cache that evicts the least recently used embeddings once it grows too large.
+
+    The size limit is read from `adatest.embedding_cache_mb` (None means no limit) every time we insert, so it
+    can be changed while a server is running. The hit, miss and eviction counts are kept for monitoring (see `stats`).
+    """
+
+    def __init__(self):
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock() # the browser prefetcher embeds from a background thread
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """ Look up an embedding (and mark it as recently used).
+        """
+        with self._lock:
+            value = self._data.get(key, None)
+            if value is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._data[key] = value
+            self.nbytes += value.nbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ The size of the cache and its hit, miss and eviction counts.
+        """
+        return {
+            "entries": len(self._data), "megabytes": self.nbytes / 2**20, "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "evicted_megabytes": self.evicted_bytes / 2**20
+        }
+
+    def _evict(self):
+        if adatest.embedding_cache_mb is None:
+            return
+        max_bytes = adatest.embedding_cache_mb * 2**20
+        while self.nbytes > max_bytes and len(self._data) > 1: # we always keep the newest entry
+            _, value = self._data.popitem(last=False)
+            self.nbytes -= value.nbytes
+            self.evictions += 1
+            self.evicted_bytes += value.nbytes
+
+
+_embedding_memory_cache = LRUEmbeddingCache()
 _embedding_file_cache = diskcache.Cache(appdirs.user_cache_dir("adatest") + "/embeddings.diskcache")
+_CACHE_FORMAT_KEY = "__adatest_embedding_cache_format__"
+_CACHE_FORMAT = 2 # digest keys (see _cache_key) and raw float32 or float16 values (see _encode_embedding)
+
+
+def _cache_key(prefixed_s):
+    """ The fixed size key we store the embedding of a (model name prefixed) string under in both cache tiers.
+    """
+    return hashlib.blake2b(prefixed_s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _is_cache_key(key):
+    return isinstance(key, str) and len(key) == 32 and all(c in "0123456789abcdef" for c in key)
+
+
+def use_vector_store(path=None, dtype=None):
+    """ Keep the persistent embedding cache in a memory-mapped VectorStore instead of a diskcache.
+
+    The store starts out empty (diskcache keys don't record which model an embedding came from, so the
+    embeddings in the diskcache can't be moved over).
+
+    Parameters
+    ----------
+    path : str or None
+        The directory to keep the store in (None means the adatest user cache directory).
+
+    dtype : str or None
+        The dtype to store new vectors in ("float32" or "float16", None means `adatest.embedding_dtype`).
+    """
+    global _embedding_file_cache
+    if path is None:
+        path = appdirs.user_cache_dir("adatest") + "/embeddings.vectors"
+    _embedding_file_cache = VectorStore(path, dtype=adatest.embedding_dtype if dtype is None else dtype)
+    return _embedding_file_cache
+
+
+def _read_file_cache(prefixed_strings, model):
+    """ Read the embeddings of many keys from the disk tier in a single transaction.
+
+    Parameters
+    ----------
+    prefixed_strings : dict
+        The (model name prefixed) string of each key to read. Embeddings saved under the old (full string) keys
+        are moved over to their digest keys as they are found.
+
+    model : str
+        The name of the model the embeddings come from.
+
+    Returns
+    -------
+    dict
+        The embedding of each key that was found.
+    """
+    out = {}
+    if len(prefixed_strings) == 0:
+        return out
+    if isinstance(_embedding_file_cache, VectorStore):
+        return _embedding_file_cache.get_many(prefixed_strings, model)
+    with _file_cache_transaction():
+        check_legacy = _may_have_legacy_keys()
+        for key, prefixed_s in prefixed_strings.items():
+            value = _embedding_file_cache.get(key, None)
+            if value is None and check_legacy:
+                value = _embedding_file_cache.get(prefixed_s, None)
+                if value is not None:
+                    _embedding_file_cache[key] = _encode_embedding(value)
+                    del _embedding_file_cache[prefixed_s]
+            if value is not None:
+                out[key] = _decode_embedding(value)
+    return out
+
+
+def _write_file_cache(embeddings, model):
+    """ Write many embeddings (a dict from key to embedding) of the given model to the disk tier in a single transaction.
+    """
+    if len(embeddings) == 0:
+        return
+    if isinstance(_embedding_file_cache, VectorStore):
+        _embedding_file_cache.set_many(embeddings, model)
+        return
+    with _file_cache_transaction():
+        for key, embedding in embeddings.items():
+            _embedding_file_cache[key] = _encode_embedding(embedding)
+
+
+def _file_cache_transaction():
+    """ A transaction on the disk tier (other cache types, like the plain dicts used in tests, don't need one).
+    """
+    if isinstance(_embedding_file_cache, diskcache.Cache):
+        return _embedding_file_cache.transact()
+    return contextlib.nullcontext()
+
+
+def _encode_embedding(embedding, dtype=None):
+    """ Embeddings are stored as raw bytes, which diskcache keeps as a blob without pickling.
+
+    float32 embeddings take a multiple of four bytes, so we mark float16 embeddings with a trailing byte (which
+    makes their length odd) and can tell the two apart without storing the dtype.
+    """
+    dtype = _storage_dtype() if dtype is None else np.dtype(dtype)
+    if dtype == np.float16:
+        return np.asarray(embedding, dtype=np.float16).tobytes() + b"\0"
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def _decode_embedding(value):
+    """ Decode a stored embedding (in the dtype it was stored in).
+    """
+    if isinstance(value, bytes):
+        if len(value) % 2 == 1:
+            return np.frombuffer(value[:-1], dtype=np.float16)
+        return np.frombuffer(value, dtype=np.float32)
+    return np.asarray(value, dtype=np.float32) # pickled by an older version
+
+
+def _storage_dtype():
+    return np.dtype(adatest.embedding_dtype)
+
+
+def _to_storage(embedding):
+    """ The embedding in the dtype we cache embeddings in.
+    """
+    return np.asarray(embedding, dtype=_storage_dtype())
+
+
+def _to_float32(embedding):
+    """ Cached embeddings are upcast to float32 before we hand them out, so all the math is done in float32.
+    """
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _may_have_legacy_keys():
+    """ Check if the disk tier may still hold embeddings under the old (full string) keys.
+
+    Looking up a legacy key doubles the cost of a miss, so we mark caches that never held legacy keys (or that were
+    fully migrated) and skip those lookups for them.
+    """
+    if _embedding_file_cache.get(_CACHE_FORMAT_KEY, None) == _CACHE_FORMAT:
+        return False
+    if len(_embedding_file_cache) == 0:
+        _embedding_file_cache[_CACHE_FORMAT_KEY] = _CACHE_FORMAT
+        return False
+    return True
+
+
+def migrate_embedding_cache(dtype=None):
+    """ Move every embedding in the disk cache that is stored under an old (full string) key to its digest key.
+
+    Old keys are also migrated one at a time as they are looked up, so this is only needed to shrink the cache
+    index (or to drop the legacy key lookup cost) in one go.
+
+    Parameters
+    ----------
+    dtype : str or None
+        Also rewrite every embedding in this dtype (e.g. "float16" to halve the size of an existing cache). None
+        leaves the embeddings that are already under digest keys as they are.
+
+    Returns
+    -------
+    int
+        The number of migrated (or rewritten) embeddings.
+    """
+    if isinstance(_embedding_file_cache, VectorStore):
+        return _embedding_file_cache.compact(dtype=dtype) if dtype is not None else 0 # vector stores only ever held digest keys
+    num_migrated = 0
+    for old_key in list(_embedding_file_cache):
+        if old_key == _CACHE_FORMAT_KEY:
+            continue
+        if isinstance(old_key, str) and not _is_cache_key(old_key):
+            _embedding_file_cache[_cache_key(old_key)] = _encode_embedding(_decode_embedding(_embedding_file_cache[old_key]), dtype)
+            del _embedding_file_cache[old_key]
+            num_migrated += 1
+        elif dtype is not None:
+            value = _embedding_file_cache[old_key]
+            embedding = _decode_embedding(value)
+            if embedding.dtype != np.dtype(dtype) or not isinstance(value, bytes):
+                _embedding_file_cache[old_key] = _encode_embedding(embedding, dtype)
+                num_migrated += 1
+    _embedding_file_cache[_CACHE_FORMAT_KEY] = _CACHE_FORMAT
+    return num_migrated
+
+
+def embedding_cache_stats():
+    """ The size and the hit, miss and eviction counts of the in-memory embedding cache.
+    """
+    return _embedding_memory_cache.stats()
+
 
 def _embed(strings, normalize=True):
 
-    # find which strings are not in the cache
-    new_text_strings = []
-    new_image_urls = []
+    # find which strings are not in the cache (we keep the embeddings of this call in `found`, since the memory
+    # tier may evict some of them before we return)
+    found = {}
+    missing = {} # key -> prefixed string, for the strings that are not in the memory tier
+    new_text_strings = {}
+    new_image_urls = {}
+    keys = []
     text_prefix = _text_embedding_model().name # TODO: need to figure out how to do the same for image embedding, but only when needed
     for s in strings:
         if s.startswith("__IMAGE="):
             prefixed_s = s
         else:
             prefixed_s = text_prefix + s
-        if prefixed_s not in _embedding_memory_cache:
-            if prefixed_s not in _embedding_file_cache:
-                if s.startswith("__IMAGE="):
-                    new_image_urls.append(s)
-                else:
-                    new_text_strings.append(s)
-                _embedding_memory_cache[prefixed_s] = None # so we don't embed the same string twice
-            else:
-                _embedding_memory_cache[prefixed_s] = _embedding_file_cache[prefixed_s]
-    
-    # embed the new text strings
+        key = _cache_key(prefixed_s)
+        keys.append(key)
+        if key in found or key in missing:
+            continue
+        embedding = _embedding_memory_cache.get(key)
+        if embedding is not None:
+            found[key] = _to_float32(embedding)
+        else:
+            missing[key] = prefixed_s
+
+    # look up everything the memory tier missed in the disk tier at once (for each model)
+    missing_images = {key: prefixed_s for key, prefixed_s in missing.items() if prefixed_s.startswith("__IMAGE=")}
+    missing_text = {key: prefixed_s for key, prefixed_s in missing.items() if key not in missing_images}
+    for model, prefixed_strings in [(text_prefix, missing_text), ("__IMAGE=", missing_images)]:
+        for key, embedding in _read_file_cache(prefixed_strings, model).items():
+            _embedding_memory_cache[key] = _to_storage(embedding)
+            found[key] = _to_float32(_to_storage(embedding))
+    for key, prefixed_s in missing_text.items():
+        if key not in found:
+            new_text_strings[key] = prefixed_s[len(text_prefix):]
+    for key, prefixed_s in missing_images.items():
+        if key not in found:
+            new_image_urls[key] = prefixed_s
+
+    # embed the new text strings (models that embed in chunks hand each one back as it finishes, so we cache it right away)
     if len(new_text_strings) > 0:
-        new_embeds = _text_embedding_model()(new_text_strings)
-        for i,s in enumerate(new_text_strings):
-            prefixed_s = text_prefix + s
-            if normalize:
-                _embedding_memory_cache[prefixed_s] = new_embeds[i] / np.linalg.norm(new_embeds[i])
-            else:
-                _embedding_memory_cache[prefixed_s] = new_embeds[i]
-            _embedding_file_cache[prefixed_s] = _embedding_memory_cache[prefixed_s]
+        new_keys = list(new_text_strings)
+        for positions, new_embeds in _embed_chunks(_text_embedding_model(), list(new_text_strings.values())):
+            for j,i in enumerate(positions):
+                key = new_keys[i]
+                if normalize:
+                    embedding = new_embeds[j] / np.linalg.norm(new_embeds[j])
+                else:
+                    embedding = new_embeds[j]
+                found[key] = _to_float32(_to_storage(embedding)) # so cold and cached embeddings are identical
+                _embedding_memory_cache[key] = _to_storage(embedding)
+            _write_file_cache({new_keys[i]: found[new_keys[i]] for i in positions}, text_prefix)
 
     # embed the new image urls
     if len(new_image_urls) > 0:
-        new_embeds = _image_embedding_model()([url[8:] for url in new_image_urls])
-        for i,s in enumerate(new_image_urls):
+        new_embeds = _image_embedding_model()([url[8:] for url in new_image_urls.values()])
+        for i,key in enumerate(new_image_urls):
             if normalize:
-                _embedding_memory_cache[s] = new_embeds[i] / np.linalg.norm(new_embeds[i])
+                embedding = new_embeds[i] / np.linalg.norm(new_embeds[i])
             else:
-                _embedding_memory_cache[s] = new_embeds[i]
-            _embedding_file_cache[s] = _embedding_memory_cache[s]
+                embedding = new_embeds[i]
+            found[key] = _to_float32(_to_storage(embedding))
+            _embedding_memory_cache[key] = _to_storage(embedding)
+        _write_file_cache({key: found[key] for key in new_image_urls}, "__IMAGE=")
     
-    return [_embedding_memory_cache[s if s.startswith("__IMAGE=") else text_prefix + s] for s in strings]
+    return [found[key] for key in keys]
+
+def _embed_chunks(model, strings):
+    """ The (positions, embeddings) chunks of embedding the given strings with the given model.
+
+    Models with an `embed_chunks` method (like EmbeddingPool) yield chunks as they finish, other models embed
+    everything as a single chunk.
+    """
+    if hasattr(model, "embed_chunks"):
+        return model.embed_chunks(strings)
+    return [(range(len(strings)), model(strings))]
 
 def _text_embedding_model():
     """ Get the text embedding model.
@@ -114,27 +410,179 @@ def cos_sim(a, b):
     return normalize(a, axis=1) @ normalize(b, axis=1).T
 
 class TransformersTextEmbedding():
-    def __init__(self, model="sentence-transformers/stsb-roberta-base-v2"):
+    def __init__(self, model="sentence-transformers/stsb-roberta-base-v2", batch_size=64, max_tokens=8192):
+        """ Embed text with a HuggingFace transformers model (using mean pooling).
+
+        Strings are sorted by length and embedded in batches of similar length, so short strings are not padded
+        to the length of the longest string we were given (and large calls don't run out of memory).
+
+        Parameters
+        ----------
+        model : str
+            The name (or path) of the model to load.
+
+        batch_size : int or None
+            The most strings to embed in a single forward pass (None means no limit).
+
+        max_tokens : int or None
+            The most (padded) tokens to embed in a single forward pass (None means no limit).
+        """
         import transformers
         self.tokenizer = transformers.AutoTokenizer.from_pretrained(model)
         self.model = transformers.AutoModel.from_pretrained(model)
         self.model_name = model
-        self.name = "adatest.embedders.TransformersTextEmbedding(" + self.model_name + "):"
+        self.name = _transformers_embedding_name(model)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
 
     def __call__(self, strings):
         import torch
 
-        encoded_input = self.tokenizer(strings, padding=True, truncation=True, return_tensors='pt')
+        encoded = self.tokenizer(list(strings), truncation=True)
+        lengths = np.array([len(ids) for ids in encoded["input_ids"]])
+        embeds = np.zeros((len(strings), self.model.config.hidden_size), dtype=np.float32)
+        for batch in _length_batches(lengths, self.batch_size, self.max_tokens):
+            encoded_input = self.tokenizer.pad({k: [encoded[k][i] for i in batch] for k in encoded.keys()}, return_tensors='pt')
+
+            # Compute token embeddings
+            with torch.no_grad():
+                model_output = self.model(**encoded_input)
+
+            # Perform mean pooling
+            token_embeddings = model_output[0] # First element of model_output contains all token embeddings
+            input_mask_expanded = encoded_input['attention_mask'].unsqueeze(-1).expand(token_embeddings.size()).float()
+            batch_embeds = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+            embeds[batch] = batch_embeds.cpu().numpy()
+        return embeds
+
+class QuantizedTransformersTextEmbedding(TransformersTextEmbedding):
+    def __init__(self, model="sentence-transformers/stsb-roberta-base-v2", batch_size=64, max_tokens=8192):
+        """ Embed text on the CPU with a dynamically int8 quantized version of a HuggingFace transformers model.
+
+        The weights of every linear layer are stored as int8 and activations are quantized on the fly, which makes
+        CPU inference faster and the model smaller at the cost of slightly different embeddings (so they are cached
+        under their own name, not the name of the fp32 model). See development/scripts/benchmark_embedders.py for
+        the accuracy check against the fp32 embeddings.
+
+        Parameters
+        ----------
+        model : str
+            The name (or path) of the model to load and quantize.
+
+        batch_size : int or None
+            The most strings to embed in a single forward pass (None means no limit).
+
+        max_tokens : int or None
+            The most (padded) tokens to embed in a single forward pass (None means no limit).
+        """
+        import torch
+        super().__init__(model, batch_size=batch_size, max_tokens=max_tokens)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # newer versions of torch warn that the quantized tensor types are deprecated
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.name = "adatest.embedders.QuantizedTransformersTextEmbedding(" + self.model_name + "):"
+
+def _transformers_embedding_name(model):
+    return "adatest.embedders.TransformersTextEmbedding(" + model + "):"
+
+def _length_batches(lengths, batch_size, max_tokens):
+    """ Split the positions of strings with the given token lengths into batches of similar length.
+
+    The longest strings come first (so running out of memory happens right away), and a batch holds at most
+    batch_size strings and at most max_tokens tokens once padded to its longest string.
+    """
+    order = np.argsort(-lengths, kind="stable")
+    batches = []
+    start = 0
+    while start < len(order):
+        size = len(order) - start
+        if batch_size is not None:
+            size = min(size, batch_size)
+        if max_tokens is not None:
+            size = min(size, max(1, max_tokens // max(1, lengths[order[start]])))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+class EmbeddingPool():
+    def __init__(self, model="sentence-transformers/stsb-roberta-base-v2", num_workers=None, chunk_size=256, **kwargs):
+        """ Embed text with TransformersTextEmbedding replicas running in a pool of worker processes.
+
+        Each call is split into chunks of similar length strings that the workers embed in parallel, and `_embed`
+        caches every chunk as soon as it comes back. Embeddings are identical to (and cached under the same keys
+        as) those of a TransformersTextEmbedding for the same model, so the two can be swapped freely.
+
+        Parameters
+        ----------
+        model : str
+            The name (or path) of the model each worker loads.
+
+        num_workers : int or None
+            The number of worker processes (None means one per CPU). Torch threads are split evenly between them.
+
+        chunk_size : int
+            The number of strings we send to a worker at a time.
+
+        **kwargs
+            Passed on to TransformersTextEmbedding (like batch_size and max_tokens).
+        """
+        self.model_name = model
+        self.name = _transformers_embedding_name(model)
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.kwargs = kwargs
+        self._executor = None
+
+    def __call__(self, strings):
+        out = None
+        for positions, embeds in self.embed_chunks(strings):
+            if out is None:
+                out = np.zeros((len(strings), embeds.shape[1]), dtype=np.float32)
+            out[positions] = embeds
+        return out if out is not None else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_chunks(self, strings):
+        """ Embed strings in the worker processes, yielding (positions, embeddings) for each chunk as it finishes.
+        """
+        import concurrent.futures
+
+        # chunks of similar length strings waste less time on padding
+        order = np.argsort([-len(s) for s in strings], kind="stable")
+        futures = {}
+        for start in range(0, len(order), self.chunk_size):
+            positions = order[start:start + self.chunk_size]
+            futures[self._pool().submit(_pool_worker_embed, [strings[i] for i in positions])] = positions
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+    def close(self):
+        """ Shut down the worker processes (they are started again on the next call).
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            import concurrent.futures
+            import multiprocessing
+            num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.num_workers, mp_context=multiprocessing.get_context("spawn"), # forking a process that already ran torch can deadlock
+                initializer=_pool_worker_init, initargs=(self.model_name, self.kwargs, num_threads)
+            )
+        return self._executor
+
+_pool_worker_model = None # the TransformersTextEmbedding replica of an EmbeddingPool worker process
 
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = self.model(**encoded_input)
+def _pool_worker_init(model, kwargs, num_threads):
+    import torch
+    global _pool_worker_model
+    torch.set_num_threads(num_threads)
+    _pool_worker_model = TransformersTextEmbedding(model, **kwargs)
 
-        # Perform mean pooling
-        token_embeddings = model_output[0] # First element of model_output contains all token embeddings
-        input_mask_expanded = encoded_input['attention_mask'].unsqueeze(-1).expand(token_embeddings.size()).float()
-        embeds = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
-        return embeds.cpu().numpy()
+def _pool_worker_embed(strings):
+    return _pool_worker_model(strings)
 
 class OpenAITextEmbedding():
     def __init__(self, model="text-similarity-babbage-001", api_key=None, replace_newlines=True):
@@ -430,8 +430,8 @@ class TestTreeSource(Generator):
         # Find tests closest to the proposals in the embedding space
         # TODO: Hallicunate extra samples if len(prompts) is insufficient for good embedding calculations.
         # TODO: Handle case when suggestion_threads>1 better than just selecting the first set of prompts as we do here
-        topic_embeddings = np.vstack([adatest._embedding_cache[input] for topic,input in prompts[0]]) 
-        data_embeddings = np.vstack([adatest._embedding_cache[input] for input in self.source["input"]])
+        topic_embeddings = np.vstack(adatest.embed([input for topic,input in prompts[0]]))
+        data_embeddings = self.source.embeddings(column="input")
         
         max_suggestions = min(num_samples * len(prompts), len(data_embeddings))
         method = 'distance_to_avg'
@@ -440,9 +440,9 @@ class TestTreeSource(Generator):
             closest_indices = np.argpartition(dist.mean(axis=0), -max_suggestions)[-max_suggestions:]
             
         elif method == 'distance_to_avg':
-            avg_topic_embedding = topic_embeddings.mean(axis=0)
+            avg_topic_embedding = topic_embeddings.mean(axis=0, keepdims=True)
 
-            distance = cos_sim(avg_topic_embedding, data_embeddings)
+            distance = cos_sim(avg_topic_embedding, data_embeddings)[0]
             closest_indices = np.argpartition(distance, -max_suggestions)[-max_suggestions:]
 
         output = self.source.iloc[np.array(closest_indices).squeeze()].copy()
@@ -7,6 +7,19 @@ import { changeInput, changeLabel, changeOutput, deleteTest, moveTest } from './
 import ContentEditable from './content-editable';
 import ContextMenu from './context-menu';
 
+// tests send their scores as a list of [id, score] pairs, while folders send a summary of their subtree
+function scoreSummary(scores) {
+  if (!Array.isArray(scores)) {
+    return {n_pass: scores.n_pass, n_fail: scores.n_fail, mean: scores.mean === null ? NaN : scores.mean};
+  }
+  const arr = scores.filter(x => Number.isFinite(x[1])).map(x => x[1]);
+  return {
+    n_pass: scores.reduce((total, value) => total + (value[1] <= 0), 0),
+    n_fail: scores.reduce((total, value) => total + (value[1] > 0), 0),
+    mean: arr.reduce((a, b) => a + b, 0) / arr.length
+  };
+}
+
 export default class Row extends React.Component {
   constructor(props) {
     super(props);
@@ -82,10 +95,8 @@ export default class Row extends React.Component {
       for (const k of this.props.scoreColumns) {
         if (this.state.scores && this.props.updateTotals) {
           // console.log("this.props.updateTotals", k, this.state.scores[k])
-          this.props.updateTotals(k,
-            this.state.scores[k].reduce((total, value) => total + (value[1] <= 0), 0),
-            this.state.scores[k].reduce((total, value) => total + (value[1] > 0), 0)
-          );
+          const summary = scoreSummary(this.state.scores[k]);
+          this.props.updateTotals(k, summary.n_pass, summary.n_fail);
         }
       }
     }
@@ -190,8 +201,7 @@ export default class Row extends React.Component {
     let overall_score = {};
     if (this.state.scores) {
       for (let k in this.state.scores) {
-        const arr = this.state.scores[k].filter(x => Number.isFinite(x[1])).map(x => x[1])
-        overall_score[k] = arr.reduce((a, b) => a + b, 0) / arr.length;
+        overall_score[k] = scoreSummary(this.state.scores[k]).mean;
       }
     } else {
       for (let k in overall_score) {
@@ -336,12 +346,11 @@ export default class Row extends React.Component {
       {this.props.scoreColumns && this.props.scoreColumns.map(k => {
 
         let total_pass = 0;
-        if (this.state.topic_name !== null) {
-          total_pass = this.state.scores[k].reduce((total, value) => total + (value[1] <= 0), 0);
-        }
         let total_fail = 0;
         if (this.state.topic_name !== null) {
-          total_fail = this.state.scores[k].reduce((total, value) => total + (value[1] > 0), 0);
+          const summary = scoreSummary(this.state.scores[k]);
+          total_pass = summary.n_pass;
+          total_fail = summary.n_fail;
         }
 
         let label_opacity = isNaN(overall_score[k]) ? 0.5 : 1;
@@ -0,0 +1,248 @@
+""" Benchmarks for the embedding caches on large numbers of strings.
+
+Usage: python development/scripts/benchmark_embedders.py [sizes...]
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+
+import numpy as np
+import diskcache
+
+import adatest
+import adatest.embedders
+
+_logger = logging.getLogger(__file__)
+logging.basicConfig(level=logging.INFO)
+
+
+class RandomTextEmbedding():
+    """ A stand in for a real text embedding model (so the benchmarks measure the caches, not the model).
+    """
+    name = "benchmark.RandomTextEmbedding:"
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def __call__(self, strings):
+        return np.random.rand(len(strings), self.dim).astype(np.float32)
+
+
+def timeit(fn, repeat=1):
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    return (time.time() - start) / repeat, out
+
+
+def benchmark_disk_tier(sizes, dim=768):
+    _logger.info(f"Writing and reading {dim} dim embeddings in the disk tier one key at a time (pickled), in bulk (raw float32) and in a vector store")
+    model = RandomTextEmbedding.name
+    for n in sizes:
+        keys = [adatest.embedders._cache_key("benchmark:%d" % i) for i in range(n)]
+        embeddings = np.random.rand(n, dim).astype(np.float32)
+        with tempfile.TemporaryDirectory() as td:
+            cache = diskcache.Cache(td + "/per_key")
+            def write_per_key():
+                for key, e in zip(keys, embeddings):
+                    cache[key] = e
+            def read_per_key():
+                return [cache[key] for key in keys if key in cache]
+            elapsed_write, _ = timeit(write_per_key)
+            elapsed_read, _ = timeit(read_per_key)
+            cache.close()
+
+            times = {}
+            for name, store in [("bulk", diskcache.Cache(td + "/bulk")), ("vector store", adatest.embedders.VectorStore(td + "/vectors"))]:
+                adatest.embedders._embedding_file_cache = store
+                elapsed_bulk_write, _ = timeit(lambda: adatest.embedders._write_file_cache(dict(zip(keys, embeddings)), model))
+                elapsed_bulk_read, found = timeit(lambda: adatest.embedders._read_file_cache({key: None for key in keys}, model))
+                assert len(found) == n
+                times[name] = (elapsed_bulk_write, elapsed_bulk_read)
+                if isinstance(store, diskcache.Cache):
+                    store.close()
+        _logger.info(
+            f"  {n:>9,d} strings: write {elapsed_write:6.2f}s per key, {times['bulk'][0]:6.2f}s bulk, {times['vector store'][0]:6.2f}s vector store;"
+            f" read {elapsed_read:6.2f}s per key, {times['bulk'][1]:6.2f}s bulk, {times['vector store'][1]:6.2f}s vector store"
+        )
+
+
+def benchmark_embed(sizes):
+    _logger.info("adatest.embed on new strings (cold) and on strings only in the disk tier (after a restart)")
+    adatest.text_embedding_model = RandomTextEmbedding()
+    for n in sizes:
+        strings = ["test input %d" % i for i in range(n)]
+        for backend in ["diskcache", "vector store"]:
+            with tempfile.TemporaryDirectory() as td:
+                if backend == "diskcache":
+                    adatest.embedders._embedding_file_cache = diskcache.Cache(td)
+                else:
+                    adatest.embedders.use_vector_store(td)
+                adatest.embedders._embedding_memory_cache = adatest.embedders.LRUEmbeddingCache()
+                elapsed_cold, _ = timeit(lambda: adatest.embed(strings))
+                adatest.embedders._embedding_memory_cache = adatest.embedders.LRUEmbeddingCache()
+                elapsed_disk, _ = timeit(lambda: adatest.embed(strings))
+                if backend == "diskcache":
+                    adatest.embedders._embedding_file_cache.close()
+            _logger.info(f"  {n:>9,d} strings {backend:>12}: cold {elapsed_cold:6.2f}s, from disk {elapsed_disk:6.2f}s")
+
+
+def load_transformers_embedding(td, embedding_class=adatest.embedders.TransformersTextEmbedding, **kwargs):
+    """ The default transformers model, or a randomly initialized model of the same shape when we are offline.
+    """
+    try:
+        return embedding_class(**kwargs)
+    except OSError:
+        import tokenizers
+        import transformers
+        if not os.path.exists(td + "/config.json"):
+            vocab = {w: i for i, w in enumerate(["<pad>", "<unk>"] + ["w%d" % i for i in range(50000)])}
+            tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="<unk>"))
+            tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+            transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>").save_pretrained(td)
+            transformers.RobertaModel(transformers.RobertaConfig(vocab_size=len(vocab), pad_token_id=0)).save_pretrained(td)
+        return embedding_class(td, **kwargs)
+
+
+def benchmark_transformers(num_strings=1000, max_words=120):
+    _logger.info(f"TransformersTextEmbedding on {num_strings:,d} strings of 3 to {max_words} words on the CPU")
+    rng = np.random.RandomState(0)
+    lengths = np.minimum(3 + rng.geometric(0.08, num_strings), max_words) # mostly short tests with a long tail
+    strings = [" ".join("w%d" % v for v in rng.randint(0, 50000, n)) for n in lengths]
+    with tempfile.TemporaryDirectory() as td:
+        for name, kwargs in [("one padded batch", dict(batch_size=None, max_tokens=None)), ("length buckets", dict())]:
+            model = load_transformers_embedding(td, **kwargs)
+            model(strings[:10]) # warm up
+            elapsed, _ = timeit(lambda: model(strings))
+            _logger.info(f"  {name:>16}: {elapsed:6.2f}s ({num_strings / elapsed:7.1f} embeddings/sec)")
+
+
+def benchmark_pool(num_strings=1000, num_workers=[2, 4], max_words=120):
+    _logger.info(f"EmbeddingPool vs. a single TransformersTextEmbedding on {num_strings:,d} strings ({os.cpu_count()} CPUs)")
+    rng = np.random.RandomState(0)
+    lengths = np.minimum(3 + rng.geometric(0.08, num_strings), max_words)
+    strings = [" ".join("w%d" % v for v in rng.randint(0, 50000, n)) for n in lengths]
+    with tempfile.TemporaryDirectory() as td:
+        model = load_transformers_embedding(td)
+        model(strings[:10]) # warm up
+        elapsed, _ = timeit(lambda: model(strings))
+        _logger.info(f"  {'in process':>16}: {elapsed:6.2f}s ({num_strings / elapsed:7.1f} embeddings/sec)")
+        path = td if os.path.exists(td + "/config.json") else model.model_name
+        for n in num_workers:
+            pool = adatest.embedders.EmbeddingPool(path, num_workers=n, chunk_size=64)
+            pool(strings) # start the workers and load their models
+            elapsed, _ = timeit(lambda: pool(strings))
+            pool.close()
+            _logger.info(f"  {str(n) + ' workers':>16}: {elapsed:6.2f}s ({num_strings / elapsed:7.1f} embeddings/sec)")
+
+
+def benchmark_quantized(num_strings=1000, max_words=120, k=10):
+    _logger.info(f"fp32 vs. int8 quantized TransformersTextEmbedding on {num_strings:,d} strings on the CPU")
+    rng = np.random.RandomState(0)
+    lengths = np.minimum(3 + rng.geometric(0.08, num_strings), max_words)
+    strings = [" ".join("w%d" % v for v in rng.randint(0, 50000, n)) for n in lengths]
+    with tempfile.TemporaryDirectory() as td:
+        embeddings = {}
+        for name, embedding_class in [("fp32", adatest.embedders.TransformersTextEmbedding), ("int8", adatest.embedders.QuantizedTransformersTextEmbedding)]:
+            model = load_transformers_embedding(td, embedding_class)
+            model(strings[:10]) # warm up
+            elapsed, embeddings[name] = timeit(lambda: model(strings))
+            _logger.info(f"  {name:>5}: {elapsed:6.2f}s ({num_strings / elapsed:7.1f} embeddings/sec)")
+
+    # how close the quantized embeddings are, and how much the nearest neighbors (what adatest uses embeddings for) move
+    sims = np.diag(adatest.embedders.cos_sim(embeddings["int8"], embeddings["fp32"]))
+    neighbors = {}
+    for name, e in embeddings.items():
+        s = adatest.embedders.cos_sim(e, e)
+        np.fill_diagonal(s, -np.inf)
+        neighbors[name] = np.argsort(-s, axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbors["fp32"], neighbors["int8"])])
+    _logger.info(f"  cosine similarity to fp32: mean {sims.mean():.4f}, min {sims.min():.4f}; top {k} neighbor overlap {overlap:.3f}")
+
+
+class ClusterEmbedding():
+    """ A stand in for a text embedding model whose embeddings are noisy copies of one of two class centers.
+
+    Strings starting with "fail" are near one center and all other strings are near the other, so a topic
+    labeling model has a real (but not perfectly separable) signal to learn.
+    """
+    name = "benchmark.ClusterEmbedding:"
+
+    def __init__(self, dim=768, noise=20.0):
+        centers = np.random.RandomState(0).randn(2, dim)
+        self.centers = centers / np.linalg.norm(centers, axis=1, keepdims=True)
+        self.noise = noise / np.sqrt(dim)
+
+    def __call__(self, strings):
+        out = []
+        for s in strings:
+            rng = np.random.RandomState(int(adatest.embedders._cache_key(s)[:8], 16))
+            out.append(self.centers[int(s.startswith("fail"))] + self.noise * rng.randn(self.centers.shape[1]))
+        return np.vstack(out).astype(np.float32)
+
+
+def benchmark_float16(sizes, num_train=200, num_test=2000, k=10):
+    _logger.info("float32 vs. float16 embedding storage: memory, cos_sim error and TopicLabelingModel accuracy")
+    adatest.text_embedding_model = ClusterEmbedding()
+    adatest.embedders._embedding_file_cache = {}
+    rng = np.random.RandomState(0)
+
+    # the memory the in-memory cache needs
+    for n in sizes:
+        strings = ["test input %d" % i for i in range(n)]
+        megabytes = {}
+        for dtype in ["float32", "float16"]:
+            adatest.embedding_dtype = dtype
+            adatest.embedders._embedding_memory_cache = adatest.embedders.LRUEmbeddingCache()
+            adatest.embedders._embedding_file_cache = {}
+            adatest.embed(strings)
+            megabytes[dtype] = adatest.embedders.embedding_cache_stats()["megabytes"]
+        _logger.info(f"  {n:>9,d} strings: memory cache {megabytes['float32']:7.1f}MB float32, {megabytes['float16']:7.1f}MB float16")
+
+    # how much the similarities (and the nearest neighbors) move
+    strings = [("fail " if rng.rand() < 0.5 else "pass ") + "test %d" % i for i in range(num_test)]
+    embeddings = {}
+    for dtype in ["float32", "float16"]:
+        adatest.embedding_dtype = dtype
+        adatest.embedders._embedding_memory_cache = adatest.embedders.LRUEmbeddingCache()
+        adatest.embedders._embedding_file_cache = {}
+        embeddings[dtype] = np.vstack(adatest.embed(strings))
+    sims = {dtype: adatest.embedders.cos_sim(e, e) for dtype, e in embeddings.items()}
+    error = np.abs(sims["float32"] - sims["float16"])
+    neighbors = {}
+    for dtype, sim in sims.items():
+        np.fill_diagonal(sim, -np.inf)
+        neighbors[dtype] = np.argsort(-sim, axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbors["float32"], neighbors["float16"])])
+    _logger.info(f"  cos_sim error: mean {np.nanmean(error[np.isfinite(error)]):.2e}, max {np.nanmax(error[np.isfinite(error)]):.2e}; top {k} neighbor overlap {overlap:.4f}")
+
+    # the accuracy of a topic labeling model trained and evaluated on each kind of embedding
+    train = [("fail " if rng.rand() < 0.5 else "pass ") + "train %d" % i for i in range(num_train)]
+    predicted = {}
+    for dtype in ["float32", "float16"]:
+        adatest.embedding_dtype = dtype
+        adatest.embedders._embedding_memory_cache = adatest.embedders.LRUEmbeddingCache()
+        adatest.embedders._embedding_file_cache = {}
+        tree = adatest.TestTree([{"topic": "/T", "input": s, "output": "out", "label": "fail" if s.startswith("fail") else "pass", "labeler": "benchmark"} for s in train])
+        model = tree.topic_labeling_model("/T")
+        predictions = np.array([model(s, "out") for s in strings]) # the probability of the second class ("pass")
+        predicted[dtype] = predictions > 0.5
+        accuracy = np.mean(predicted[dtype] == np.array([s.startswith("pass") for s in strings]))
+        _logger.info(f"  {dtype}: TopicLabelingModel accuracy {accuracy:.4f}")
+    _logger.info(f"  float32 and float16 TopicLabelingModel predictions agree on {np.mean(predicted['float32'] == predicted['float16']):.4f} of the tests")
+    adatest.embedding_dtype = "float32"
+
+
+def main(sizes):
+    benchmark_disk_tier(sizes)
+    benchmark_embed(sizes)
+    benchmark_transformers()
+    benchmark_pool()
+    benchmark_quantized()
+    benchmark_float16(sizes)
+
+
+if __name__ == "__main__":
+    main([int(v) for v in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,269 @@
+""" Benchmarks for TestTree operations on large synthetic test trees.
+
+Usage: python development/scripts/benchmark_test_tree.py [sizes...]
+"""
+import os
+import sys
+import time
+import uuid
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import adatest
+
+_logger = logging.getLogger(__file__)
+logging.basicConfig(level=logging.INFO)
+
+
+def synthetic_tests(n, num_topics=1000, depth=3, seed=0):
+    """ Build a frame of n synthetic tests spread over a random topic hierarchy (without topic markers).
+    """
+    rng = np.random.RandomState(seed)
+    topics = []
+    for i in range(num_topics):
+        parts = ["topic %d" % rng.randint(0, 10) for _ in range(rng.randint(1, depth+1))]
+        topics.append("/" + "/".join(parts) + " %d" % i)
+    return pd.DataFrame({
+        "topic": [topics[i] for i in rng.randint(0, num_topics, n)],
+        "input": ["test input %d" % i for i in range(n)],
+        "output": rng.choice(["POSITIVE", "NEGATIVE"], n),
+        "label": rng.choice(["pass", "fail"], n),
+        "labeler": "benchmark",
+        "description": "",
+        "model score": rng.rand(n).astype(str)
+    }, index=[uuid.uuid4().hex for _ in range(n)])
+
+
+def timeit(fn, repeat=1):
+    start = time.time()
+    for _ in range(repeat):
+        out = fn()
+    return (time.time() - start) / repeat, out
+
+
+def benchmark_load(sizes, extensions=[".csv", ".parquet", ".feather"]):
+    _logger.info("TestTree(file) load time")
+    with tempfile.TemporaryDirectory() as td:
+        for n in sizes:
+            tests = synthetic_tests(n)
+            for ext in extensions:
+                path = os.path.join(td, "tree_%d%s" % (n, ext))
+                tree = adatest.TestTree(tests, index=tests.index)
+                getattr(tree, "to_" + ext[1:])(path)
+                elapsed, tree = timeit(lambda: adatest.TestTree(path))
+                size = os.path.getsize(path) / 1e6
+                _logger.info(f"  {n:>9,d} rows {ext:>8}: {elapsed:7.3f}s ({elapsed / n * 1e6:.2f}us/row, {size:.1f}MB, {len(tree):,d} rows loaded)")
+
+
+def benchmark_slicing(sizes):
+    _logger.info("TestTree.topic() and TestTree.loc[ids] slice time")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        topics = tree["topic"].unique()[:100]
+        tree.topic_index # build the index up front
+        elapsed, _ = timeit(lambda: [tree.topic(t) for t in topics])
+        _logger.info(f"  {n:>9,d} rows: topic() {elapsed / len(topics) * 1e3:8.3f}ms/call")
+        ids = list(tree.index[:1000])
+        elapsed, _ = timeit(lambda: tree.loc[ids], repeat=20)
+        _logger.info(f"  {n:>9,d} rows: loc[1000 ids] {elapsed * 1e3:8.3f}ms/call")
+
+
+def benchmark_metadata_columns(sizes):
+    _logger.info("TestTree metadata column memory and label mask time")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        for c in ["topic", "label", "labeler"]:
+            as_category = tree[c].memory_usage(index=False, deep=True) / 1e6
+            as_object = tree[c].astype(object).memory_usage(index=False, deep=True) / 1e6
+            _logger.info(f"  {n:>9,d} rows: {c:>8} {as_category:8.2f}MB as category, {as_object:8.2f}MB as object")
+        labels = tree["label"]
+        elapsed, _ = timeit(lambda: labels == "topic_marker", repeat=20)
+        object_labels = labels.astype(object)
+        object_elapsed, _ = timeit(lambda: object_labels == "topic_marker", repeat=20)
+        _logger.info(f"  {n:>9,d} rows: label mask {elapsed * 1e3:8.3f}ms as category, {object_elapsed * 1e3:8.3f}ms as object")
+
+
+def benchmark_deduplicate(sizes, batch_size=50):
+    _logger.info("TestTree.deduplicate() time (full pass and incremental after appending a batch of suggestions)")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        elapsed, _ = timeit(lambda: tree.deduplicate())
+        _logger.info(f"  {n:>9,d} rows: full {elapsed * 1e3:8.1f}ms")
+        tree.deduplicate(incremental=True)
+        topic = tree["topic"].iloc[0]
+        def add_batch_and_deduplicate():
+            tree.append(pd.DataFrame({
+                "topic": topic + "/__suggestions__", "input": ["suggestion %s" % uuid.uuid4().hex for _ in range(batch_size)],
+                "output": "POSITIVE", "label": "", "labeler": "imputed", "description": ""
+            }, index=[uuid.uuid4().hex for _ in range(batch_size)]))
+            tree.deduplicate(incremental=True)
+        elapsed, _ = timeit(add_batch_and_deduplicate, repeat=5)
+        _logger.info(f"  {n:>9,d} rows: append {batch_size} + incremental {elapsed * 1e3:8.1f}ms")
+
+
+def benchmark_extend(sizes, batch_size=100):
+    _logger.info(f"Adding {batch_size} suggestions one cell at a time with loc vs. with TestTree.extend()")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        topic = tree["topic"].iloc[0] + "/__suggestions__"
+        rows = [{"topic": topic, "input": "suggestion %d" % i, "output": "[no output]", "label": "", "labeler": "imputed", "description": "", "model score": "__TOEVAL__"} for i in range(batch_size)]
+        def add_with_loc():
+            for row in rows:
+                id = uuid.uuid4().hex
+                for k, v in row.items():
+                    tree.loc[id, k] = v
+        elapsed_loc, _ = timeit(add_with_loc)
+        elapsed_extend, _ = timeit(lambda: tree.extend(rows))
+        _logger.info(f"  {n:>9,d} rows: loc {elapsed_loc:8.3f}s, extend {elapsed_extend * 1e3:8.1f}ms")
+
+
+def benchmark_topic_stats(sizes):
+    _logger.info("Summarizing the scores of the top level topics (what the browser does on every redraw)")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        top_topics = [t for t in tree.topic_index.subtopics("", include_self=False) if t.count("/") == 1]
+        elapsed_build, _ = timeit(lambda: tree.topic_stats)
+        elapsed, _ = timeit(lambda: [tree.topic_stats.subtree(t) for t in top_topics], repeat=5)
+        tree.loc[tree.index[0], "model score"] = 0.5 # an edit only recomputes the totals of a single topic
+        elapsed_edit, _ = timeit(lambda: [tree.topic_stats.subtree(t) for t in top_topics])
+        _logger.info(f"  {n:>9,d} rows: build {elapsed_build:7.3f}s, {len(top_topics)} topics {elapsed * 1e3:8.2f}ms, after an edit {elapsed_edit * 1e3:8.2f}ms")
+
+
+def benchmark_text_search(sizes, queries=["input 12", "NEGATIVE", "put 9999", "input 123456"]):
+    _logger.info("Finding the tests that contain a filter string with a scan vs. with the trigram text index")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        elapsed_build, _ = timeit(lambda: tree.search("build"))
+        for text in queries:
+            elapsed_scan, _ = timeit(lambda: (tree["input"].str.contains(text, regex=False) | tree["output"].str.contains(text, regex=False)).values)
+            elapsed, ids = timeit(lambda: tree.search(text), repeat=5)
+            if ids is None:
+                _logger.info(f"  {n:>9,d} rows: {text!r:>12} scan {elapsed_scan * 1e3:8.2f}ms, too common for the index")
+            else:
+                _logger.info(f"  {n:>9,d} rows: {text!r:>12} scan {elapsed_scan * 1e3:8.2f}ms, index {elapsed * 1e3:8.2f}ms ({len(ids):,d} matches, index built in {elapsed_build:.2f}s)")
+
+
+def benchmark_move_topic(sizes):
+    _logger.info("Moving and then deleting a top level topic subtree")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        topic = "/" + tree["topic"].iloc[0].split("/")[1]
+        tree.topic_index # build the index up front
+        elapsed_move, ids = timeit(lambda: tree.move_topic(topic, "/moved"))
+        elapsed_drop, _ = timeit(lambda: tree.drop_topic("/moved", subtopics=True))
+        _logger.info(f"  {n:>9,d} rows: move {len(ids):,d} rows {elapsed_move * 1e3:8.1f}ms, delete {elapsed_drop * 1e3:8.1f}ms")
+
+
+def benchmark_clear_suggestions(sizes, num_suggestions=50):
+    _logger.info(f"Clearing the {num_suggestions} suggestions of a topic (what the browser does before generating new ones)")
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        tree.topic_index # build the index up front
+        topic = tree["topic"].iloc[0] + "/__suggestions__"
+        def add_and_clear():
+            tree.extend([{"topic": topic, "input": "suggestion %d" % i, "output": "POSITIVE"} for i in range(num_suggestions)])
+            start = time.time()
+            tree.drop_topic(topic, subtopics=True)
+            return time.time() - start
+        elapsed = np.mean([add_and_clear() for _ in range(5)])
+        _logger.info(f"  {n:>9,d} rows: {elapsed * 1e3:8.1f}ms")
+
+
+def benchmark_sharded(sizes):
+    _logger.info("Startup, first visit to a top level topic, and save after one edit: a single CSV file vs. a directory of shards")
+    with tempfile.TemporaryDirectory() as td:
+        for n in sizes:
+            tests = synthetic_tests(n)
+            csv_path = os.path.join(td, "tree_%d.csv" % n)
+            shards_path = os.path.join(td, "tree_%d" % n) + "/"
+            tree = adatest.TestTree(tests, index=tests.index)
+            tree.to_csv(csv_path)
+            tree.to_shards(shards_path)
+            elapsed_csv, csv_tree = timeit(lambda: adatest.TestTree(csv_path))
+            elapsed_shards, sharded_tree = timeit(lambda: adatest.TestTree(shards_path))
+            topic = sharded_tree.topic_index.subtopics("", include_self=False)[0]
+            elapsed_visit, ids = timeit(lambda: sharded_tree.load_topic(topic))
+            id = sharded_tree.topic_ids(topic)[-1]
+            def edit_and_save(tree):
+                tree.loc[id, "input"] = "edited"
+                tree.save()
+            elapsed_csv_save, _ = timeit(lambda: edit_and_save(csv_tree))
+            elapsed_shards_save, _ = timeit(lambda: edit_and_save(sharded_tree))
+            _logger.info(f"  {n:>9,d} rows: startup {elapsed_csv:6.2f}s csv, {elapsed_shards * 1e3:7.1f}ms shards ({len(sharded_tree) - len(ids):,d} root rows)")
+            _logger.info(f"  {n:>9,d} rows: visit {topic} {elapsed_visit:6.2f}s ({len(ids):,d} rows), save {elapsed_csv_save:6.2f}s csv, {elapsed_shards_save:6.2f}s shards")
+
+
+class RandomTextEmbedding():
+    """ A stand in for a real text embedding model (so the benchmarks measure the lookups, not the model).
+    """
+    name = "benchmark.RandomTextEmbedding:"
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    def __call__(self, strings):
+        return np.random.rand(len(strings), self.dim).astype(np.float32)
+
+
+def benchmark_embeddings(sizes, num_ids=10000):
+    _logger.info(f"Gathering the input/output embeddings of {num_ids:,d} tests from the (warm) string cache vs. the test tree embedding matrix")
+    adatest.text_embedding_model = RandomTextEmbedding()
+    adatest.embedders._embedding_file_cache = {} # don't fill the real on-disk cache with random vectors
+    for n in sizes:
+        tree = adatest.TestTree(synthetic_tests(n))
+        tree.embeddings() # warm both the string cache and the matrix
+        ids = tree.index[np.random.choice(len(tree), min(num_ids, len(tree)), replace=False)]
+        def from_string_cache():
+            return np.hstack([
+                np.vstack(adatest.embed([tree.loc[id, "input"] for id in ids])),
+                np.vstack(adatest.embed([tree.loc[id, "output"] for id in ids]))
+            ])
+        elapsed_cache, _ = timeit(from_string_cache)
+        elapsed_matrix, _ = timeit(lambda: tree.embeddings(ids), repeat=5)
+        _logger.info(f"  {n:>9,d} rows: string cache {elapsed_cache * 1e3:8.1f}ms, matrix {elapsed_matrix * 1e3:8.1f}ms")
+
+
+def benchmark_prefetch(sizes):
+    _logger.info("Embeddings and topic model training for the first suggestion request after a topic change, cold vs. prefetched")
+    adatest.text_embedding_model = RandomTextEmbedding()
+    adatest.embedders._embedding_file_cache = {} # don't fill the real on-disk cache with random vectors
+    for n in sizes:
+        tests = synthetic_tests(n, num_topics=100)
+        tree = adatest.TestTree(tests, index=tests.index)
+        topic = tree["topic"][tree["label"] != "topic_marker"].value_counts().index[0]
+        def first_request(tree):
+            tree.retrain_topic_labeling_model(topic)
+            tree.retrain_topic_membership_model(topic)
+            tree.embeddings(tree.topic_index.ids(topic))
+        adatest.embedders._embedding_memory_cache.clear()
+        elapsed_cold, _ = timeit(lambda: first_request(tree))
+
+        adatest.embedders._embedding_memory_cache.clear()
+        tree = adatest.TestTree(tests, index=tests.index)
+        prefetcher = adatest._prefetcher.Prefetcher(tree)
+        prefetcher.start(topic)
+        prefetcher.wait()
+        elapsed_warm, _ = timeit(lambda: first_request(tree))
+        _logger.info(f"  {n:>9,d} rows: cold {elapsed_cold:6.2f}s, prefetched {elapsed_warm * 1e3:7.1f}ms ({len(tree.topic_index.ids(topic)):,d} tests in the topic)")
+
+
+def main(sizes):
+    benchmark_load(sizes)
+    benchmark_slicing(sizes)
+    benchmark_metadata_columns(sizes)
+    benchmark_deduplicate(sizes)
+    benchmark_extend(sizes)
+    benchmark_topic_stats(sizes)
+    benchmark_text_search(sizes)
+    benchmark_move_topic(sizes)
+    benchmark_clear_suggestions(sizes)
+    benchmark_sharded(sizes)
+    benchmark_embeddings(sizes)
+    benchmark_prefetch(sizes)
+
+
+if __name__ == "__main__":
+    main([int(v) for v in sys.argv[1:]] or [10000, 50000, 200000, 500000])
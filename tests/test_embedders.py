@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+import pytest
+
+import adatest
+import adatest.embedders
+
+
+class CountingEmbedding():
+    name = "counting:"
+
+    def __init__(self):
+        self.num_embedded = 0
+
+    def __call__(self, strings):
+        self.num_embedded += len(strings)
+        return np.array([[len(s), 1.0, 0.0, 0.0] for s in strings], dtype=np.float32)
+
+
+def test_embedding_cache(monkeypatch):
+    embed = CountingEmbedding()
+    monkeypatch.setattr(adatest, "text_embedding_model", embed)
+    monkeypatch.setattr(adatest, "embedding_cache_mb", 32 / 2**20) # room for two 4 dim float32 embeddings
+    monkeypatch.setattr(adatest.embedders, "_embedding_memory_cache", adatest.embedders.LRUEmbeddingCache())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", {"counting:legacy": np.ones(4, dtype=np.float32)})
+
+    out = adatest.embed(["a", "bb", "a", "ccc"])
+    assert [round(v[0] * np.linalg.norm([len(s), 1])) for v, s in zip(out, ["a", "bb", "a", "ccc"])] == [1, 2, 1, 3]
+    assert embed.num_embedded == 3
+
+    # the memory tier is bounded, but evicted embeddings are still found in the disk tier
+    stats = adatest.embedders.embedding_cache_stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    adatest.embed(["a"])
+    assert embed.num_embedded == 3
+
+    # embeddings saved under the old full string keys are moved to digest keys when they are read
+    assert adatest.embed(["legacy"])[0].tolist() == [1, 1, 1, 1]
+    assert embed.num_embedded == 3
+    assert "counting:legacy" not in adatest.embedders._embedding_file_cache
+    assert all(adatest.embedders._is_cache_key(k) for k in adatest.embedders._embedding_file_cache)
+
+
+def test_embedding_disk_cache(monkeypatch, tmp_path):
+    import diskcache
+    embed = CountingEmbedding()
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(adatest, "text_embedding_model", embed)
+    monkeypatch.setattr(adatest.embedders, "_embedding_memory_cache", adatest.embedders.LRUEmbeddingCache())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", cache)
+
+    first = adatest.embed(["a", "bb"])
+    assert all(isinstance(cache[k], bytes) for k in cache if adatest.embedders._is_cache_key(k)) # raw float32, not pickles
+
+    # embeddings pickled by older versions can still be read
+    cache[adatest.embedders._cache_key("counting:ccc")] = np.full(4, 0.5)
+    adatest.embedders._embedding_memory_cache.clear()
+    out = adatest.embed(["a", "bb", "ccc"])
+    assert embed.num_embedded == 2
+    assert np.allclose(out[0], first[0]) and out[2].dtype == np.float32 and out[2].tolist() == [0.5] * 4
+
+
+
+def test_float16_embeddings(monkeypatch, tmp_path):
+    import diskcache
+    embed = CountingEmbedding()
+    cache = diskcache.Cache(str(tmp_path))
+    monkeypatch.setattr(adatest, "text_embedding_model", embed)
+    monkeypatch.setattr(adatest, "embedding_dtype", "float16")
+    monkeypatch.setattr(adatest.embedders, "_embedding_memory_cache", adatest.embedders.LRUEmbeddingCache())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", cache)
+
+    # embeddings are cached in float16, but handed out as float32 (and the same whether they were cached or not)
+    cold = adatest.embed(["a", "bb"])
+    assert adatest.embedders.embedding_cache_stats()["megabytes"] * 2**20 == 2 * 4 * 2
+    warm = adatest.embed(["a", "bb"])
+    adatest.embedders._embedding_memory_cache.clear()
+    from_disk = adatest.embed(["a", "bb"])
+    assert all(v.dtype == np.float32 for v in cold + warm + from_disk) and embed.num_embedded == 2
+    assert np.array_equal(cold, warm) and np.array_equal(cold, from_disk)
+
+    # existing float32 (and pickled) embeddings can be rewritten in float16
+    cache[adatest.embedders._cache_key("counting:ccc")] = np.full(4, 0.5)
+    cache[adatest.embedders._cache_key("counting:dddd")] = adatest.embedders._encode_embedding(np.ones(4), "float32")
+    assert adatest.embedders.migrate_embedding_cache(dtype="float16") == 2
+    assert all(len(cache[k]) == 4 * 2 + 1 for k in cache if adatest.embedders._is_cache_key(k))
+
+
+def test_vector_store(monkeypatch, tmp_path):
+    embed = CountingEmbedding()
+    monkeypatch.setattr(adatest, "text_embedding_model", embed)
+    monkeypatch.setattr(adatest.embedders, "_embedding_memory_cache", adatest.embedders.LRUEmbeddingCache())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", adatest.embedders.VectorStore(str(tmp_path)))
+
+    first = adatest.embed(["a", "bb", "a"])
+    assert embed.num_embedded == 2
+
+    # a second process sees the vectors through its own mapping of the files
+    other = adatest.embedders.VectorStore(str(tmp_path))
+    keys = [adatest.embedders._cache_key("counting:" + s) for s in ["a", "bb", "ccc"]]
+    found = other.get_many(keys, "counting:")
+    assert list(found) == keys[:2] and np.allclose(found[keys[1]], first[1])
+
+    # writing a key again shadows its old row until we compact (here to float16)
+    other.set_many({keys[0]: np.zeros(4)}, "counting:")
+    assert adatest.embedders._embedding_file_cache.get_many(keys[:1], "counting:")[keys[0]].tolist() == [0] * 4
+    assert other.compact(dtype="float16") == 1 and len(other) == 2
+    assert len([f for f in os.listdir(str(tmp_path)) if f.endswith(".keys")]) == 1 # the old generation is gone
+    adatest.embedders._embedding_memory_cache.clear()
+    out = adatest.embed(["a", "bb"])
+    assert embed.num_embedded == 2 and out[0].tolist() == [0] * 4 and np.allclose(out[1], first[1], atol=1e-3)
+
+
+def save_tiny_transformers_model(path):
+    """ Save a tiny randomly initialized model (so we don't need to download one).
+    """
+    transformers = pytest.importorskip("transformers")
+    tokenizers = pytest.importorskip("tokenizers")
+    vocab = {w: i for i, w in enumerate(["<pad>", "<unk>", "<s>", "</s>"] + ["w%d" % i for i in range(50)])}
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", unk_token="<unk>").save_pretrained(str(path))
+    config = transformers.RobertaConfig(vocab_size=len(vocab), hidden_size=16, num_hidden_layers=1, num_attention_heads=2, intermediate_size=32, pad_token_id=0)
+    transformers.RobertaModel(config).save_pretrained(str(path))
+    return str(path)
+
+
+STRINGS = [" ".join("w%d" % ((i * j) % 50) for j in range(i % 7 + 1)) for i in range(20)]
+
+
+def test_transformers_batching(tmp_path):
+    path = save_tiny_transformers_model(tmp_path)
+    one_batch = adatest.embedders.TransformersTextEmbedding(path, batch_size=None, max_tokens=None)(STRINGS)
+    batched = adatest.embedders.TransformersTextEmbedding(path, batch_size=3, max_tokens=10)(STRINGS)
+    assert batched.shape == (20, 16) and np.allclose(one_batch, batched, atol=1e-5)
+    assert [len(b) for b in adatest.embedders._length_batches(np.array([1, 5, 2, 5]), 3, 10)] == [2, 2]
+
+
+def test_embedding_pool(monkeypatch, tmp_path):
+    path = save_tiny_transformers_model(tmp_path)
+    expected = adatest.embedders.TransformersTextEmbedding(path)(STRINGS)
+    pool = adatest.embedders.EmbeddingPool(path, num_workers=2, chunk_size=6)
+    monkeypatch.setattr(adatest, "text_embedding_model", pool)
+    monkeypatch.setattr(adatest.embedders, "_embedding_memory_cache", adatest.embedders.LRUEmbeddingCache())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", {})
+    try:
+        out = adatest.embed(STRINGS)
+        assert np.allclose(np.vstack(out), expected / np.linalg.norm(expected, axis=1, keepdims=True), atol=1e-5)
+        assert sum(adatest.embedders._is_cache_key(k) for k in adatest.embedders._embedding_file_cache) == len(set(STRINGS))
+    finally:
+        pool.close()
+
+
+def test_quantized_transformers_embedding(tmp_path):
+    path = save_tiny_transformers_model(tmp_path)
+    expected = adatest.embedders.TransformersTextEmbedding(path)(STRINGS)
+    quantized = adatest.embedders.QuantizedTransformersTextEmbedding(path)
+    assert quantized.name != adatest.embedders._transformers_embedding_name(path)
+    assert np.diag(adatest.embedders.cos_sim(quantized(STRINGS), expected)).min() > 0.98
@@ -2,8 +2,11 @@ from operator import truediv
 import os
 import pathlib
 import tempfile
+import threading
 
 import numpy as np
+import pandas as pd
+import pytest
 
 import adatest
 
@@ -71,3 +74,513 @@ def test_has_subtopic_or_tests():
     assert tree.topic_has_subtopics("/A/B") == False
     assert tree.topic_has_direct_tests("/A/C") == False
     assert tree.topic_has_subtopics("/A/C") == False
+
+
+def test_topic_index_tracks_edits():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    assert set(tree.topic("/A").index) == set(tree.index[tree["topic"].str.startswith("/A")])
+
+    # add a new test in a new subtopic
+    tree.loc["new_id"] = {"topic": "/A/C", "input": "x", "output": "y", "label": "pass", "labeler": "u", "description": ""}
+    assert tree.topic_has_direct_tests("/A/C") == True
+    assert "new_id" in tree.topic("/A").index
+
+    # move it out of /A
+    tree.loc["new_id", "topic"] = "/AB"
+    assert tree.topic_has_direct_tests("/A/C") == False
+    assert "new_id" not in tree.topic("/A").index
+    assert list(tree.topic("/AB").index) == ["new_id"]
+
+    # drop it
+    tree.drop("new_id", inplace=True)
+    assert len(tree.topic("/AB")) == 0
+    assert tree.topic_has_subtopics("/A") == True
+    tree.drop_topic("/A/B")
+    tree.drop_topic("/A/C")
+    assert tree.topic_has_subtopics("/A") == False
+
+
+def test_init_normalizes_topics():
+    tree = adatest.TestTree(
+        [
+            {"topic": "/A/B C", "input": "x", "output": "y", "label": "pass"},
+            {"topic": "/A/B C", "input": "x", "output": "y", "label": "pass"},
+            {"topic": "not a topic", "input": "z", "output": "y", "label": "fail"},
+        ]
+    )
+    markers = tree.loc[tree["label"] == "topic_marker"]
+    assert set(markers["topic"]) == {"", "/A", "/A/B%20C"}
+    assert sorted(tree.loc[tree["label"] != "topic_marker"]["topic"]) == ["", "/A/B%20C"]
+    assert tree.index.is_unique
+
+
+def test_slices_share_parent_settings():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    ids = list(tree.index[:3])
+    subset = tree.loc[ids]
+    assert isinstance(subset, adatest.TestTree)
+    assert list(subset.index) == ids
+    assert subset.name == tree.name
+    assert subset.labeling_model is tree.labeling_model
+    assert isinstance(tree.iloc[1:3], adatest.TestTree)
+    assert len(tree.loc[ids + ids[:1]]) == 3
+
+
+def test_journal_save_and_replay():
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        target_file = os.path.join(td, "tree.csv")
+        adatest.TestTree(str(curr_dir / "simple_test_tree.csv")).to_csv(target_file)
+        csv_contents = open(target_file).read()
+
+        tree = adatest.TestTree(target_file, journal=True)
+        first_id = tree.index[0]
+        tree.loc[first_id, "input"] = "edited input"
+        tree.loc["new_id"] = {"topic": "/A", "input": "new", "output": "o", "label": "pass", "labeler": "u", "description": ""}
+        tree.loc["suggestion_id"] = {"topic": "/A/__suggestions__", "input": "s", "output": "o", "label": "", "labeler": "imputed", "description": ""}
+        tree.drop(tree.index[tree["input"] == "Test under B"], inplace=True)
+        tree.save()
+
+        # only the journal was written
+        assert open(target_file).read() == csv_contents
+        assert os.path.exists(target_file + ".journal")
+
+        # reloading replays the journal
+        reloaded = adatest.TestTree(target_file)
+        assert reloaded.loc[first_id, "input"] == "edited input"
+        assert "new_id" in reloaded.index
+        assert "suggestion_id" not in reloaded.index
+        assert len(reloaded) == len(tree) - 1
+        assert "Test under B" not in list(reloaded["input"])
+
+        # compaction folds the journal back into the CSV file
+        tree.to_csv()
+        assert not os.path.exists(target_file + ".journal")
+        compacted = adatest.TestTree(target_file)
+        assert sorted(compacted.index) == sorted(reloaded.index)
+
+def test_full_save_retires_journal():
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        target_file = os.path.join(td, "tree.csv")
+        adatest.TestTree(str(curr_dir / "simple_test_tree.csv")).to_csv(target_file)
+        tree = adatest.TestTree(target_file, journal=True)
+        first_id = tree.index[0]
+        tree.loc[first_id, "input"] = "journaled"
+        tree.save()
+
+        # a full rewrite without the journal must not be undone by replaying the old journal on the next load
+        plain = adatest.TestTree(target_file)
+        plain.loc[first_id, "input"] = "rewritten"
+        plain.save()
+        assert not os.path.exists(target_file + ".journal")
+        assert adatest.TestTree(target_file).loc[first_id, "input"] == "rewritten"
+
+
+def test_columnar_round_trip():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    tree["model score"] = [0.25 * i for i in range(len(tree))]
+    with tempfile.TemporaryDirectory() as td:
+        for name in ["tree.parquet", "tree.feather"]:
+            target_file = os.path.join(td, name)
+            if name.endswith(".parquet"):
+                tree.to_parquet(target_file)
+                loaded = adatest.TestTree.from_parquet(target_file)
+            else:
+                tree.to_feather(target_file)
+                loaded = adatest.TestTree.from_feather(target_file)
+            assert sorted(loaded.index) == sorted(tree.index)
+            assert loaded.columns.to_list() == tree.columns.to_list()
+            assert loaded["model score"].dtype == np.float64
+            assert loaded.loc[tree.index[1], "input"] == tree.loc[tree.index[1], "input"]
+
+            # typed score columns still accept the browser's placeholder values
+            loaded.loc[loaded.index[0], "model score"] = "__TOEVAL__"
+            assert loaded.loc[loaded.index[0], "model score"] == "__TOEVAL__"
+
+            # save() writes back in the format given by the file extension
+            loaded.loc[loaded.index[0], "input"] = "edited"
+            loaded.save()
+            assert adatest.TestTree(target_file).loc[loaded.index[0], "input"] == "edited"
+
+
+def test_sqlite_storage():
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        target_file = os.path.join(td, "tree.sqlite")
+        tree = adatest.TestTree(target_file)
+        tree.append(adatest.TestTree(str(curr_dir / "simple_test_tree.csv")))
+        tree.save()
+
+        # a second process starts with just the topic markers and root tests, and reads the rest with indexed queries
+        other = adatest.TestTree(target_file)
+        assert ((other["label"] == "topic_marker") | (other["topic"] == "")).all()
+        mask = other.query(text="Test under B")
+        assert list(other.loc[mask.index[mask.values], "topic"]) == ["/A/B"]
+        assert not ((other["topic"] == "/A/C") & (other["label"] != "topic_marker")).any()
+        assert len(other.topic("/A")) == len(tree.topic("/A"))
+        other.load_topic("")
+        assert sorted(other.index) == sorted(tree.index)
+        assert other.columns.to_list() == tree.columns.to_list()
+
+        # rewriting a lazily loaded tree leaves the rows it never read alone
+        lazy = adatest.TestTree(target_file)
+        lazy.insert(len(lazy.columns), "note", "")
+        lazy.save()
+        assert len(adatest.TestTree(target_file).topic("")) == len(tree)
+
+        # edits are saved as small transactions that other processes can pull in
+        first_id = tree.index[0]
+        tree.loc[first_id, "input"] = "edited input"
+        tree.loc["new_id"] = {"topic": "/A", "input": "new", "output": "o", "label": "pass", "labeler": "u", "description": ""}
+        deleted_id = tree.index[tree["input"] == "Test under B"][0]
+        tree.drop(deleted_id, inplace=True)
+        tree.save()
+        other.refresh()
+        assert other.loc[first_id, "input"] == "edited input"
+        assert "new_id" in other.topic("/A").index
+        assert deleted_id not in other.index
+
+        # unsaved local edits are not overwritten by a refresh
+        other.loc["new_id", "input"] = "local edit"
+        tree.loc["new_id", "input"] = "remote edit"
+        tree.save()
+        other.refresh()
+        assert other.loc["new_id", "input"] == "local edit"
+
+
+def test_sharded_storage():
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        location = os.path.join(td, "tree") + "/"
+        tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+        tree.extend([{"topic": "/B", "input": "b", "output": "o", "label": "pass"}], index=["b_id"])
+        tree.to_shards(location)
+        assert sorted(os.listdir(os.path.join(location, "topics"))) == ["A.csv", "B.csv"]
+
+        # only the root shard is read up front
+        lazy = adatest.TestTree(location)
+        assert "b_id" not in lazy.index
+        assert len(lazy.topic("/A/B")) == len(tree.topic("/A/B"))
+        assert "b_id" not in lazy.index
+
+        # saving only rewrites the shards with changed rows
+        b_mtime = os.path.getmtime(os.path.join(location, "topics", "B.csv"))
+        lazy.loc[lazy.topic_ids("/A/B")[0], "input"] = "edited"
+        lazy.save()
+        assert os.path.getmtime(os.path.join(location, "topics", "B.csv")) == b_mtime
+
+        full = adatest.TestTree(location)
+        root_ids = set(full.index)
+        assert sorted(full.load_topic("")) == sorted(set(tree.index) - root_ids)
+        assert sorted(full.index) == sorted(tree.index)
+        assert "edited" in list(full.topic("/A/B")["input"])
+
+def test_sharded_storage_unvisited_topics():
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        location = os.path.join(td, "tree") + "/"
+        tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+        tree.extend([{"topic": "/B", "input": "b", "output": "o", "label": "pass"}], index=["b_id"])
+        tree.to_shards(location)
+        num_a = len(tree.topic("/A"))
+
+        # whole tree operations read every shard first
+        adatest.TestTree(location).to_csv(os.path.join(td, "export.csv"))
+        assert set(tree.index) <= set(adatest.TestTree(os.path.join(td, "export.csv")).index)
+
+        # deleting a topic we never visited removes its tests too
+        lazy = adatest.TestTree(location)
+        lazy.drop(lazy.topic_ids("/B"), inplace=True)
+        lazy.save()
+        reloaded = adatest.TestTree(location)
+        reloaded.load_topic("")
+        assert "b_id" not in reloaded.index and not any(reloaded["topic"].str.startswith("/B"))
+
+        # so does moving one
+        lazy = adatest.TestTree(location)
+        lazy.move_topic("/A", "/Z")
+        lazy.save()
+        reloaded = adatest.TestTree(location)
+        reloaded.load_topic("")
+        assert len(reloaded.topic("/Z")) == num_a
+        assert len(reloaded.topic("/A")) == 0
+
+        # incremental deduplication and filtering the listed topic only use the shards we have read
+        lazy = adatest.TestTree(location)
+        lazy.load_topic("/Z")
+        lazy.extend([{"topic": "/Z", "input": "twice added", "output": "o", "label": "pass"}] * 2)
+        lazy.deduplicate(incremental=True)
+        assert len(lazy._loaded_query(text="twice added", topic="/Z").values.nonzero()[0]) == 1
+        assert "b_id" not in lazy.index and lazy._store.loaded == {"", "Z"}
+
+def test_metadata_columns_stay_categorical():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+
+    def assert_categorical():
+        for c in ["topic", "label", "labeler"]:
+            assert isinstance(tree[c].dtype, pd.CategoricalDtype)
+
+    assert_categorical()
+    first_id = tree.index[0]
+    tree.loc[first_id, "topic"] = "/A/New topic"
+    tree.loc[first_id, ["label", "labeler"]] = ["fail", "new user"]
+    tree.loc["new_id"] = {"topic": "/Z", "input": "new", "output": "o", "label": "pass", "labeler": "other user", "description": ""}
+    tree.append({"topic": "/Y", "input": "appended", "output": "o", "label": "pass", "labeler": "u", "description": ""})
+    assert_categorical()
+    assert tree.loc[first_id, "labeler"] == "new user"
+    assert tree.topic_ids("/Z") == ["new_id"]
+
+    with tempfile.TemporaryDirectory() as td:
+        target_file = os.path.join(td, "tree.csv")
+        tree.to_csv(target_file)
+        tree = adatest.TestTree(target_file)
+        assert_categorical()
+        assert tree.loc["new_id", "labeler"] == "other user"
+
+
+def test_deduplicate():
+    tree = adatest.TestTree(pd.DataFrame({
+        "topic": ["/A", "/A", "/B", "/A/__suggestions__", "/A/__suggestions__"],
+        "input": ["x", "x", "x", "x", "y"],
+        "output": ["o", "o", "o", "o", "o"],
+        "label": ["pass", "fail", "pass", "", ""],
+        "labeler": ["user1", "user2", "user1", "imputed", "imputed"],
+    }), index=["a1", "a2", "b1", "s1", "s2"], ensure_topic_markers=False)
+    tree.deduplicate(incremental=True)
+    assert list(tree.index) == ["a1", "b1", "s2"]
+
+    # incremental mode only checks new rows against the rows we already have
+    tree.loc["s3"] = {"topic": "/B/__suggestions__", "input": "x", "output": "o", "label": "", "labeler": "imputed", "description": ""}
+    tree.loc["s4"] = {"topic": "/B/__suggestions__", "input": "z", "output": "o", "label": "", "labeler": "imputed", "description": ""}
+    tree.loc["a3"] = {"topic": "/A", "input": "y", "output": "o", "label": "pass", "labeler": "user", "description": ""}
+    tree.deduplicate(incremental=True)
+    assert list(tree.index) == ["a1", "b1", "s4", "a3"]
+
+    # edits are noticed as well
+    tree.loc["b1", "topic"] = "/A"
+    tree.deduplicate(incremental=True)
+    assert list(tree.index) == ["a1", "s4", "a3"]
+
+
+def test_extend():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    num_tests = len(tree)
+    ids = tree.extend([
+        {"topic": "/A", "input": "first", "output": "o", "label": "pass"},
+        {"topic": "/A/__suggestions__", "input": "second", "model score": "__TOEVAL__"}
+    ])
+    assert len(tree) == num_tests + 2
+    assert tree.loc[ids[0], "input"] == "first"
+    assert tree.loc[ids[1], "labeler"] == "imputed"
+    assert tree.loc[ids[1], "model score"] == "__TOEVAL__"
+    assert ids[0] in tree.topic("/A").index
+
+    # columnar input with explicit ids
+    tree.extend({"topic": ["/B", "/B"], "input": ["x", "y"]}, index=["x_id", "y_id"])
+    assert list(tree.topic_ids("/B", subtopics=False)[-2:]) == ["x_id", "y_id"]
+    assert isinstance(tree["topic"].dtype, pd.CategoricalDtype)
+
+
+def test_change_feed():
+    curr_dir = pathlib.Path(__file__).parent
+    trained = []
+    class CountingModel():
+        def __init__(self, topic, test_tree):
+            trained.append(topic)
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"), labeling_model=CountingModel, membership_model=CountingModel)
+    changes = []
+    tree.subscribe(lambda ids, columns: changes.append((ids, columns)))
+
+    first_id = tree.index[tree["topic"] == "/A"][0]
+    version = tree.version
+    tree.loc[first_id, "description"] = "new description"
+    assert tree.version == version + 1
+    assert changes[-1] == ([first_id], ["description"])
+    ids = tree.extend([{"topic": "/A/__suggestions__", "input": "suggestion"}])
+    assert changes[-1] == (ids, None)
+
+    # topic models are only retrained when their training data changed
+    tree.retrain_topic_labeling_model("/A")
+    tree.retrain_topic_labeling_model("/A")
+    tree.extend([{"topic": "/A/__suggestions__", "input": "another suggestion"}]) # imputed rows are not training data
+    tree.loc[first_id, "description"] = "another description"
+    tree.retrain_topic_labeling_model("/A")
+    assert trained == ["/A"]
+    tree.loc["new_id"] = {"topic": "/A", "input": "new", "output": "o", "label": "pass", "labeler": "user", "description": ""}
+    tree.retrain_topic_labeling_model("/A")
+    assert trained == ["/A", "/A"]
+
+
+def test_topic_stats():
+    tree = adatest.TestTree(pd.DataFrame({
+        "topic": ["/A", "/A/B", "/A/B", "/A/__suggestions__", "/C"],
+        "input": ["a", "b1", "b2", "s", "c"],
+        "output": ["o", "o", "o", "o", "o"],
+        "label": ["pass", "fail", "pass", "fail", "fail"],
+        "model score": [0.2, 0.7, "0.1|0.3", 0.9, ""],
+    }), index=["a", "b1", "b2", "s", "c"])
+    stats = tree.topic_stats.subtree("/A")
+    assert (stats["pass"], stats["fail"]) == (2, 1)
+    assert stats["model score"]["n_pass"] == 3 and stats["model score"]["n_fail"] == 1
+    assert np.isclose(stats["model score"]["max"], 0.7 + 1e-6)
+
+    # the stats follow edits
+    tree.loc["b1", "label"] = "pass"
+    tree.loc["b2", "topic"] = "/C"
+    stats = tree.topic_stats.subtree("/A")
+    assert stats["model score"]["n_pass"] == 2 and stats["model score"]["n_fail"] == 0
+    assert tree.topic_stats.subtree("/C")["model score"]["n_pass"] == 2
+    assert tree.topic_stats.subtree("")["pass"] == 3
+
+
+def test_query():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    tree.extend([
+        {"topic": "/A", "input": "The food was great", "output": "POSITIVE", "label": "pass", "model score": "0.1|0.8"},
+        {"topic": "/A/__suggestions__", "input": "The food was bad", "output": "NEGATIVE", "label": "fail", "model score": 0.4},
+    ], index=["great", "bad"])
+    assert list(tree.index[tree.query(text="food")]) == ["great", "bad"]
+    assert list(tree.index[tree.query(regex="food.*(great|awful)")]) == ["great"]
+    assert list(tree.index[tree.query(text="food", suggestions=False)]) == ["great"]
+    assert list(tree.index[tree.query(text="food", labels=["fail"])]) == ["bad"]
+    assert list(tree.index[tree.query(score_column="model score", min_score=0.5)]) == ["great"]
+    assert tree.query(topic="/A/__suggestions__").sum() == 1
+
+    # results are cached until the tree changes
+    assert tree.query(text="food") is tree.query(text="food")
+    tree.loc["bad", "input"] = "The soup was bad"
+    assert list(tree.index[tree.query(text="food")]) == ["great"]
+
+def test_text_index():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    tree.text_index_min_rows = 0 # force the index for a small tree
+    tree.extend([
+        {"topic": "/A", "input": "The food was great", "output": "VERY POSITIVE", "label": "pass"},
+        {"topic": "/A", "input": "The service was slow", "output": "NEGATIVE", "label": "fail"},
+    ], index=["great", "slow"])
+    assert tree.search("fo") is None # too short for the index
+    assert sorted(tree.search("was")) == ["great", "slow"]
+    assert list(tree.search("VERY POS")) == ["great"]
+    assert list(tree.search("food was slow")) == []
+
+    # edits, removals and new rows are all seen by the index
+    tree.loc["slow", "input"] = "The food was slow"
+    tree.drop("great", inplace=True)
+    tree.extend([{"topic": "/B", "input": "Good food", "output": "POSITIVE", "label": "pass"}], index=["good"])
+    assert sorted(tree.search("food")) == ["good", "slow"]
+    assert list(tree.index[tree.query(text="food was")]) == ["slow"]
+
+def test_move_and_drop_topic():
+    curr_dir = pathlib.Path(__file__).parent
+    tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+    tree.extend([
+        {"topic": "/E/B", "input": "x", "output": "POSITIVE", "label": "pass"},
+        {"topic": "/E/B/C", "input": "y", "output": "POSITIVE", "label": "pass"},
+        {"topic": "/EB", "input": "z", "output": "POSITIVE", "label": "pass"},
+    ], index=["x", "y", "z"])
+    moved = tree.move_topic("/E/B", "/D")
+    assert set(moved) == {"x", "y"}
+    assert list(tree.loc[["x", "y", "z"], "topic"]) == ["/D", "/D/C", "/EB"]
+    assert list(tree.topic_ids("/D/C")) == ["y"]
+    assert tree.topic_has_subtopics("/D")
+
+    tree.drop_topic("/D", subtopics=True)
+    assert "x" not in tree.index and "y" not in tree.index and "z" in tree.index
+    assert len(tree.topic_ids("/D")) == 0
+
+def test_embedding_matrix(monkeypatch):
+    class CountingEmbedding():
+        name = "counting:"
+        def __init__(self):
+            self.num_embedded = 0
+        def __call__(self, strings):
+            self.num_embedded += len(strings)
+            return [np.array([len(s), 1.0], dtype=np.float32) for s in strings]
+    embed = CountingEmbedding()
+    monkeypatch.setattr(adatest, "text_embedding_model", embed)
+    monkeypatch.setattr(adatest, "embed", embed)
+
+    curr_dir = pathlib.Path(__file__).parent
+    with tempfile.TemporaryDirectory() as td:
+        target_file = os.path.join(td, "tree.csv")
+        tree = adatest.TestTree(str(curr_dir / "simple_test_tree.csv"))
+        tree.extend([{"topic": "/A", "input": "abc", "output": "de", "label": "pass"}], index=["x"])
+        tree.to_csv(target_file)
+        tree = adatest.TestTree(target_file)
+        assert tree.embeddings(["x"]).tolist() == [[3, 1, 2, 1]]
+        assert tree.embeddings(["x"], column="output").tolist() == [[2, 1]]
+        assert embed.num_embedded == 2
+        assert not os.path.exists(target_file + ".embeddings.npy") # nothing is written until we save
+
+        # edits are re-embedded, and everything else is served from the matrix (also after a reload)
+        tree.loc["x", "input"] = "abcd"
+        assert tree.embeddings(["x"], column="input").tolist() == [[4, 1]]
+        tree.save()
+        assert os.path.exists(target_file + ".embeddings.npy")
+        num_embedded = embed.num_embedded
+        reloaded = adatest.TestTree(target_file)
+        assert reloaded.embeddings(["x"]).tolist() == [[4, 1, 2, 1]]
+        assert embed.num_embedded == num_embedded
+        with pytest.raises(KeyError):
+            reloaded.embeddings(["not a test id"])
+
+        # switching the embedding model starts a new matrix
+        class DoubleEmbedding():
+            name = "double:"
+            def __call__(self, strings):
+                return [np.array([2 * len(s), 1.0], dtype=np.float32) for s in strings]
+        monkeypatch.setattr(adatest, "text_embedding_model", DoubleEmbedding())
+        monkeypatch.setattr(adatest, "embed", adatest.text_embedding_model)
+        assert reloaded.embeddings(["x"]).tolist() == [[8, 1, 4, 1]]
+
+
+def test_prefetcher(monkeypatch, tmp_path):
+    class LengthEmbedding():
+        name = "length:"
+        def __call__(self, strings):
+            return [np.array([len(s), 1.0], dtype=np.float32) for s in strings]
+    monkeypatch.setattr(adatest, "text_embedding_model", LengthEmbedding())
+    monkeypatch.setattr(adatest.embedders, "_embedding_file_cache", {})
+
+    curr_dir = pathlib.Path(__file__).parent
+    adatest.TestTree(str(curr_dir / "simple_test_tree.csv")).to_csv(str(tmp_path / "tree.csv"))
+    tree = adatest.TestTree(str(tmp_path / "tree.csv"))
+    prefetcher = adatest._prefetcher.Prefetcher(tree)
+    assert prefetcher.neighborhood("/A") == ["/A", "/A/B", "/A/C"]
+    assert prefetcher.neighborhood("/A/B") == ["/A/B", "/A/C"]
+
+    prefetcher.start("/A/B")
+    prefetcher.wait()
+    assert prefetcher.warmed == [(step, topic) for topic in ["/A/B", "/A/C"] for step in ["embeddings", "labeling", "membership"]]
+    assert "/A/C" in tree._topic_labeling_models and "/A/C" in tree._topic_membership_models
+    assert tree._embedding_matrix is not None and "4b256f1fb5c64e13bc73106d2146257e" in tree._embedding_matrix._slots
+
+    # cancelling stops the run after the chunk in progress (here the first chunk cancels it, like an interface event would)
+    class CancellingEmbedding():
+        name = "cancelling:"
+        num_calls = 0
+        def __call__(self, strings):
+            CancellingEmbedding.num_calls += 1
+            prefetcher.cancel()
+            return [np.array([len(s), 1.0], dtype=np.float32) for s in strings]
+    monkeypatch.setattr(adatest, "text_embedding_model", CancellingEmbedding())
+    tree.extend([{"topic": "/A", "input": "test %d" % i, "output": "o", "label": "pass"} for i in range(20)])
+    prefetcher.chunk_size = 2
+    prefetcher.start("/A")
+    prefetcher.wait()
+    assert prefetcher.warmed == [] and CancellingEmbedding.num_calls <= 2 # the inputs and the outputs of one chunk
+
+    # a topic model that finishes training after a cancel is dropped (the tree may have changed under it)
+    cancelled = threading.Event()
+    cancelled.set()
+    tree._topic_labeling_models.pop("/A/C", None)
+    tree._train_topic_model("labeling", "/A/C", cancelled)
+    assert "/A/C" not in tree._topic_labeling_models